@@ -29,13 +29,11 @@ import pathlib
 #     SpatialCropGuidanced,
 # )
 # from monailabel.transform.post import Restored
-from monai.inferers import Inferer, SlidingWindowInferer
+from monai.inferers import Inferer
 from monai.transforms import (
-    Activationsd,
     # AddChanneld,
     # AsChannelFirstd,
     # AsChannelLastd,
-    AsDiscreted,
     EnsureTyped,
     LoadImaged,
     # NormalizeIntensityd,
@@ -60,6 +58,9 @@ from monailabel.tasks.infer.basic_infer import BasicInferTask, CallBackTypes
 # )
 # from sw_fastedit.utils.helper import AttributeDict
 from sw_fastedit.transforms import AddGuidanceSignal, AddEmptySignalChannels, NormalizeLabelsInDatasetd
+from sw_fastedit.helper_transforms import ArgmaxIfLogitsd
+from sw_fastedit.inferers import LowPrecisionSlidingWindowInferer
+from sw_fastedit.utils.quantization import load_quantized_network
 # from sw_fastedit.helper_transforms import SignalFillEmptyd
 
 monai_version = pkg_resources.get_distribution("monai").version
@@ -125,11 +126,18 @@ class SWFastEdit(BasicInferTask):
         self.sw_overlap = 0.25
         # Should be the same ROI size as it was trained on
         self.sw_roi_size = (128,128,128)
+        # Only the argmax is returned, so the windows are stitched in fp16 (or bf16) without a count map.
+        # Use "margin" for models with a single label (two output channels) to halve the stitching memory again
+        self.sw_stitching = "fp16"
         
         # Reduce this if you run into OOMs
         self.train_sw_batch_size = 8
         # Reduce this if you run into OOMs
         self.val_sw_batch_size = 16
+        self._inferer = None
+        # INT8 weights written by quantize.py for CPU-only annotation nodes, None to use the fp32 network
+        self.quantized_path = None
+        self._quantized_network = None
 
     def __call__(self, request, callbacks= None):
         if callbacks is None:
@@ -186,18 +194,31 @@ class SWFastEdit(BasicInferTask):
         t.extend(t_val_2)
         return t
 
+    def _get_network(self, device, data):
+        if self.quantized_path is None:
+            return super()._get_network(device, data)
+        if self._quantized_network is None:
+            self._quantized_network = load_quantized_network(
+                self.network, self.quantized_path, in_channels=1 + len(self.label_names), roi_size=self.sw_roi_size
+            )
+        return self._quantized_network
+
     def inferer(self, data=None) -> Inferer:
-        sw_params = {
-            "roi_size": self.sw_roi_size,
-            "mode":"gaussian",
-            "cache_roi_weight_map": False,
-            "overlap": self.sw_overlap,
-        }
-        eval_inferer = SlidingWindowInferer(
-            sw_batch_size=self.val_sw_batch_size,
-            **sw_params
-        )
-        return eval_inferer
+        # Built once, the window plans (slices, importance and count map) of repeated requests on the same study
+        # are cached by sw_fastedit.inferers.get_window_plan
+        if self._inferer is None:
+            sw_params = {
+                "roi_size": self.sw_roi_size,
+                "mode":"gaussian",
+                "cache_roi_weight_map": False,
+                "overlap": self.sw_overlap,
+            }
+            self._inferer = LowPrecisionSlidingWindowInferer(
+                sw_batch_size=self.val_sw_batch_size,
+                stitching=self.sw_stitching,
+                **sw_params
+            )
+        return self._inferer
 
     def inverse_transforms(self, data=None) -> Union[None, Sequence[Callable]]:
         return []  # Self-determine from the list of pre-transforms provided
@@ -207,8 +228,8 @@ class SWFastEdit(BasicInferTask):
         device = data.get("device") if data else None
         return [
             EnsureTyped(keys="pred", device=device),
-            Activationsd(keys="pred", softmax=True),
-            AsDiscreted(keys="pred", argmax=True),
+            # The inferer already returns the label map, the softmax is not needed for the argmax anyway
+            ArgmaxIfLogitsd(keys="pred"),
             SqueezeDimd(keys="pred", dim=0),
             EnsureTyped(keys="pred", device="cpu" if data else None, dtype=torch.uint8),
         ]
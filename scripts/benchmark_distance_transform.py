@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import argparse
+import logging
+
+import torch
+
+from sw_fastedit.utils.distance_transform import (
+    DISTANCE_TRANSFORM_BACKENDS,
+    benchmark_distance_transform_backends,
+    get_synthetic_discrepancy,
+)
+
+"""
+Compares all available distance transform backends against scipy on a synthetic discrepancy map and reports
+the seconds per voxel of each backend, so the fastest one can be passed as --distance_transform_backend.
+"""
+
+logger = logging.getLogger("sw_fastedit")
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    discrepancy = get_synthetic_discrepancy((64, 48, 40), device=args.device)
+    expected = DISTANCE_TRANSFORM_BACKENDS["scipy"](discrepancy)
+    for name, backend in DISTANCE_TRANSFORM_BACKENDS.items():
+        if name == "cucim" and not discrepancy.is_cuda:
+            continue
+        max_diff = torch.max(torch.abs(backend(discrepancy) - expected)).item()
+        logger.info(f"Distance transform backend {name:>9}: max abs difference to scipy: {max_diff:.2e}")
+
+    benchmark_distance_transform_backends(device=args.device, iterations=args.iterations)
+
+
+if __name__ == "__main__":
+    main()
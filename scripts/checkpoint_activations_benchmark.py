@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import time
+
+import torch
+
+from sw_fastedit.api import get_network
+from sw_fastedit.inferers import PeakMemory
+from sw_fastedit.utils.checkpointing import CHECKPOINT_GRANULARITIES
+
+"""
+Measures the peak memory and the step time (forward + backward) of a training step for every
+--checkpoint_activations granularity at several crop sizes, so the largest crop / batch which fits can be chosen.
+"""
+
+logger = logging.getLogger("sw_fastedit")
+logging.basicConfig(level=logging.INFO)
+
+LABELS = {"tumor": 1, "background": 0}
+
+
+def measure_step(network, inputs, device, iterations):
+    network.train()
+    # Warm-up, e.g. for the cudnn algorithm selection
+    network(inputs).sum().backward()
+    network.zero_grad(set_to_none=True)
+    with PeakMemory(device) as peak_memory:
+        start = time.time()
+        for _ in range(iterations):
+            network(inputs).sum().backward()
+            network.zero_grad(set_to_none=True)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+    return peak_memory.peak, (time.time() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--network", default="bigdynunet", choices=["dynunet", "smalldynunet", "bigdynunet", "hugedynunet"])
+    parser.add_argument("--crop_sizes", type=int, nargs="+", default=[64, 128, 192])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    for crop_size in args.crop_sizes:
+        inputs = torch.rand((args.batch_size, 1 + len(LABELS), crop_size, crop_size, crop_size), device=device)
+        for granularity in CHECKPOINT_GRANULARITIES:
+            network = get_network(args.network, LABELS, checkpoint_activations=granularity).to(device)
+            try:
+                peak, seconds = measure_step(network, inputs, device, args.iterations)
+                logger.info(
+                    f"crop {crop_size:>3} checkpoint_activations {granularity:>7}: "
+                    f"peak memory {peak / 2**30:6.2f} GiB, step time {seconds:6.2f} s"
+                )
+            except torch.cuda.OutOfMemoryError:
+                logger.info(f"crop {crop_size:>3} checkpoint_activations {granularity:>7}: OOM")
+            del network
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    main()
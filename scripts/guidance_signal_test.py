@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import torch
+from monai.networks.layers import GaussianFilter
+
+from sw_fastedit.click_definitions import LABELS_KEY
+from sw_fastedit.transforms import AddGuidanceSignal
+
+"""
+Checks the guidance signal of AddGuidanceSignal against the original implementation, which sets the clicks to 1 in
+an empty volume, applies the GaussianFilter to the whole volume, min-max normalizes it and thresholds it for disks.
+Covers neighbouring clicks (whose Gaussians overlap), clicks at the borders and clicks added over several iterations.
+"""
+
+IMAGE_SIZE = (40, 36, 32)
+CLICKS = {
+    "single": [[20, 18, 16]],
+    "adjacent": [[20, 18, 16], [21, 18, 16]],
+    "three_apart": [[20, 18, 16], [23, 18, 16], [20, 21, 16]],
+    "border": [[0, 0, 0], [39, 35, 31], [2, 35, 0]],
+    "duplicate": [[10, 10, 10], [10, 10, 10], [12, 10, 10]],
+    "outside": [[5, 5, 5], [-1, -1, -1], [50, 10, 10]],
+}
+
+
+def get_baseline_signal(clicks, sigma: int, disks: bool) -> torch.Tensor:
+    signal = torch.zeros(IMAGE_SIZE)
+    for point in clicks:
+        if any(p < 0 for p in point):
+            continue
+        signal[tuple(max(0, min(int(p), size - 1)) for p, size in zip(point, IMAGE_SIZE))] = 1.0
+    if torch.max(signal) > 0:
+        if sigma != 0:
+            signal = GaussianFilter(3, sigma=sigma)(signal[None, None])[0, 0]
+        signal = (signal - torch.min(signal)) / (torch.max(signal) - torch.min(signal))
+        if disks:
+            signal = (signal > 0.1) * 1.0
+    return signal
+
+
+def get_signal(transform: AddGuidanceSignal, data: dict, clicks) -> torch.Tensor:
+    data["spleen"] = clicks
+    data = transform(data)
+    return data["image"][1].clone()
+
+
+def main():
+    for sigma in [0, 1, 2, 3]:
+        for disks in [False, True]:
+            for name, clicks in CLICKS.items():
+                transform = AddGuidanceSignal(keys="image", sigma=sigma, disks=disks, device="cpu")
+                data = {"image": torch.zeros((2, *IMAGE_SIZE)), LABELS_KEY: {"spleen": 1}}
+                # Add the clicks one by one, like the click iterations do
+                for n in range(1, len(clicks) + 1):
+                    signal = get_signal(transform, data, clicks[:n])
+                    expected = get_baseline_signal(clicks[:n], sigma, disks)
+                    error = torch.max(torch.abs(signal - expected)).item()
+                    assert error < 1e-5, f"sigma {sigma} disks {disks} {name} ({n} clicks): max error {error}"
+                if disks:
+                    print(f"sigma {sigma} disks {name}: {int(signal.sum())} voxels, matches the baseline")
+    print("Guidance signal test passed")
+
+
+if __name__ == "__main__":
+    main()
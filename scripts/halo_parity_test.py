@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import numpy as np
+import torch
+from monai.networks.nets.dynunet import DynUNet
+
+from sw_fastedit.inferers import HaloTiledInferer
+
+"""
+Checks that the HaloTiledInferer reproduces a single full-volume pass of a batch norm DynUNet in eval mode, whose
+output only depends on the receptive field. Instance norm (as in get_network) normalizes every tile on its own, so it
+can not match, see HaloTiledInferer.exact. Also checks that a roi_size which is too small for the halo raises with
+strict and keeps the derived halo on a fallback.
+"""
+
+# image size (a multiple of the total stride for the full-volume pass), roi_size. With the overlap of 0.5 the tiles
+# compute less than the sliding window, so the inferer does not fall back to it
+OVERLAP = 0.5
+CASES = [
+    ((160, 152, 96), (96, 96, 80)),
+    ((200, 96, 100), (96, 96, 80)),
+    ((96, 96, 80), (96, 96, 80)),
+]
+
+
+def get_network() -> DynUNet:
+    # The smalldynunet of get_network with batch norm
+    return DynUNet(
+        spatial_dims=3,
+        in_channels=3,
+        out_channels=2,
+        kernel_size=[3, 3, 3],
+        strides=[1, 2, [2, 2, 1]],
+        upsample_kernel_size=[2, [2, 2, 1]],
+        filters=[8, 16, 32],
+        norm_name="batch",
+        deep_supervision=False,
+        res_block=True,
+    )
+
+
+def main():
+    torch.manual_seed(0)
+    network = get_network()
+    # Non-trivial running statistics, then freeze them
+    with torch.no_grad():
+        network.train()(torch.randn((2, 3, 64, 64, 32)))
+    network.eval()
+
+    for image_size, roi_size in CASES:
+        inferer = HaloTiledInferer(roi_size, sw_batch_size=4, overlap=OVERLAP, network=network, strict=True)
+        assert inferer.exact, f"{roi_size}: the halo {inferer.halo} does not cover the receptive field"
+        inputs = torch.randn((1, 3, *image_size))
+        with torch.no_grad():
+            expected = network(inputs)
+            output = inferer(inputs, network)
+        num_tiles = len(inferer.get_tiles(image_size, roi_size))
+        assert inferer.redundant_compute == num_tiles * np.prod(roi_size) / np.prod(image_size), "Not halo tiled"
+        max_diff = (output - expected).abs().max().item()
+        print(
+            f"{image_size} roi {roi_size}: halo {inferer.halo}, core {inferer.core_size}, "
+            f"{num_tiles} tiles, max diff {max_diff:.2e}"
+        )
+        assert max_diff < 1e-4, f"{image_size}: max diff {max_diff} to the full-volume pass"
+
+    small_roi_size = (32, 32, 32)
+    try:
+        HaloTiledInferer(small_roi_size, network=network, strict=True)
+    except UserWarning as e:
+        print(f"roi {small_roi_size}: {e}")
+    else:
+        raise AssertionError(f"The roi_size {small_roi_size} is too small for the halo, strict has to raise")
+    inferer = HaloTiledInferer(small_roi_size, network=network)
+    assert inferer.fallback and inferer.core_size is None
+    assert inferer.halo == HaloTiledInferer((96, 96, 80), network=network).halo, "The fallback changed the halo"
+    print("Halo parity test passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import tempfile
+
+import torch
+
+from sw_fastedit.api import get_network
+from sw_fastedit.inferers import ForegroundSlidingWindowInferer
+from sw_fastedit.utils.onnx_network import ONNX_NETWORKS, OnnxNetwork, check_onnx_parity, export_onnx
+
+"""
+Exports a randomly initialized network to ONNX and checks on the CPU that onnxruntime yields the same output as the
+eager network, for a single window and for the whole sliding window pass.
+"""
+
+logger = logging.getLogger("sw_fastedit")
+logging.basicConfig(level=logging.INFO)
+
+LABELS = {"tumor": 1, "background": 0}
+IMAGE_SHAPE = (1, 3, 160, 144, 128)
+ATOL = 1e-3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--network", default="smalldynunet", choices=ONNX_NETWORKS)
+    parser.add_argument("--roi_size", type=int, nargs=3, default=[64, 64, 64])
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    network = get_network(args.network, LABELS).eval()
+    inferer = ForegroundSlidingWindowInferer(args.roi_size, sw_batch_size=2, skip_background=False)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        export_onnx(network, f"{tmp_dir}/{args.network}.onnx", IMAGE_SHAPE[1], args.roi_size)
+        onnx_network = OnnxNetwork(f"{tmp_dir}/{args.network}.onnx")
+        assert check_onnx_parity(network, onnx_network, IMAGE_SHAPE[1], args.roi_size) < ATOL
+
+        inputs = torch.rand(IMAGE_SHAPE)
+        with torch.no_grad():
+            max_diff = torch.max(torch.abs(inferer(inputs, network) - inferer(inputs, onnx_network))).item()
+    logger.info(f"Sliding window: max abs difference between eager and onnxruntime: {max_diff:.2e}")
+    assert max_diff < ATOL, f"The onnxruntime sliding window differs by {max_diff} from the eager one"
+
+
+if __name__ == "__main__":
+    main()
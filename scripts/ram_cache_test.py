@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+import torch
+from monai.data.dataset import PersistentDataset
+from monai.transforms import Compose, EnsureChannelFirstd, LoadImaged, ScaleIntensityd
+
+from sw_fastedit.utils.ram_cache import RamCache, RamCachedPersistentDataset, RamCachedVolumeStoreDataset
+
+"""
+Checks the RAM tier of RamCachedPersistentDataset / RamCachedVolumeStoreDataset against a plain PersistentDataset:
+the second epoch has to be served from the RAM cache, return the same samples and must not see in-place changes of the
+samples of the first epoch. This also notices when a MONAI update stops calling the overridden _cachecheck().
+"""
+
+NUM_SAMPLES = 4
+
+
+def get_data(data_dir: str):
+    data = []
+    for i in range(NUM_SAMPLES):
+        path = os.path.join(data_dir, f"image_{i}.nii.gz")
+        nib.save(nib.Nifti1Image(np.random.rand(32, 32, 16).astype(np.float32), np.eye(4)), path)
+        data.append({"image": path})
+    return data
+
+
+def main():
+    data_dir = tempfile.mkdtemp()
+    data = get_data(data_dir)
+    # Deterministic only, so the samples of all datasets have to be identical
+    transforms = Compose([LoadImaged("image"), EnsureChannelFirstd("image"), ScaleIntensityd("image")])
+    expected = PersistentDataset(data, transforms, cache_dir=os.path.join(data_dir, "persistent"))
+    for dataset_cls in [RamCachedPersistentDataset, RamCachedVolumeStoreDataset]:
+        ram_cache = RamCache(max_bytes=2**30)
+        cache_dir = os.path.join(data_dir, dataset_cls.__name__)
+        dataset = dataset_cls(data, transforms, cache_dir=cache_dir, ram_cache=ram_cache)
+        for epoch in range(2):
+            for i in range(NUM_SAMPLES):
+                sample = dataset[i]
+                assert torch.equal(torch.as_tensor(sample["image"]), torch.as_tensor(expected[i]["image"])), i
+                sample["image"] += 1  # must not change the cached sample
+        print(f"{dataset_cls.__name__}: {ram_cache.hits} hits, {ram_cache.misses} misses")
+        assert ram_cache.misses == NUM_SAMPLES and ram_cache.hits == NUM_SAMPLES, "The RAM tier is not used"
+    print("RAM cache test passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import torch
+from monai.networks.nets.dynunet import DynUNet
+
+from sw_fastedit.inferers import get_dynunet_receptive_field
+
+"""
+Checks get_dynunet_receptive_field against real DynUNets: the gradient of single output voxels (at every position of
+the stride grid) with respect to the input shows which input voxels influence them. The norm layers are removed for
+the probe, since instance norm makes every output voxel depend on the whole input.
+"""
+
+CONFIGS = {
+    # kernel_size, strides, upsample_kernel_size
+    "smalldynunet": ([3, 3, 3], [1, 2, [2, 2, 1]], [2, [2, 2, 1]]),
+    "four_levels": ([3, 3, 3, 3], [1, 2, 2, [2, 2, 1]], [2, 2, [2, 2, 1]]),
+    "mixed_kernels": ([[3, 3, 1], 3, 3, 3], [1, 2, [2, 2, 1], 2], [2, [2, 2, 1], 2]),
+}
+
+
+def remove_norms(module: torch.nn.Module):
+    for name, child in module.named_children():
+        if "Norm" in type(child).__name__:
+            setattr(module, name, torch.nn.Identity())
+        else:
+            remove_norms(child)
+
+
+def get_empirical_radius(network: DynUNet, image_size) -> tuple:
+    radius = [0] * len(image_size)
+    total_stride = [1] * len(image_size)
+    for s in network.strides:
+        for d, s_d in enumerate(s if isinstance(s, (list, tuple)) else [s] * len(image_size)):
+            total_stride[d] *= s_d
+    for offset in range(max(total_stride)):
+        inputs = torch.randn((1, 1, *image_size), dtype=torch.float64, requires_grad=True)
+        center = [size // 2 + offset % t for size, t in zip(image_size, total_stride)]
+        network(inputs)[(0, 0, *center)].backward()
+        influence = (inputs.grad[0, 0] != 0).nonzero()
+        for d in range(len(image_size)):
+            radius[d] = max(radius[d], center[d] - influence[:, d].min().item(), influence[:, d].max().item() - center[d])
+    return tuple(radius)
+
+
+def main():
+    torch.manual_seed(0)
+    for name, (kernel_size, strides, upsample_kernel_size) in CONFIGS.items():
+        network = DynUNet(
+            spatial_dims=3,
+            in_channels=1,
+            out_channels=1,
+            kernel_size=kernel_size,
+            strides=strides,
+            upsample_kernel_size=upsample_kernel_size,
+            filters=[2] * len(strides),
+            norm_name="instance",
+            res_block=True,
+        ).double()
+        remove_norms(network)
+        expected = tuple(r // 2 for r in get_dynunet_receptive_field(network))
+        image_size = tuple(2 * r + 32 for r in expected)
+        measured = get_empirical_radius(network, image_size)
+        print(f"{name}: radius {expected}, measured {measured}")
+        assert measured == expected, f"{name}: get_dynunet_receptive_field radius {expected} != measured {measured}"
+    print("Receptive field test passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import torch
+from monai.inferers import SlidingWindowInferer
+from monai.networks.nets.dynunet import DynUNet
+
+from sw_fastedit import inferers
+from sw_fastedit.inferers import ForegroundSlidingWindowInferer
+
+"""
+Checks on the CPU that the default inferer of get_inferers() (ForegroundSlidingWindowInferer without skip_background)
+gives the output of MONAI's SlidingWindowInferer, also for images smaller than the roi_size with every padding_mode,
+and that the second call on the same padded size takes its WindowPlan from the cache.
+"""
+
+ROI_SIZE = (32, 32, 32)
+IMAGE_SHAPES = [(1, 3, 80, 72, 48), (2, 3, 20, 40, 32), (1, 3, 17, 25, 20)]
+ATOL = 1e-5
+
+
+def main():
+    torch.manual_seed(0)
+    network = DynUNet(3, 3, 2, kernel_size=[3, 3, 3], strides=[1, 2, 2], upsample_kernel_size=[2, 2], filters=[4, 8, 16])
+    network.eval()
+    for padding_mode, cval in [("constant", 0.0), ("constant", 0.5), ("replicate", 0.0), ("reflect", 0.0)]:
+        params = {"roi_size": ROI_SIZE, "sw_batch_size": 2, "overlap": 0.25, "mode": "gaussian"}
+        params.update({"padding_mode": padding_mode, "cval": cval})
+        inferer = ForegroundSlidingWindowInferer(skip_background=False, **params)
+        expected_inferer = SlidingWindowInferer(**params)
+        for shape in IMAGE_SHAPES:
+            inputs = torch.rand(shape)
+            with torch.no_grad():
+                output = inferer(inputs, network)
+                expected = expected_inferer(inputs, network)
+            error = torch.max(torch.abs(output - expected)).item()
+            assert output.shape == expected.shape, f"{padding_mode} {shape}: {output.shape} != {expected.shape}"
+            assert error < ATOL, f"{padding_mode} {shape}: max error {error}"
+            print(f"{padding_mode} (cval {cval}) {shape}: max error {error:.2e}")
+
+    # The small image has been planned with its padded size, so this is a cache hit
+    padded_size = tuple(max(s, r) for s, r in zip(IMAGE_SHAPES[-1][2:], ROI_SIZE))
+    assert any(key[0] == padded_size for key in inferers._window_plans), f"No plan for the padded size {padded_size}"
+    print("Window plan test passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import itertools
+
+import torch
+from monai.data import PatchIterd
+from monai.losses import DiceLoss
+from monai.transforms import AsDiscreted
+
+from sw_fastedit.click_definitions import LABELS_KEY
+from sw_fastedit.transforms import AddGuidance
+
+"""
+Checks AddGuidance.find_worst_patch (strided sum pooling) against per-patch dice losses:
+- on shapes which patch_size divides, against the original implementation (one-hot + PatchIterd + DiceLoss),
+- on other shapes (and with patch_overlap) against a brute force loop over the same grid, where the last patch of a
+  dimension is cut at the border. The original PatchIterd wrap-padded these patches with the voxels of the opposite
+  border instead, so there the chosen patch can differ from it, which is reported but not an error.
+"""
+
+LABEL_NAMES = {"background": 0, "spleen": 1, "liver": 2}
+CASES = [
+    # spatial size, patch size, patch overlap
+    ((64, 64, 32), (32, 32, 16), 0.0),
+    ((96, 64, 48), (32, 32, 16), 0.0),
+    ((70, 50, 37), (32, 32, 16), 0.0),
+    ((70, 50, 37), (32, 32, 16), 0.5),
+    ((20, 50, 37), (32, 32, 16), 0.25),
+]
+
+
+def get_random_masks(spatial_size):
+    """Random blobs as label and a prediction which differs from it in some regions."""
+    label = torch.zeros((1, *spatial_size), dtype=torch.int64)
+    for value in [1, 2]:
+        for _ in range(4):
+            start = [torch.randint(0, s - s // 4, ()).item() for s in spatial_size]
+            label[(0, *[slice(b, b + s // 4) for b, s in zip(start, spatial_size)])] = value
+    pred = label.clone()
+    for _ in range(6):
+        start = [torch.randint(0, s - s // 5, ()).item() for s in spatial_size]
+        pred[(0, *[slice(b, b + s // 5) for b, s in zip(start, spatial_size)])] = torch.randint(0, 3, ()).item()
+    return label, pred
+
+
+def find_worst_patch_original(label, pred, patch_size):
+    """The implementation before the sum pooling, returns the spatial start of the worst patch per label."""
+    t_data = AsDiscreted(keys=("pred", "label"), to_onehot=(len(LABEL_NAMES), len(LABEL_NAMES)))(
+        {"pred": pred, "label": label}
+    )
+    patches = [patch[0] for patch in PatchIterd(keys=["pred", "label"], patch_size=patch_size)(t_data)]
+    pred_stack = torch.stack([patch["pred"] for patch in patches])
+    label_stack = torch.stack([patch["label"] for patch in patches])
+    loss = DiceLoss(include_background=True, reduction="none")(pred_stack, label_stack).squeeze()
+    return [list(patches[i]["patch_coords"][1:, 0]) for i in torch.argmax(loss, dim=0)]
+
+
+def find_worst_patch_brute_force(label, pred, patch_size, patch_overlap):
+    """Loops over the grid of find_worst_patch and computes the dice loss of the cut patches one by one."""
+    spatial_size = label.shape[1:]
+    patch_size = [min(p, s) for p, s in zip(patch_size, spatial_size)]
+    stride = [max(int(p * (1 - patch_overlap)), 1) for p in patch_size]
+    starts = [range(0, max(s - p, 0) + st, st) for s, p, st in zip(spatial_size, patch_size, stride)]
+    # Same as the sum pooling with ceil_mode: the last patch has to start inside the image
+    starts = [[b for b in r if b < s] for r, s in zip(starts, spatial_size)]
+    worst = []
+    for value in LABEL_NAMES.values():
+        losses = {}
+        for start in itertools.product(*starts):
+            region = (0, *[slice(b, b + p) for b, p in zip(start, patch_size)])
+            label_mask, pred_mask = label[region] == value, pred[region] == value
+            tp = (label_mask & pred_mask).sum().item()
+            losses[start] = 1.0 - (2.0 * tp + 1e-5) / (pred_mask.sum().item() + label_mask.sum().item() + 1e-5)
+        worst_loss = max(losses.values())
+        worst.append([list(start) for start, loss in losses.items() if abs(loss - worst_loss) < 1e-6])
+    return worst
+
+
+def main():
+    torch.manual_seed(0)
+    for spatial_size, patch_size, patch_overlap in CASES:
+        label, pred = get_random_masks(spatial_size)
+        data = {"label": label[None], "pred": pred[None], LABELS_KEY: LABEL_NAMES}
+        transform = AddGuidance(keys="NA", patch_size=patch_size, patch_overlap=patch_overlap)
+        worst_patches = [coordinates[1:, 0].tolist() for coordinates in transform.find_worst_patch(data, 0)]
+
+        expected = find_worst_patch_brute_force(label, pred, patch_size, patch_overlap)
+        for start, candidates in zip(worst_patches, expected):
+            assert start in candidates, f"{spatial_size} {patch_size} {patch_overlap}: {start} not in {candidates}"
+        divisible = all(s % p == 0 for s, p in zip(spatial_size, patch_size))
+        if patch_overlap == 0:
+            original = find_worst_patch_original(label, pred, patch_size)
+            if divisible:
+                assert worst_patches == original, f"{spatial_size}: {worst_patches} != original {original}"
+            elif worst_patches != original:
+                print(f"{spatial_size}: border patches are cut, the wrap-padded original chose {original}")
+        print(f"{spatial_size} patch {patch_size} overlap {patch_overlap}: worst patches {worst_patches}")
+    print("Worst patch test passed")
+
+
+if __name__ == "__main__":
+    main()
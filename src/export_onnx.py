@@ -0,0 +1,61 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import logging
+import os
+
+import torch
+
+from sw_fastedit.api import get_network
+from sw_fastedit.utils.argparser import parse_args, setup_environment_and_adapt_args
+from sw_fastedit.utils.onnx_network import ONNX_NETWORKS, OnnxNetwork, check_onnx_parity, export_onnx
+
+logger = logging.getLogger("sw_fastedit")
+
+"""
+export_onnx.py
+
+Converts the --resume_from checkpoint of a dynunet / smalldynunet / bigdynunet to ONNX (written to --onnx_path,
+default <output_dir>/<network>.onnx) and checks the onnxruntime output against the eager one.
+The model can then be used with test.py --inference_backend onnxruntime --onnx_path <file>.
+"""
+
+
+def run(args):
+    if args.network not in ONNX_NETWORKS:
+        raise UserWarning(f"The ONNX export supports {ONNX_NETWORKS}, not {args.network}")
+    if args.resume_from == "None":
+        raise UserWarning("Set --resume_from to the checkpoint which shall be exported")
+    if args.onnx_path == "None":
+        args.onnx_path = os.path.join(args.output_dir, f"{args.network}.onnx")
+
+    network = get_network(args.network, args.labels, args.non_interactive)
+    checkpoint = torch.load(args.resume_from, map_location="cpu")
+    network.load_state_dict(checkpoint["net"])
+    in_channels = 1 if args.non_interactive else 1 + len(args.labels)
+
+    export_onnx(network, args.onnx_path, in_channels, args.sw_roi_size)
+    check_onnx_parity(network, OnnxNetwork(args.onnx_path, num_threads=args.onnx_threads), in_channels, args.sw_roi_size)
+
+
+def main():
+    global logger
+
+    args = parse_args()
+    args, logger = setup_environment_and_adapt_args(args)
+
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+
+from sw_fastedit.api import get_network
+from sw_fastedit.utils.argparser import parse_args, setup_environment_and_adapt_args
+from sw_fastedit.utils.planner import get_cpu_seconds_per_flop, load_shape_manifest, plan_configuration
+
+logger = logging.getLogger("sw_fastedit")
+
+"""
+plan.py
+
+Compares deployment configurations without trial runs: for every combination of --plan_networks, --plan_roi_sizes and
+--plan_sw_batch_sizes it reports the FLOPs per window, the peak memory of the sliding window batch, the windows per case
+of the --plan_manifest volumes and the estimated CPU seconds per click and per case (--max_val_interactions clicks plus
+the final prediction), calibrated by a short CPU micro-benchmark of every network.
+The overlap and the crop are taken from --val_sw_overlap and --val_crop_size, activations are counted in fp16 with --amp.
+The results are also written to <output_dir>/plan.json.
+"""
+
+
+def run(args):
+    if args.plan_manifest == "None":
+        raise UserWarning("Set --plan_manifest to a JSON file with the shapes of the volumes")
+    shapes = load_shape_manifest(args.plan_manifest)
+    networks = args.plan_networks or [args.network]
+    sw_batch_sizes = args.plan_sw_batch_sizes or [args.val_sw_batch_size]
+    in_channels = 1 if args.non_interactive else 1 + len(args.labels)
+    bytes_per_element = 2 if args.amp else 4
+    logger.info(f"Planning for {len(shapes)} volumes of {args.plan_manifest}")
+
+    results = []
+    for network_str in networks:
+        network = get_network(network_str, args.labels, args.non_interactive)
+        seconds_per_flop = get_cpu_seconds_per_flop(network, in_channels)
+        for roi_size in args.plan_roi_sizes:
+            for sw_batch_size in sw_batch_sizes:
+                result = plan_configuration(
+                    network,
+                    in_channels,
+                    roi_size,
+                    sw_batch_size,
+                    shapes,
+                    overlap=args.val_sw_overlap,
+                    seconds_per_flop=seconds_per_flop,
+                    clicks_per_case=args.max_val_interactions,
+                    crop_size=args.val_crop_size,
+                    bytes_per_element=bytes_per_element,
+                )
+                result = {"network": network_str, "roi_size": list(roi_size), "sw_batch_size": sw_batch_size, **result}
+                results.append(result)
+                logger.info(
+                    f"{network_str} roi {tuple(roi_size)} sw_batch_size {sw_batch_size}: "
+                    f"{result['gflops_per_window']:.1f} GFLOP/window, peak memory {result['peak_memory_gb']:.2f} GB, "
+                    f"{result['windows_per_case']:.1f} windows/case (max {result['max_windows_per_case']}), "
+                    f"{result['seconds_per_click']:.1f} s/click, {result['seconds_per_case']:.1f} s/case"
+                )
+
+    with open(os.path.join(args.output_dir, "plan.json"), "w") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+def main():
+    global logger
+
+    args = parse_args()
+    args, logger = setup_environment_and_adapt_args(args)
+
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
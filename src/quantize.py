@@ -0,0 +1,92 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import logging
+import os
+
+import torch
+
+from sw_fastedit.api import get_inferers, get_network
+from sw_fastedit.data import get_pre_transforms, get_val_loader
+from sw_fastedit.utils.argparser import parse_args, setup_environment_and_adapt_args
+from sw_fastedit.utils.quantization import (
+    get_calibration_windows,
+    get_dice_delta,
+    quantize_network,
+    save_quantized_network,
+)
+
+logger = logging.getLogger("sw_fastedit")
+
+"""
+quantize.py
+
+INT8 post training quantization of the --resume_from checkpoint for CPU-only annotation nodes.
+Calibrates on --calibration_windows windows of the (cached) validation data, writes the INT8 weights to
+--quantized_path (default <output_dir>/<network>_int8.pt) and reports the Dice delta to fp32 on the validation loader.
+The model can then be used with test.py --inference_backend int8 --quantized_path <file>
+or as `quantized_path` of the MONAI Label SWFastEdit task.
+"""
+
+
+def run(args):
+    if args.resume_from == "None":
+        raise UserWarning("Set --resume_from to the checkpoint which shall be quantized")
+    if args.quantized_path == "None":
+        args.quantized_path = os.path.join(args.output_dir, f"{args.network}_int8.pt")
+    cpu_device = torch.device("cpu")
+
+    network = get_network(args.network, args.labels, args.non_interactive)
+    checkpoint = torch.load(args.resume_from, map_location="cpu")
+    network.load_state_dict(checkpoint["net"])
+    network.eval()
+
+    _, pre_transforms_val = get_pre_transforms(args.labels, cpu_device, args)
+    val_loader = get_val_loader(args, pre_transforms_val)
+
+    calibration_windows = get_calibration_windows(val_loader, args.sw_roi_size, args.calibration_windows)
+    quantized_network = quantize_network(network, calibration_windows)
+    save_quantized_network(quantized_network, args.quantized_path)
+
+    _, eval_inferer = get_inferers(
+        args.inferer,
+        sw_roi_size=args.sw_roi_size,
+        train_crop_size=args.train_crop_size,
+        val_crop_size=args.val_crop_size,
+        train_sw_batch_size=args.train_sw_batch_size,
+        val_sw_batch_size=args.val_sw_batch_size,
+        train_sw_overlap=args.train_sw_overlap,
+        val_sw_overlap=args.val_sw_overlap,
+        network=network,
+    )
+    get_dice_delta(
+        network,
+        quantized_network,
+        eval_inferer,
+        val_loader,
+        num_classes=len(args.labels),
+        max_samples=args.quantization_val_samples,
+    )
+
+
+def main():
+    global logger
+
+    args = parse_args()
+    args, logger = setup_environment_and_adapt_args(args)
+
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,13 +19,13 @@ from __future__ import annotations
 import logging
 import os
 import random
+import time
 from collections import OrderedDict
-from functools import reduce
+from functools import partial, reduce
 from pickle import dump
-from typing import Iterable, List
+from typing import Iterable, List, Sequence
 import sys
 
-import cupy as cp
 import numpy as np
 import torch
 from ignite.engine import Events
@@ -43,13 +43,14 @@ from monai.handlers import (
     ValidationHandler,
     from_engine,
 )
-from monai.inferers import SimpleInferer, SlidingWindowInferer
+from monai.inferers import SimpleInferer
 from monai.losses import DiceCELoss, DiceLoss
 from monai.metrics import SurfaceDiceMetric
 from monai.networks.nets.dynunet import DynUNet
 from monai.optimizers.novograd import Novograd
 from monai.transforms import Compose
 from monai.utils import set_determinism
+from torch.fx.experimental.optimization import fuse
 
 from sw_fastedit.data import (
     get_click_transforms,
@@ -60,8 +61,23 @@ from sw_fastedit.data import (
     get_val_loader,
     get_test_loader,
 )
+from sw_fastedit.inferers import (
+    CascadeSlidingWindowInferer,
+    ForegroundSlidingWindowInferer,
+    HaloTiledInferer,
+    IncrementalSlidingWindowInferer,
+    LowPrecisionSlidingWindowInferer,
+    MemmapSlidingWindowInferer,
+    get_auto_sw_batch_size,
+    get_memory_per_window,
+    set_window_plan_cache_size,
+)
 from sw_fastedit.interaction import Interaction
+from sw_fastedit.utils.checkpointing import enable_activation_checkpointing
+from sw_fastedit.utils.distance_transform import set_click_sampler_seed, set_distance_transform_backend
 from sw_fastedit.utils.helper import count_parameters, is_docker, run_once, handle_exception
+from sw_fastedit.utils.onnx_network import OnnxNetwork
+from sw_fastedit.utils.quantization import QuantizedNetwork
 
 logger = logging.getLogger("sw_fastedit")
 output_dir = None
@@ -87,11 +103,13 @@ def get_loss_function(loss_args, loss_kwargs=None):  # squared_pred=True, includ
     return loss_function
 
 
-def get_network(network_str: str, labels: Iterable, non_interactive: bool = False):
+def get_network(network_str: str, labels: Iterable, non_interactive: bool = False, checkpoint_activations: str = "none"):
     """
     in_channels: 1 slice for the image, the other ones for the signal per label whereas each signal is the size of image.
         The signal is only added for interactive runs of this code.
     out_channels: amount of labels
+    checkpoint_activations: which blocks recompute their activations in the backward pass instead of storing them
+        ("none", "encoder", "decoder", "all"), see enable_activation_checkpointing
     """
     in_channels = 1 if non_interactive else 1 + len(labels)
     out_channels = len(labels)
@@ -153,10 +171,67 @@ def get_network(network_str: str, labels: Iterable, non_interactive: bool = Fals
 
     logger.info(f"Selected network {network.__class__.__qualname__}")
     logger.info(f"Number of parameters: {count_parameters(network):,}")
+    enable_activation_checkpointing(network, checkpoint_activations)
 
     return network
 
 
+def get_inference_network(
+    args, network: torch.nn.Module, device, *, inferers: Sequence = (), fold: bool = True
+) -> torch.nn.Module | None:
+    """
+    Inference-only variant of `network` for the no-grad passes (click iterations, test.py, test_ensemble.py) according
+    to args.inference_network ("compile": torch.compile, "torchscript": torch.jit.trace, "none": returns None).
+    It is warmed up with the window batch sizes of `inferers` (the inferers which will run it), so the first case does
+    not pay for the compilation. The torch.compile artifacts are stored in args.compile_cache_dir and reused by the next
+    run. `network` itself keeps its weights, memory format and train / eval mode.
+
+    fold: eval-mode folding (conv + batch norm fusion, freezing of the TorchScript module) on a copy of `network` with
+        channels_last_3d weights on CUDA, so only use it for fixed weights. Without it the variant shares the parameters
+        with `network` and always sees the current weights of the training.
+    """
+    if args.inference_network == "none":
+        return None
+    device = torch.device(device)
+    in_channels = 1 if args.non_interactive else 1 + len(args.labels)
+    sw_batch_sizes = sorted({getattr(inferer, "sw_batch_size", 1) for inferer in inferers} | {1}, reverse=True)
+    example_input = torch.zeros((sw_batch_sizes[0], in_channels, *args.sw_roi_size), device=device)
+    autocast = torch.autocast(device_type=device.type, enabled=args.amp and device.type == "cuda")
+
+    training = network.training
+    if fold:
+        # fuse() works on a copy, which can also be converted to channels_last_3d
+        fused_network = fuse(network.eval()).to(device)
+        network.train(training)
+        network = fused_network
+        if device.type == "cuda":
+            network = network.to(memory_format=torch.channels_last_3d)
+    if args.inference_network == "compile":
+        if args.compile_cache_dir is not None:
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = args.compile_cache_dir
+            os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+        inference_network = torch.compile(network)
+    else:
+        # Traced under autocast, so the graph contains the mixed precision casts
+        with torch.no_grad(), autocast:
+            inference_network = torch.jit.trace(network.eval(), example_input)
+        if fold:
+            inference_network = torch.jit.optimize_for_inference(inference_network)
+
+    start = time.time()
+    with torch.no_grad(), autocast:
+        for batch_size in sw_batch_sizes:
+            inference_network.eval()(example_input[:batch_size])
+    logger.info(
+        f"Warm-up of the {args.inference_network} inference network with sw_batch_size {sw_batch_sizes} took "
+        f"{time.time() - start:.1f} seconds"
+    )
+    if not fold:
+        # The eval() calls above also switched the shared network
+        network.train(training)
+    return inference_network
+
+
 def get_inferers(
     inferer: str,
     *,
@@ -170,11 +245,24 @@ def get_inferers(
     cache_roi_weight_map: bool = True,
     device="cpu",
     sw_cpu_output=False,
+    skip_background=False,
+    network=None,
+    auto_sw_batch_size=False,
+    amp=False,
+    sw_stitching="memory",
+    sw_stitching_dir=None,
+    cascade_downsample_factor=2,
+    cascade_full_final_pass=True,
 ):
     if inferer == "SimpleInferer":
         train_inferer = SimpleInferer()
         eval_inferer = SimpleInferer()
-    elif inferer == "SlidingWindowInferer":
+    elif inferer in [
+        "SlidingWindowInferer",
+        "IncrementalSlidingWindowInferer",
+        "CascadeSlidingWindowInferer",
+        "HaloTiledInferer",
+    ]:
         # train_batch_size is limited due to this bug: https://github.com/Project-MONAI/MONAI/issues/6628
         assert train_crop_size is not None
         train_batch_size = max(
@@ -204,6 +292,25 @@ def get_inferers(
         )
         logger.info(f"{val_batch_size=}")
 
+        val_sw_batch_size_fn = None
+        if auto_sw_batch_size:
+            # Replace the estimates above by probing the peak memory of the network per window
+            assert network is not None, "The sw_batch_size auto-tuning needs the network"
+            output_device = "cpu" if sw_cpu_output else None
+            train_batch_size = get_auto_sw_batch_size(
+                network, sw_roi_size, train_crop_size, train_sw_overlap, output_device=output_device, amp=amp, with_grad=True
+            )
+            # The validation volumes differ in shape, so the eval inferer tunes on the first call per volume shape
+            val_sw_batch_size_fn = partial(
+                get_auto_sw_batch_size,
+                network,
+                sw_roi_size,
+                overlap=val_sw_overlap,
+                output_device=output_device,
+                amp=amp,
+                memory_per_window=get_memory_per_window(network, sw_roi_size, amp=amp),
+            )
+
         sw_params = {
             "roi_size": sw_roi_size,
             "mode": "gaussian",
@@ -216,8 +323,52 @@ def get_inferers(
                 "Note that this only works well for validation! For training AMP has to be turned off and it has no real effect"
             )
             sw_params.update({"sw_device": device, "device": "cpu"})
-        train_inferer = SlidingWindowInferer(sw_batch_size=train_batch_size, overlap=train_sw_overlap, **sw_params)
-        eval_inferer = SlidingWindowInferer(sw_batch_size=val_batch_size, overlap=val_sw_overlap, **sw_params)
+        # The incremental inferer only reruns the windows which changed since the last click iteration.
+        # Without skip_background the ForegroundSlidingWindowInferer is a SlidingWindowInferer which reuses the cached
+        # window plans (slices, importance and count map) of get_window_plan(), shared by train, eval and MONAI Label
+        sw_inferer = (
+            IncrementalSlidingWindowInferer
+            if inferer == "IncrementalSlidingWindowInferer"
+            else ForegroundSlidingWindowInferer
+        )
+        sw_params["skip_background"] = False
+        if inferer == "CascadeSlidingWindowInferer":
+            # Full resolution windows only around the candidates of a downsampled pass, the clicks and the last prediction
+            sw_inferer = CascadeSlidingWindowInferer
+            sw_params.update(
+                {"downsample_factor": cascade_downsample_factor, "full_final_pass": cascade_full_final_pass}
+            )
+        if inferer == "HaloTiledInferer":
+            # Non-overlapping tiles with the receptive field of the network as halo instead of the overlap blending
+            assert network is not None, "The HaloTiledInferer derives the halo from the network"
+            if sw_stitching != "memory" or skip_background:
+                raise UserWarning("The HaloTiledInferer only supports --sw_stitching memory without --sw_skip_background")
+            sw_inferer = HaloTiledInferer
+            sw_params.pop("skip_background")
+            # It was selected explicitly, so a roi_size which is too small for the halo is an error instead of a fallback
+            sw_params.update({"network": network, "strict": True})
+        elif sw_stitching == "memmap":
+            # Stitch into a disk-backed memmap and return the label map instead of the logits
+            if sw_inferer in [IncrementalSlidingWindowInferer, CascadeSlidingWindowInferer]:
+                raise UserWarning(f"The {inferer} keeps all logits in memory, use --sw_stitching memory")
+            logger.info("Stitching the sliding windows into a memmap")
+            sw_inferer = MemmapSlidingWindowInferer
+            sw_params.update({"skip_background": skip_background, "stitching_dir": sw_stitching_dir})
+        elif sw_stitching in ["fp16", "bf16", "margin"]:
+            # Only stitch what the argmax needs, in low precision, and return the label map instead of the logits
+            if sw_inferer in [IncrementalSlidingWindowInferer, CascadeSlidingWindowInferer]:
+                raise UserWarning(f"The {inferer} keeps all logits in memory, use --sw_stitching memory")
+            logger.info(f"Stitching the sliding windows in {sw_stitching}")
+            sw_inferer = LowPrecisionSlidingWindowInferer
+            sw_params.update({"skip_background": skip_background, "stitching": sw_stitching})
+        elif skip_background:
+            # Skip the windows without foreground and clicks during the click simulation and evaluation
+            logger.info("Skipping sliding windows without foreground")
+            sw_params["skip_background"] = True
+        train_inferer = sw_inferer(sw_batch_size=train_batch_size, overlap=train_sw_overlap, **sw_params)
+        eval_inferer = sw_inferer(
+            sw_batch_size=val_batch_size, overlap=val_sw_overlap, sw_batch_size_fn=val_sw_batch_size_fn, **sw_params
+        )
     return train_inferer, eval_inferer
 
 
@@ -362,6 +513,9 @@ def get_test_evaluator(
     resume_from="None",
 ) -> SupervisedEvaluator:
     init(args)
+    if isinstance(inferer, CascadeSlidingWindowInferer):
+        # Only the Interaction click loop tells the cascade which prediction is the final one
+        raise UserWarning("The CascadeSlidingWindowInferer needs the click loop, use --inferer SlidingWindowInferer")
 
     evaluator = SupervisedEvaluator(
         device=device,
@@ -382,7 +536,8 @@ def get_test_evaluator(
         "net": network,
     }
 
-    if resume_from != "None":
+    if resume_from != "None" and not isinstance(network, (OnnxNetwork, QuantizedNetwork)):
+        # The onnxruntime / int8 backends already contain the weights of the exported checkpoint
         logger.info(f"{args.gpu}:: Loading Network...")
         logger.info(f"{save_dict.keys()=}")
         logger.info(f"CWD: {os.getcwd()}")
@@ -393,6 +548,11 @@ def get_test_evaluator(
         handler = CheckpointLoader(load_path=resume_from, load_dict=save_dict, map_location=map_location)
         handler(evaluator)
 
+    if not isinstance(network, (OnnxNetwork, QuantizedNetwork)):
+        inference_network = get_inference_network(args, network, device, inferers=(inferer,))
+        if inference_network is not None:
+            evaluator.network = inference_network
+
     return evaluator
 
 
@@ -410,7 +570,13 @@ def create_supervised_evaluator(args, resume_from="None") -> SupervisedEvaluator
 
 
     click_transforms = get_click_transforms(device, args)
-    post_transform = get_post_transforms(args.labels, save_pred=args.save_pred, output_dir=args.output_dir, pretransform=pre_transforms_val)
+    post_transform = get_post_transforms(
+        args.labels,
+        save_pred=args.save_pred,
+        output_dir=args.output_dir,
+        pretransform=pre_transforms_val,
+        discrete_pred=(args.sw_stitching != "memory"),
+    )
 
     network = get_network(args.network, args.labels, args.non_interactive).to(device)
     _, eval_inferer = get_inferers(
@@ -422,6 +588,14 @@ def create_supervised_evaluator(args, resume_from="None") -> SupervisedEvaluator
         val_sw_batch_size=args.val_sw_batch_size,
         val_sw_overlap=args.val_sw_overlap,
         cache_roi_weight_map=True,
+        skip_background=args.sw_skip_background,
+        network=network,
+        auto_sw_batch_size=args.auto_sw_batch_size,
+        amp=args.amp,
+        sw_stitching=args.sw_stitching,
+        sw_stitching_dir=args.sw_stitching_dir,
+        cascade_downsample_factor=args.cascade_downsample_factor,
+        cascade_full_final_pass=not args.no_cascade_full_final_pass,
     )
 
     loss_kwargs = {
@@ -454,6 +628,7 @@ def create_supervised_evaluator(args, resume_from="None") -> SupervisedEvaluator
             click_generation_strategy=args.val_click_generation,
             stopping_criterion=args.val_click_generation_stopping_criterion,
             non_interactive=args.non_interactive,
+            inference_network=get_inference_network(args, network, device, inferers=(eval_inferer,), fold=False),
         ),
         inferer=eval_inferer,
         postprocessing=post_transform,
@@ -496,6 +671,7 @@ def get_supervised_evaluator(
     post_transform,
     key_val_metric,
     additional_metrics,
+    inference_network=None,
 ) -> SupervisedEvaluator:
     init(args)
 
@@ -516,6 +692,7 @@ def get_supervised_evaluator(
             click_generation_strategy=args.val_click_generation,
             stopping_criterion=args.val_click_generation_stopping_criterion,
             non_interactive=args.non_interactive,
+            inference_network=inference_network,
         )
         if not args.non_interactive
         else None,
@@ -567,6 +744,9 @@ def get_ensemble_evaluator(
     args, networks, inferer, device, val_loader, post_transform, resume_from="None", nfolds=5
 ) -> EnsembleEvaluator:
     init(args)
+    if isinstance(inferer, CascadeSlidingWindowInferer):
+        # Only the Interaction click loop tells the cascade which prediction is the final one
+        raise UserWarning("The CascadeSlidingWindowInferer needs the click loop, use --inferer SlidingWindowInferer")
 
     device = torch.device(f"cuda:{args.gpu}")
     prediction_keys = [f"pred_{i}" for i in range(nfolds)]
@@ -592,6 +772,11 @@ def get_ensemble_evaluator(
             logger.info(f"{file_path=}")
             checkpoint = torch.load(file_path)
             networks[i].load_state_dict(checkpoint["net"])
+
+    if args.inference_network != "none":
+        evaluator.networks = tuple(
+            get_inference_network(args, network, device, inferers=(inferer,)) for network in networks
+        )
     return evaluator
 
 
@@ -611,9 +796,13 @@ def get_trainer(
 
 
     click_transforms = get_click_transforms(sw_device, args)
-    post_transform = get_post_transforms(args.labels, save_pred=args.save_pred, output_dir=args.output_dir)
+    post_transform = get_post_transforms(
+        args.labels, save_pred=args.save_pred, output_dir=args.output_dir, discrete_pred=(args.sw_stitching != "memory")
+    )
 
-    network = get_network(args.network, args.labels, args.non_interactive).to(sw_device)
+    network = get_network(
+        args.network, args.labels, args.non_interactive, checkpoint_activations=args.checkpoint_activations
+    ).to(sw_device)
     train_inferer, eval_inferer = get_inferers(
         args.inferer,
         sw_roi_size=args.sw_roi_size,
@@ -623,6 +812,14 @@ def get_trainer(
         val_sw_batch_size=args.val_sw_batch_size,
         train_sw_overlap=args.train_sw_overlap,
         val_sw_overlap=args.val_sw_overlap,
+        skip_background=args.sw_skip_background,
+        network=network,
+        auto_sw_batch_size=args.auto_sw_batch_size,
+        amp=args.amp,
+        sw_stitching=args.sw_stitching,
+        sw_stitching_dir=args.sw_stitching_dir,
+        cascade_downsample_factor=args.cascade_downsample_factor,
+        cascade_full_final_pass=not args.no_cascade_full_final_pass,
     )
 
     loss_kwargs = {
@@ -640,6 +837,11 @@ def get_trainer(
             args.labels, include_background=False, loss_kwargs=loss_kwargs, str_to_prepend="val_"
         )
 
+    # Shares the parameters with the network, so the click passes always use the current weights
+    inference_network = get_inference_network(
+        args, network, sw_device, inferers=(train_inferer, eval_inferer), fold=False
+    )
+
     evaluator = get_supervised_evaluator(
         args,
         network=network,
@@ -651,6 +853,7 @@ def get_trainer(
         post_transform=post_transform,
         key_val_metric=val_key_metric,
         additional_metrics=val_additional_metrics,
+        inference_network=inference_network,
     )
 
     pre_transforms_train = Compose(get_pre_transforms_train_as_list(args.labels, device, args))
@@ -693,6 +896,7 @@ def get_trainer(
             iteration_probability=args.train_iteration_probability,
             loss_stopping_threshold=args.train_loss_stopping_threshold,
             non_interactive=args.non_interactive,
+            inference_network=inference_network,
         )
         if not args.non_interactive
         else None,
@@ -824,6 +1028,9 @@ def init(args):
         #        if not os.path.exists(tmpdir):
         #            pathlib.Path(tmpdir).mkdir(parents=True)
 
+    set_distance_transform_backend(args.distance_transform_backend)
+    set_window_plan_cache_size(args.sw_plan_cache_size)
+
     torch.backends.cuda.matmul.allow_tf32 = True
     torch.backends.cudnn.allow_tf32 = True
     torch.backends.cudnn.deterministic = True
@@ -837,9 +1044,7 @@ def init(args):
 
     set_determinism(seed=args.seed)
 
-    if not is_docker():
-        with cp.cuda.Device(args.gpu):
-            cp.random.seed(seed=args.seed)
+    set_click_sampler_seed(args.seed)
 
     if args.debug:
         torch.autograd.set_detect_anomaly(True)
@@ -3,6 +3,8 @@ from __future__ import annotations
 from enum import IntEnum
 
 LABELS_KEY = "label_names"
+# Number of clicks per label which have already been stamped into the guidance signal
+NUM_STAMPED_CLICKS_KEY = "num_stamped_clicks"
 
 
 class ClickGenerationStrategy(IntEnum):
@@ -47,10 +47,13 @@ from monai.transforms import (  # RandShiftIntensityd,; Resized,; ScaleIntensity
     VoteEnsembled,
 )
 from monai.utils.enums import CommonKeys
+from torch.utils.data import IterableDataset, get_worker_info
 
 from sw_fastedit.helper_transforms import (  # SignalFillEmptyd,
     # AbortifNaNd,
+    ArgmaxIfLogitsd,
     CheckTheAmountOfInformationLossByCropd,
+    CompactFgBgToIndicesd,
     InitLoggerd,
     PrintDatad,
     TrackTimed,
@@ -65,7 +68,10 @@ from sw_fastedit.transforms import (
     NormalizeLabelsInDatasetd,
     SplitPredsLabeld,
 )
+from sw_fastedit.utils.cache_fingerprint import file_fingerprint_hashing, transform_fingerprint_hashing
 from sw_fastedit.utils.helper import convert_mha_to_nii, convert_nii_to_mha
+from sw_fastedit.utils.ram_cache import RamCache, RamCachedPersistentDataset, RamCachedVolumeStoreDataset
+from sw_fastedit.utils.volume_store import VolumeStoreDataset
 
 logger = logging.getLogger("sw_fastedit")
 
@@ -139,6 +145,10 @@ def get_pre_transforms_train_as_list(labels: Dict, device, args, input_keys=("im
             else ScaleIntensityRangePercentilesd(
                 keys="image", lower=0.05, upper=99.95, b_min=0.0, b_max=1.0, clip=True, relative=False
             ),
+            # Cached with the deterministic transforms, so the crop does not have to scan the whole label
+            CompactFgBgToIndicesd(keys="label", max_indices=args.max_crop_center_indices)
+            if args.train_crop_size is not None
+            else Identityd(keys=input_keys, allow_missing_keys=True),
             # Random Transforms
             # allow_smaller=True not necessary for the default AUTOPET split of (224,)**3, just there for safety so that training does not get interrupted
             RandCropByPosNegLabeld(
@@ -147,6 +157,9 @@ def get_pre_transforms_train_as_list(labels: Dict, device, args, input_keys=("im
                 spatial_size=args.train_crop_size,
                 pos=args.positive_crop_rate,
                 neg=1 - args.positive_crop_rate,
+                num_samples=args.crops_per_volume,
+                fg_indices_key="label_fg_indices",
+                bg_indices_key="label_bg_indices",
                 allow_smaller=True,
             )
             if args.train_crop_size is not None
@@ -252,15 +265,25 @@ def get_click_transforms(device, args):
 
     logger.info(f"{device=}")
 
+    # The click transforms run on the whole batch BCHWD, so reduce over dim 1.
+    # No softmax needed since it does not change the argmax
     t = [
-        Activationsd(keys="pred", softmax=True),
-        AsDiscreted(keys="pred", argmax=True),
-        FindDiscrepancyRegions(keys="label", pred_key="pred", discrepancy_key="discrepancy", device=device),
+        ArgmaxIfLogitsd(keys="pred", dim=1),
+        FindDiscrepancyRegions(
+            keys="label",
+            pred_key="pred",
+            discrepancy_key="discrepancy",
+            device=device,
+            bounding_box_key="discrepancy_bounding_box",
+        ),
         AddGuidance(
             keys="NA",
             discrepancy_key="discrepancy",
             probability_key="probability",
             device=device,
+            patch_size=args.click_patch_size,
+            patch_overlap=args.click_patch_overlap,
+            bounding_box_key="discrepancy_bounding_box",
         ),
         # Overwrites the image entry
         AddGuidanceSignal(
@@ -282,7 +305,8 @@ def get_click_transforms(device, args):
     return Compose(t)
 
 
-def get_post_transforms(labels, *, save_pred=False, output_dir=None, pretransform=None):
+def get_post_transforms(labels, *, save_pred=False, output_dir=None, pretransform=None, discrete_pred=False):
+    """discrete_pred: set it if the inferer returns a label map instead of logits, e.g. the MemmapSlidingWindowInferer"""
     cpu_device = torch.device("cpu")
     if save_pred:
         if output_dir is None:
@@ -298,21 +322,15 @@ def get_post_transforms(labels, *, save_pred=False, output_dir=None, pretransfor
         Invertd(
             keys=("pred_for_save",),
             orig_keys="image",
-            nearest_interp=False,
+            nearest_interp=discrete_pred,
             transform=pretransform,
         )
         if (save_pred and pretransform is not None)
         else Identityd(keys=input_keys, allow_missing_keys=True),
-        Activationsd(keys=("pred",), softmax=True),
-        AsDiscreted(
-            keys="pred_for_save",
-            argmax=True,
-        )
-        if save_pred
-        else Identityd(keys=input_keys, allow_missing_keys=True),
+        # No softmax needed since it does not change the argmax
+        ArgmaxIfLogitsd(keys=("pred", "pred_for_save"), allow_missing_keys=True),
         AsDiscreted(
             keys=("pred", "label"),
-            argmax=(True, False),
             to_onehot=(len(labels), len(labels)),
         ),
         SaveImaged(
@@ -334,7 +352,7 @@ def get_post_transforms(labels, *, save_pred=False, output_dir=None, pretransfor
     return Compose(t)
 
 
-def get_post_transforms_unsupervised(labels, device, pred_dir, pretransform):
+def get_post_transforms_unsupervised(labels, device, pred_dir, pretransform, discrete_pred=False):
     os.makedirs(pred_dir, exist_ok=True)
     nii_layout = FolderLayout(output_dir=pred_dir, postfix="", extension=".nii.gz", makedirs=False)
 
@@ -342,14 +360,11 @@ def get_post_transforms_unsupervised(labels, device, pred_dir, pretransform):
         Invertd(
             keys="pred",
             orig_keys="image",
-            nearest_interp=False,
+            nearest_interp=discrete_pred,
             transform=pretransform,
         ),
-        Activationsd(keys="pred", softmax=True),
-        AsDiscreted(
-            keys="pred",
-            argmax=True,  # to_onehot=(len(labels),),
-        ),
+        # No softmax needed since it does not change the argmax
+        ArgmaxIfLogitsd(keys="pred"),
         # This transform is to check dice score per segment/label, disabled not needed right now
         # SplitPredsLabeld(keys="pred"),
         SaveImaged(
@@ -579,6 +594,42 @@ def get_data(args):
     return train_data, val_data, test_data
 
 
+def get_cache_dataset(args, data, pre_transforms):
+    """
+    PersistentDataset in cache_dir or, with --volume_store, the memory-mapped VolumeStoreDataset. The cache keys contain
+    a fingerprint of the deterministic preprocessing and of the input files, so the cache_dir can be shared between runs.
+    """
+    cache_kwargs = {
+        "cache_dir": args.cache_dir,
+        "hash_func": file_fingerprint_hashing,
+        "hash_transform": transform_fingerprint_hashing,
+    }
+    dataset = get_cache_dataset_cls(args)(data, pre_transforms, **cache_kwargs)
+    if args.volume_store and args.volume_store_workers > 0:
+        dataset.build(args.volume_store_workers)
+    return add_ram_cache(args, dataset)
+
+
+def get_cache_dataset_cls(args):
+    """The dataset class of get_cache_dataset(), with the RAM tier of add_ram_cache() if --ram_cache_gb is set."""
+    if args.volume_store:
+        return RamCachedVolumeStoreDataset if args.ram_cache_gb > 0 else VolumeStoreDataset
+    return RamCachedPersistentDataset if args.ram_cache_gb > 0 else PersistentDataset
+
+
+def add_ram_cache(args, dataset):
+    """
+    With --ram_cache_gb puts the in-RAM LRU tier in front of the disk cache of the dataset (of get_cache_dataset_cls()).
+    Every DataLoader worker process has its own tier, so the budget is split between them (and the workers are kept
+    alive between the epochs).
+    """
+    if args.ram_cache_gb <= 0:
+        return dataset
+    max_bytes = int(args.ram_cache_gb * 1024**3 / max(args.num_workers, 1))
+    dataset.ram_cache = RamCache(max_bytes, log_interval=len(dataset))
+    return dataset
+
+
 def get_test_loader(args, pre_transforms_test):
     train_data, val_data, test_data = get_data(args)
     if not len(test_data):
@@ -605,16 +656,63 @@ def get_test_loader(args, pre_transforms_test):
     return test_loader
 
 
+class CropShuffleBuffer(IterableDataset):
+    """
+    Yields the crops of a dataset which returns several crops per volume (RandCropByPosNegLabeld with num_samples > 1)
+    as separate samples through a shuffle buffer, so consecutive samples are mostly from different volumes.
+    The volumes are visited in a random order per epoch, split between the DataLoader workers.
+
+    Args:
+        dataset: map-style dataset, every item is a list of crops.
+        crops_per_volume: number of crops per item, only needed for the length.
+        buffer_size: number of crops in the buffer, a random one of them is yielded for every new crop.
+        seed: seed of the volume order / buffer when no DataLoader workers are used.
+    """
+
+    def __init__(self, dataset, crops_per_volume: int, buffer_size: int, seed: int = 0):
+        self.dataset = dataset
+        self.crops_per_volume = crops_per_volume
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self._epoch = 0
+
+    def __len__(self):
+        return len(self.dataset) * self.crops_per_volume
+
+    def __iter__(self):
+        info = get_worker_info()
+        if info is None:
+            self._epoch += 1
+            seed, worker_id, num_workers = self.seed + self._epoch, 0, 1
+        else:
+            # The DataLoader draws a new base seed every epoch, identical for all workers of the epoch
+            seed, worker_id, num_workers = info.seed - info.id, info.id, info.num_workers
+        order = np.random.default_rng(seed % 2**32).permutation(len(self.dataset))
+        rng = np.random.default_rng((seed + worker_id + 1) % 2**32)
+        buffer = []
+        for index in order[worker_id::num_workers]:
+            for crop in self.dataset[index]:
+                buffer.append(crop)
+                if len(buffer) >= self.buffer_size:
+                    yield buffer.pop(rng.integers(len(buffer)))
+        rng.shuffle(buffer)
+        yield from buffer
+
+
 def get_train_loader(args, pre_transforms_train):
     train_data, val_data, test_data = get_data(args)
     total_l = len(train_data) + len(val_data)
 
-    train_ds = PersistentDataset(train_data, pre_transforms_train, cache_dir=args.cache_dir)
+    train_ds = get_cache_dataset(args, train_data, pre_transforms_train)
+    if args.crops_per_volume > 1:
+        train_ds = CropShuffleBuffer(train_ds, args.crops_per_volume, args.crop_shuffle_buffer, seed=args.seed)
     train_loader = ThreadDataLoader(
         train_ds,
-        shuffle=True,
+        # CropShuffleBuffer shuffles itself
+        shuffle=not isinstance(train_ds, CropShuffleBuffer),
         num_workers=args.num_workers,
-        batch_size=1,
+        batch_size=args.train_batch_size,
+        persistent_workers=args.ram_cache_gb > 0 and args.num_workers > 0,
         # The two options below are needed if ToDeviced('cuda' ,..) is activated..
         # multiprocessing_context="spawn",
         # persistent_workers=True,
@@ -629,11 +727,12 @@ def get_val_loader(args, pre_transforms_val):
 
     total_l = len(train_data) + len(val_data)
 
-    val_ds = PersistentDataset(val_data, pre_transforms_val, cache_dir=args.cache_dir)
+    val_ds = get_cache_dataset(args, val_data, pre_transforms_val)
     val_loader = ThreadDataLoader(
         val_ds,
         num_workers=args.num_workers,
-        batch_size=1,
+        batch_size=args.val_batch_size,
+        persistent_workers=args.ram_cache_gb > 0 and args.num_workers > 0,
         # multiprocessing_context="spawn",
         # persistent_workers=True,
     )
@@ -648,23 +747,30 @@ def get_cross_validation(args, nfolds, pre_transforms_train, pre_transforms_val)
     train_data, val_data, test_data = get_data(args)
 
     cvdataset = CrossValidation(
-        dataset_cls=PersistentDataset,
+        dataset_cls=get_cache_dataset_cls(args),
         data=train_data,
         nfolds=nfolds,
         seed=args.seed,
         transform=pre_transforms_train,
         cache_dir=args.cache_dir,
+        hash_func=file_fingerprint_hashing,
+        hash_transform=transform_fingerprint_hashing,
     )
 
-    train_dss = [cvdataset.get_dataset(folds=folds[0:i] + folds[(i + 1) :]) for i in folds]
-    val_dss = [cvdataset.get_dataset(folds=i, transform=pre_transforms_val) for i in range(nfolds)]
+    train_dss = [add_ram_cache(args, cvdataset.get_dataset(folds=folds[0:i] + folds[(i + 1) :])) for i in folds]
+    if args.crops_per_volume > 1:
+        train_dss = [
+            CropShuffleBuffer(ds, args.crops_per_volume, args.crop_shuffle_buffer, seed=args.seed) for ds in train_dss
+        ]
+    val_dss = [add_ram_cache(args, cvdataset.get_dataset(folds=i, transform=pre_transforms_val)) for i in range(nfolds)]
 
     train_loaders = [
         ThreadDataLoader(
             train_dss[i],
-            shuffle=True,
+            shuffle=args.crops_per_volume == 1,
             num_workers=args.num_workers,
-            batch_size=1,
+            batch_size=args.train_batch_size,
+            persistent_workers=args.ram_cache_gb > 0 and args.num_workers > 0,
         )
         for i in folds
     ]
@@ -673,7 +779,8 @@ def get_cross_validation(args, nfolds, pre_transforms_train, pre_transforms_val)
         ThreadDataLoader(
             val_dss[i],
             num_workers=args.num_workers,
-            batch_size=1,
+            batch_size=args.val_batch_size,
+            persistent_workers=args.ram_cache_gb > 0 and args.num_workers > 0,
         )
         for i in folds
     ]
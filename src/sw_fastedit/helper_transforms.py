@@ -5,12 +5,14 @@ import time
 from typing import Hashable, Iterable, Mapping
 import gc
 
+import numpy as np
 import torch
 from monai.config import KeysCollection
 from monai.transforms import (
     CenterSpatialCropd,
     Compose,
     CropForegroundd,
+    FgBgToIndicesd,
     MapTransform,
     Transform,
 )
@@ -43,6 +45,22 @@ class AbortifNaNd(MapTransform):
         return data
 
 
+class ArgmaxIfLogitsd(MapTransform):
+    def __init__(self, keys: KeysCollection = None, dim: int = 0, allow_missing_keys: bool = False):
+        """
+        Argmax over the channel dimension `dim`, unless the prediction already is a label map with a single channel,
+        e.g. from the MemmapSlidingWindowInferer.
+        """
+        super().__init__(keys, allow_missing_keys)
+        self.dim = dim
+
+    def __call__(self, data: Mapping[Hashable, torch.Tensor]) -> Mapping[Hashable, torch.Tensor]:
+        for key in self.key_iterator(data):
+            if data[key].shape[self.dim] > 1:
+                data[key] = torch.argmax(data[key], dim=self.dim, keepdim=True)
+        return data
+
+
 class TrackTimed(Transform):
     def __init__(self, transform):
         """
@@ -143,6 +161,29 @@ class CheckTheAmountOfInformationLossByCropd(MapTransform):
         return data
 
 
+class CompactFgBgToIndicesd(FgBgToIndicesd):
+    def __init__(self, keys: KeysCollection, max_indices: int = 0, **kwargs):
+        """
+        FgBgToIndicesd which stores the indices as int32 and keeps at most max_indices (0: all) of each of them,
+        every n-th one in raster order, so they stay small in the cache. Used for the fg_indices_key / bg_indices_key
+        of RandCropByPosNegLabeld, which then no longer scans the whole label for every crop.
+        """
+        super().__init__(keys, **kwargs)
+        self.max_indices = max_indices
+
+    def _compact(self, indices):
+        if self.max_indices and len(indices) > self.max_indices:
+            indices = indices[:: -(-len(indices) // self.max_indices)]
+        return indices.to(torch.int32) if isinstance(indices, torch.Tensor) else indices.astype(np.int32)
+
+    def __call__(self, data: Mapping[Hashable, torch.Tensor]) -> Mapping[Hashable, torch.Tensor]:
+        d = super().__call__(data)
+        for key in self.key_iterator(d):
+            for postfix in (self.fg_postfix, self.bg_postfix):
+                d[str(key) + postfix] = self._compact(d[str(key) + postfix])
+        return d
+
+
 class PrintDatad(MapTransform):
     def __init__(
         self,
@@ -0,0 +1,1048 @@
+from __future__ import annotations
+
+import itertools
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+import psutil
+import torch
+import torch.nn.functional as F
+from monai.data import MetaTensor
+from monai.data.utils import compute_importance_map, dense_patch_slices
+from monai.inferers import SlidingWindowInferer
+from monai.utils import (
+    PytorchPadMode,
+    convert_data_type,
+    convert_to_dst_type,
+    ensure_tuple,
+    ensure_tuple_rep,
+    look_up_option,
+)
+
+from sw_fastedit.helper_transforms import threshold_foreground
+
+logger = logging.getLogger("sw_fastedit")
+
+
+def get_scan_interval(image_size: Sequence[int], roi_size: Sequence[int], overlap: float) -> Tuple[int]:
+    """Same scan interval as MONAI's sliding_window_inference uses."""
+    scan_interval = []
+    for i in range(len(image_size)):
+        if roi_size[i] == image_size[i]:
+            scan_interval.append(int(roi_size[i]))
+        else:
+            interval = int(roi_size[i] * (1 - overlap))
+            scan_interval.append(interval if interval > 0 else 1)
+    return tuple(scan_interval)
+
+
+def get_window_slices(image_size: Sequence[int], roi_size: Sequence[int], overlap: float) -> List[Tuple[slice]]:
+    """Returns the spatial slices of all windows, identical to the ones of MONAI's sliding_window_inference."""
+    scan_interval = get_scan_interval(image_size, roi_size, overlap)
+    return dense_patch_slices(image_size, roi_size, scan_interval)
+
+
+class WindowPlan:
+    """
+    Everything a sliding window pass over one image size needs besides the network: the window slices, the
+    importance map of a window (11HWD, float32) and the count map (11HWD, float32), i.e. the sum of the importance maps
+    of all windows. The count map is only computed when it is first used.
+    """
+
+    def __init__(self, image_size, roi_size, overlap: float, mode="gaussian", sigma_scale=0.125, device=None):
+        self.image_size = tuple(image_size)
+        self.slices = get_window_slices(image_size, roi_size, overlap)
+        importance_map = compute_importance_map(roi_size, mode=mode, sigma_scale=sigma_scale, device=device)
+        self.importance_map = importance_map.to(device=device, dtype=torch.float32)[None, None]
+        self._count_map = None
+
+    @property
+    def count_map(self) -> torch.Tensor:
+        if self._count_map is None:
+            self._count_map = torch.zeros((1, 1, *self.image_size), device=self.importance_map.device)
+            for s in self.slices:
+                self._count_map[(slice(None), slice(None), *s)] += self.importance_map
+        return self._count_map
+
+
+# LRU cache of the WindowPlans, shared by all inferers of the process (train, eval, MONAI Label)
+_window_plans: OrderedDict[tuple, WindowPlan] = OrderedDict()
+# Set by set_window_plan_cache_size(), usually from args.sw_plan_cache_size
+_window_plan_cache_size = 4
+
+
+def set_window_plan_cache_size(size: int):
+    """Number of WindowPlans to keep, 0 disables the cache. Every plan holds a count map of the image size."""
+    global _window_plan_cache_size
+    _window_plan_cache_size = size
+    while len(_window_plans) > max(size, 0):
+        _window_plans.popitem(last=False)
+
+
+def get_window_plan(image_size, roi_size, overlap: float, mode="gaussian", sigma_scale=0.125, device=None) -> WindowPlan:
+    """Returns the WindowPlan for (image size, roi size, overlap, mode), from the LRU cache if it has been planned before."""
+    device = torch.device(device or "cpu")
+    key = (tuple(image_size), tuple(roi_size), overlap, str(mode), ensure_tuple(sigma_scale), str(device))
+    if key in _window_plans:
+        _window_plans.move_to_end(key)
+        return _window_plans[key]
+    plan = WindowPlan(image_size, roi_size, overlap, mode, sigma_scale, device)
+    if _window_plan_cache_size > 0:
+        _window_plans[key] = plan
+        if len(_window_plans) > _window_plan_cache_size:
+            _window_plans.popitem(last=False)
+    logger.debug(f"Planned {len(plan.slices)} sliding windows for the image size {tuple(image_size)}")
+    return plan
+
+
+def get_roi_padding(image_size: Sequence[int], roi_size: Sequence[int]) -> Tuple[List[int], Tuple[slice]]:
+    """
+    Padding of MONAI's sliding_window_inference for images smaller than roi_size: the F.pad sizes (last dimension
+    first) and the spatial slices which crop the padded output back to image_size.
+    """
+    diffs = [max(r - s, 0) for s, r in zip(image_size, roi_size)]
+    pad_size = []
+    for diff in reversed(diffs):
+        pad_size.extend([diff // 2, diff - diff // 2])
+    crop = tuple(slice(diff // 2, diff // 2 + size) for size, diff in zip(image_size, diffs))
+    return pad_size, crop
+
+
+def predict_windows(
+    inputs: torch.Tensor,
+    network: Callable,
+    windows: List[Tuple[int, Tuple[slice]]],
+    sw_batch_size: int,
+    sw_device,
+    *args,
+    **kwargs,
+):
+    """
+    Runs the network on the given windows in batches of sw_batch_size.
+
+    Args:
+        inputs: input of shape BCHWD
+        windows: list of (batch index, spatial slices) tuples
+    Yields: (window position in `windows`, logits of shape 1CHWD on sw_device)
+    """
+    for start in range(0, len(windows), sw_batch_size):
+        batch_windows = windows[start : start + sw_batch_size]
+        win_data = torch.cat(
+            [inputs[(slice(b, b + 1), slice(None), *s)] for b, s in batch_windows],
+        ).to(sw_device)
+        logits = network(win_data, *args, **kwargs)
+        for i in range(len(batch_windows)):
+            yield start + i, logits[i : i + 1]
+
+
+class PeakMemory:
+    """
+    Context manager which measures the peak memory increase in bytes while it is active, on CUDA via the allocator
+    statistics and on the CPU by sampling the resident set size (RSS) of the process.
+    """
+
+    def __init__(self, device: torch.device, sample_interval: float = 0.001):
+        self.device = torch.device(device)
+        self.sample_interval = sample_interval
+        self.peak = 0
+        self._start = 0
+
+    def _sample_rss(self):
+        process = psutil.Process()
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process.memory_info().rss)
+            self._stop.wait(self.sample_interval)
+
+    def __enter__(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._start = torch.cuda.memory_allocated(self.device)
+        else:
+            self._start = self.peak = psutil.Process().memory_info().rss
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample_rss, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            self.peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, psutil.Process().memory_info().rss)
+        self.peak -= self._start
+
+
+def get_available_memory(device: torch.device) -> int:
+    """Free memory in bytes on the device (CUDA) or in the RAM (CPU)."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        # Memory which is cached by torch can be reused as well
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    return psutil.virtual_memory().available
+
+
+def get_memory_per_window(
+    network: torch.nn.Module,
+    roi_size: Sequence[int],
+    *,
+    device: torch.device | None = None,
+    amp: bool = False,
+    with_grad: bool = False,
+) -> int:
+    """
+    Peak memory in bytes which every additional window of a sliding window batch needs.
+
+    On CUDA it is probed by running the network on synthetic windows with a batch size of 1 and 2, in train mode with
+    gradients for with_grad (the training step) and in eval mode otherwise. The mode of the network is restored
+    afterwards. On the CPU the resident set size is too noisy for such a probe (freed memory stays mapped), so the
+    activations of the cost model of get_network_cost() are used instead.
+    """
+    device = torch.device(device or next(network.parameters()).device)
+    in_channels = network.in_channels
+    if device.type == "cuda":
+        peaks = []
+        was_training = network.training
+        # The train mode forward passes update the running statistics of batch norm layers
+        buffers = [(buffer, buffer.clone()) for buffer in network.buffers()]
+        network.train(with_grad)
+        for batch_size in [1, 2]:
+            window = torch.rand((batch_size, in_channels, *roi_size), device=device)
+            with PeakMemory(device) as peak_memory, torch.set_grad_enabled(with_grad):
+                with torch.autocast(device_type=device.type) if amp else nullcontext():
+                    # The output is freed right away, only the peak during the forward pass counts
+                    network(window)
+            peaks.append(peak_memory.peak)
+            del window
+        network.train(was_training)
+        for buffer, value in buffers:
+            buffer.copy_(value)
+        return max(peaks[1] - peaks[0], 1)
+    # Imported here, the planner depends on this module
+    from sw_fastedit.utils.planner import get_network_cost
+
+    cost = get_network_cost(network, in_channels, roi_size, bytes_per_element=2 if amp else 4)
+    return cost["train_activations"] if with_grad else cost["peak_activations"]
+
+
+def get_auto_sw_batch_size(
+    network: torch.nn.Module,
+    roi_size: Sequence[int],
+    image_size: Sequence[int],
+    overlap: float,
+    *,
+    device: torch.device | None = None,
+    output_device: torch.device | None = None,
+    amp: bool = False,
+    with_grad: bool = False,
+    memory_fraction: float = 0.8,
+    max_sw_batch_size: int | None = None,
+    memory_per_window: int | None = None,
+) -> int:
+    """
+    Returns the largest sw_batch_size which fits into memory_fraction of the available memory for a sliding window
+    inference of roi_size windows on a volume of image_size.
+
+    The memory per window comes from get_memory_per_window() unless it is given, it does not depend on image_size.
+    The memory of the stitched output (logits and count map) of the volume is reserved on output_device as well.
+    """
+    device = torch.device(device or next(network.parameters()).device)
+    output_device = torch.device(output_device or device)
+    out_channels = network.out_channels
+    num_windows = len(get_window_slices(image_size, roi_size, overlap))
+    if memory_per_window is None:
+        memory_per_window = get_memory_per_window(network, roi_size, device=device, amp=amp, with_grad=with_grad)
+
+    # Output logits, count map and the input of the volume, all in float32
+    voxels = 1
+    for size in image_size:
+        voxels *= size
+    stitching_memory = voxels * (out_channels + 1) * 4
+    available = get_available_memory(device) * memory_fraction
+    if output_device == device:
+        available -= stitching_memory
+    elif get_available_memory(output_device) * memory_fraction < stitching_memory:
+        logger.warning(f"The stitched output ({stitching_memory / 1024**3:.2f} GB) may not fit on {output_device}")
+
+    sw_batch_size = int(available // memory_per_window)
+    sw_batch_size = max(1, min(sw_batch_size, num_windows, max_sw_batch_size or num_windows))
+    logger.info(
+        f"Auto-tuned sw_batch_size={sw_batch_size} for {num_windows} windows of {tuple(roi_size)} on a volume of "
+        f"{tuple(image_size)} ({device}): {memory_per_window / 1024**2:.0f} MB per window, "
+        f"{available / 1024**3:.2f} GB available"
+    )
+    return sw_batch_size
+
+
+def update_sw_batch_size(inferer: SlidingWindowInferer, image_size: Sequence[int]):
+    """
+    Sets inferer.sw_batch_size to inferer.sw_batch_size_fn(image_size) (e.g. get_auto_sw_batch_size() for the volume
+    shape), computed once per image size. Does nothing without a sw_batch_size_fn.
+    """
+    if inferer.sw_batch_size_fn is None:
+        return
+    image_size = tuple(image_size)
+    if image_size not in inferer.sw_batch_sizes:
+        inferer.sw_batch_sizes[image_size] = inferer.sw_batch_size_fn(image_size)
+    inferer.sw_batch_size = inferer.sw_batch_sizes[image_size]
+
+
+def get_window_occupancy(
+    inputs: torch.Tensor,
+    windows: List[Tuple[int, Tuple[slice]]],
+    foreground_fn: Callable = threshold_foreground,
+    number_intensity_ch: int = 1,
+) -> List[bool]:
+    """
+    Returns for every window whether it contains foreground in the intensity channels (according to foreground_fn)
+    or any guidance, i.e. a click signal, in the remaining channels.
+    """
+    occupied = torch.any(foreground_fn(inputs[:, :number_intensity_ch]), dim=1)
+    if inputs.shape[1] > number_intensity_ch:
+        occupied |= torch.any(inputs[:, number_intensity_ch:] != 0, dim=1)
+    return [bool(torch.any(occupied[(b, *s)])) for b, s in windows]
+
+
+def get_label_map(output: torch.Tensor | np.ndarray, chunk_size: int, device=None) -> torch.Tensor:
+    """
+    Argmax over the channels of the stitched output (BCHWD, tensor or numpy array) as a uint8 label map (B1HWD).
+    Runs in chunks of `chunk_size` slices along the first spatial dimension, so the int64 argmax indices
+    never exist for the whole volume at once.
+    """
+    batch_size, image_size = output.shape[0], tuple(output.shape[2:])
+    labels = torch.empty((batch_size, 1, *image_size), dtype=torch.uint8, device=device)
+    for b in range(batch_size):
+        for start in range(0, image_size[0], chunk_size):
+            if isinstance(output, np.ndarray):
+                chunk = torch.from_numpy(np.argmax(output[b, :, start : start + chunk_size], axis=0))
+            else:
+                chunk = torch.argmax(output[b, :, start : start + chunk_size], dim=0)
+            labels[b, 0, start : start + chunk_size] = chunk.to(device=device, dtype=torch.uint8)
+    return labels
+
+
+class ForegroundSlidingWindowInferer(SlidingWindowInferer):
+    """
+    SlidingWindowInferer which skips the windows without foreground and without clicks, e.g. the air around
+    a whole-body PET volume. Skipped windows are filled with a constant logit of `background_logit` for the
+    background channel (channel 0) and `-background_logit` for all other channels.
+    Foreground is determined by `foreground_fn` on the intensity channels, by default the same `threshold_foreground`
+    which is used for CropForegroundd on the scaled [0, 1] intensities.
+
+    With `skip_background=False` it is a SlidingWindowInferer with the same output, which is the default of
+    get_inferers(). The number of skipped windows of the last call is kept in `skipped_windows`.
+    The window slices, importance map and count map come from the shared WindowPlan cache, see get_window_plan().
+    Inputs smaller than roi_size are padded with padding_mode and cval like in MONAI, so their plan is the one of the
+    padded size. With gradients enabled (training step) or buffer_steps this falls back to the normal
+    SlidingWindowInferer.
+    With `sw_batch_size_fn` the sw_batch_size is set per volume shape, see update_sw_batch_size().
+    """
+
+    def __init__(
+        self,
+        roi_size,
+        sw_batch_size: int = 1,
+        overlap: float = 0.25,
+        mode="gaussian",
+        *,
+        skip_background: bool = True,
+        foreground_fn: Callable = threshold_foreground,
+        number_intensity_ch: int = 1,
+        background_logit: float = 10.0,
+        sw_batch_size_fn: Callable | None = None,
+        **kwargs,
+    ):
+        super().__init__(roi_size, sw_batch_size=sw_batch_size, overlap=overlap, mode=mode, **kwargs)
+        self.sw_batch_size_fn = sw_batch_size_fn
+        self.sw_batch_sizes = {}
+        self.skip_background = skip_background
+        self.foreground_fn = foreground_fn
+        self.number_intensity_ch = number_intensity_ch
+        self.background_logit = background_logit
+        self.skipped_windows = 0
+
+    def _get_window_plan(self, image_size, roi_size, device) -> WindowPlan:
+        return get_window_plan(image_size, roi_size, self.overlap, self.mode, self.sigma_scale, device)
+
+    def _get_background_logits(self, num_channels: int, roi_size, device) -> torch.Tensor:
+        logits = torch.full((1, num_channels, *([1] * len(roi_size))), -self.background_logit, device=device)
+        logits[:, 0] = self.background_logit
+        return logits.expand(1, num_channels, *roi_size)
+
+    def _split_windows(self, inputs: torch.Tensor, windows: List[int], all_windows: List[Tuple[int, Tuple[slice]]]):
+        """Splits the window indices into the ones which have to be predicted and the skipped background ones."""
+        if not self.skip_background:
+            return windows, []
+        occupancy = get_window_occupancy(
+            inputs, [all_windows[i] for i in windows], self.foreground_fn, self.number_intensity_ch
+        )
+        predicted = [i for i, occupied in zip(windows, occupancy) if occupied]
+        skipped = [i for i, occupied in zip(windows, occupancy) if not occupied]
+        return predicted, skipped
+
+    def __call__(self, inputs: torch.Tensor, network: Callable, *args, **kwargs) -> torch.Tensor:
+        roi_size = ensure_tuple_rep(self.roi_size, len(inputs.shape) - 2)
+        update_sw_batch_size(self, inputs.shape[2:])
+        if torch.is_grad_enabled() or self.buffer_steps is not None:
+            return super().__call__(inputs, network, *args, **kwargs)
+
+        temp_meta = None
+        if isinstance(inputs, MetaTensor):
+            temp_meta = MetaTensor([]).copy_meta_from(inputs, copy_attr=False)
+        inputs_t = convert_data_type(inputs, torch.Tensor)[0]
+        sw_device = self.sw_device or inputs_t.device
+        device = self.device or inputs_t.device
+        pad_size, crop = get_roi_padding(inputs_t.shape[2:], roi_size)
+        if any(pad_size):
+            inputs_t = F.pad(inputs_t, pad=pad_size, mode=look_up_option(self.padding_mode, PytorchPadMode), value=self.cval)
+        batch_size, image_size = inputs_t.shape[0], tuple(inputs_t.shape[2:])
+
+        plan = self._get_window_plan(image_size, roi_size, device)
+        windows = [(b, s) for b in range(batch_size) for s in plan.slices]
+        predicted, skipped = self._split_windows(inputs_t, list(range(len(windows))), windows)
+        if not len(predicted):
+            # Predict one window anyway to get the number of output channels
+            predicted, skipped = skipped[:1], skipped[1:]
+
+        importance_map = plan.importance_map
+        output = None
+        for pos, logits in predict_windows(
+            inputs_t, network, [windows[i] for i in predicted], self.sw_batch_size, sw_device, *args, **kwargs
+        ):
+            b, s = windows[predicted[pos]]
+            if output is None:
+                output = torch.zeros((batch_size, logits.shape[1], *image_size), device=device)
+            output[(slice(b, b + 1), slice(None), *s)] += logits.to(device=device, dtype=torch.float32) * importance_map
+        background_logits = self._get_background_logits(output.shape[1], roi_size, device)
+        for idx in skipped:
+            b, s = windows[idx]
+            output[(slice(b, b + 1), slice(None), *s)] += background_logits * importance_map
+
+        self.skipped_windows = len(skipped)
+        if self.skip_background:
+            logger.info(f"Foreground sliding window: skipped {len(skipped)}/{len(windows)} windows")
+
+        output = output / plan.count_map
+        if any(pad_size):
+            output = output[(slice(None), slice(None), *crop)]
+        if temp_meta is not None:
+            return convert_to_dst_type(output, temp_meta, device=device)[0]
+        return output
+
+
+class MemmapSlidingWindowInferer(ForegroundSlidingWindowInferer):
+    """
+    SlidingWindowInferer which stitches the windows into a disk-backed numpy.memmap instead of a tensor, so only
+    the current windows have to fit into memory, not the logits of the whole volume.
+    The argmax is then streamed out of the memmap in chunks of `chunk_size` slices along the first spatial dimension.
+
+    Returns the label map (B1HWD, uint8) instead of the logits, so the softmax / argmax post processing is skipped
+    for it, see ArgmaxIfLogitsd. With gradients enabled (training step) this falls back to the normal
+    SlidingWindowInferer which returns logits.
+
+    Args:
+        stitching_dir: where to create the temporary memmap files, defaults to the system temp dir.
+        chunk_size: number of slices per argmax chunk, defaults to the first dimension of roi_size.
+    """
+
+    def __init__(
+        self,
+        roi_size,
+        sw_batch_size: int = 1,
+        overlap: float = 0.25,
+        mode="gaussian",
+        *,
+        skip_background: bool = False,
+        stitching_dir: str | None = None,
+        chunk_size: int | None = None,
+        **kwargs,
+    ):
+        super().__init__(
+            roi_size, sw_batch_size=sw_batch_size, overlap=overlap, mode=mode, skip_background=skip_background, **kwargs
+        )
+        self.stitching_dir = stitching_dir
+        self.chunk_size = chunk_size
+
+    def __call__(self, inputs: torch.Tensor, network: Callable, *args, **kwargs) -> torch.Tensor:
+        roi_size = ensure_tuple_rep(self.roi_size, len(inputs.shape) - 2)
+        update_sw_batch_size(self, inputs.shape[2:])
+        if torch.is_grad_enabled() or any(inputs.shape[2 + i] < roi_size[i] for i in range(len(roi_size))):
+            return SlidingWindowInferer.__call__(self, inputs, network, *args, **kwargs)
+
+        temp_meta = None
+        if isinstance(inputs, MetaTensor):
+            temp_meta = MetaTensor([]).copy_meta_from(inputs, copy_attr=False)
+        inputs_t = convert_data_type(inputs, torch.Tensor)[0]
+        sw_device = self.sw_device or inputs_t.device
+        device = self.device or inputs_t.device
+        batch_size, image_size = inputs_t.shape[0], tuple(inputs_t.shape[2:])
+
+        plan = self._get_window_plan(image_size, roi_size, torch.device("cpu"))
+        windows = [(b, s) for b in range(batch_size) for s in plan.slices]
+        predicted, skipped = self._split_windows(inputs_t, list(range(len(windows))), windows)
+        if not len(predicted):
+            # Predict one window anyway to get the number of output channels
+            predicted, skipped = skipped[:1], skipped[1:]
+        importance_map = plan.importance_map[0].numpy()
+
+        with tempfile.TemporaryDirectory(dir=self.stitching_dir) as stitching_dir:
+            output = None
+            for pos, logits in predict_windows(
+                inputs_t, network, [windows[i] for i in predicted], self.sw_batch_size, sw_device, *args, **kwargs
+            ):
+                if output is None:
+                    output = np.memmap(
+                        f"{stitching_dir}/output.dat",
+                        dtype=np.float32,
+                        mode="w+",
+                        shape=(batch_size, logits.shape[1], *image_size),
+                    )
+                b, s = windows[predicted[pos]]
+                output[(b, slice(None), *s)] += logits[0].to(device="cpu", dtype=torch.float32).numpy() * importance_map
+            if len(skipped):
+                background_logits = self._get_background_logits(output.shape[1], roi_size, torch.device("cpu"))[0].numpy()
+                for idx in skipped:
+                    b, s = windows[idx]
+                    output[(b, slice(None), *s)] += background_logits * importance_map
+
+            # The count map is positive everywhere, so the argmax does not need the normalization
+            labels = get_label_map(output, self.chunk_size or roi_size[0], device)
+            del output
+
+        self.skipped_windows = len(skipped)
+        if self.skip_background:
+            logger.info(f"Memmap sliding window: skipped {len(skipped)}/{len(windows)} windows")
+
+        if temp_meta is not None:
+            return convert_to_dst_type(labels, temp_meta, device=device, dtype=torch.uint8)[0]
+        return labels
+
+
+class LowPrecisionSlidingWindowInferer(ForegroundSlidingWindowInferer):
+    """
+    SlidingWindowInferer for evaluation and serving, where only the argmax of the prediction is used.
+    Since the argmax does not change under the count map normalization, only the Gaussian weighted logits are
+    stitched, without a count map and in low precision:
+
+        - "fp16" / "bf16": all channels in float16 / bfloat16 (C * 2 instead of (C + 1) * 4 bytes per voxel)
+        - "margin": only for two output channels, the weighted margin logit_1 - logit_0 in float16, the label is
+          then margin > 0 (2 bytes per voxel)
+
+    Returns the label map (B1HWD, uint8) instead of the logits, so the softmax / argmax post processing is skipped
+    for it, see ArgmaxIfLogitsd. With gradients enabled (training step) this falls back to the normal
+    SlidingWindowInferer which returns logits.
+
+    Args:
+        stitching: one of "fp16", "bf16" or "margin".
+        chunk_size: number of slices per argmax chunk, defaults to the first dimension of roi_size.
+    """
+
+    STITCHING_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "margin": torch.float16}
+
+    def __init__(
+        self,
+        roi_size,
+        sw_batch_size: int = 1,
+        overlap: float = 0.25,
+        mode="gaussian",
+        *,
+        skip_background: bool = False,
+        stitching: str = "fp16",
+        chunk_size: int | None = None,
+        **kwargs,
+    ):
+        super().__init__(
+            roi_size, sw_batch_size=sw_batch_size, overlap=overlap, mode=mode, skip_background=skip_background, **kwargs
+        )
+        if stitching not in self.STITCHING_DTYPES:
+            raise UserWarning(f"Unknown stitching {stitching}, choose from {list(self.STITCHING_DTYPES)}")
+        self.stitching = stitching
+        self.chunk_size = chunk_size
+
+    def _to_stitching(self, weighted_logits: torch.Tensor) -> torch.Tensor:
+        """Converts the weighted (float32) logits of a window into what is accumulated for `stitching`."""
+        if self.stitching == "margin":
+            if weighted_logits.shape[1] != 2:
+                raise UserWarning(f"margin stitching needs two output channels, got {weighted_logits.shape[1]}")
+            weighted_logits = weighted_logits[:, 1:2] - weighted_logits[:, 0:1]
+        return weighted_logits.to(dtype=self.STITCHING_DTYPES[self.stitching])
+
+    def __call__(self, inputs: torch.Tensor, network: Callable, *args, **kwargs) -> torch.Tensor:
+        roi_size = ensure_tuple_rep(self.roi_size, len(inputs.shape) - 2)
+        update_sw_batch_size(self, inputs.shape[2:])
+        if torch.is_grad_enabled() or any(inputs.shape[2 + i] < roi_size[i] for i in range(len(roi_size))):
+            return SlidingWindowInferer.__call__(self, inputs, network, *args, **kwargs)
+
+        temp_meta = None
+        if isinstance(inputs, MetaTensor):
+            temp_meta = MetaTensor([]).copy_meta_from(inputs, copy_attr=False)
+        inputs_t = convert_data_type(inputs, torch.Tensor)[0]
+        sw_device = self.sw_device or inputs_t.device
+        device = self.device or inputs_t.device
+        batch_size, image_size = inputs_t.shape[0], tuple(inputs_t.shape[2:])
+
+        plan = self._get_window_plan(image_size, roi_size, device)
+        windows = [(b, s) for b in range(batch_size) for s in plan.slices]
+        predicted, skipped = self._split_windows(inputs_t, list(range(len(windows))), windows)
+        if not len(predicted):
+            # Predict one window anyway to get the number of output channels
+            predicted, skipped = skipped[:1], skipped[1:]
+
+        importance_map = plan.importance_map
+        output, num_channels = None, None
+        for pos, logits in predict_windows(
+            inputs_t, network, [windows[i] for i in predicted], self.sw_batch_size, sw_device, *args, **kwargs
+        ):
+            stitched = self._to_stitching(logits.to(device=device, dtype=torch.float32) * importance_map)
+            if output is None:
+                num_channels = logits.shape[1]
+                output = torch.zeros((batch_size, stitched.shape[1], *image_size), dtype=stitched.dtype, device=device)
+            b, s = windows[predicted[pos]]
+            output[(slice(b, b + 1), slice(None), *s)] += stitched
+        if len(skipped):
+            background = self._to_stitching(self._get_background_logits(num_channels, roi_size, device) * importance_map)
+            for idx in skipped:
+                b, s = windows[idx]
+                output[(slice(b, b + 1), slice(None), *s)] += background
+
+        if self.stitching == "margin":
+            labels = (output > 0).to(dtype=torch.uint8)
+        else:
+            labels = get_label_map(output, self.chunk_size or roi_size[0], device)
+        del output
+
+        self.skipped_windows = len(skipped)
+        if self.skip_background:
+            logger.info(f"Low precision sliding window: skipped {len(skipped)}/{len(windows)} windows")
+
+        if temp_meta is not None:
+            return convert_to_dst_type(labels, temp_meta, device=device, dtype=torch.uint8)[0]
+        return labels
+
+
+class IncrementalSlidingWindowInferer(ForegroundSlidingWindowInferer):
+    """
+    SlidingWindowInferer for the click loop of `Interaction`. It keeps the logits of every window from the previous
+    call and only runs the network again on the windows whose input changed, e.g. the windows around a new click.
+    The changed windows are then re-blended into the stored output.
+
+    Every window is predicted on its own (including the instance norm), so the output matches a full sliding window
+    pass up to floating point differences in the blending.
+    With `skip_background=True` changed windows without foreground and clicks are filled with the constant background
+    logits instead, see ForegroundSlidingWindowInferer.
+    With gradients enabled (training step) this falls back to the normal SlidingWindowInferer.
+    Call `reset()` to release the cached logits, e.g. when the next volume starts.
+    """
+
+    def __init__(
+        self, roi_size, sw_batch_size: int = 1, overlap: float = 0.25, mode="gaussian", skip_background=False, **kwargs
+    ):
+        super().__init__(
+            roi_size, sw_batch_size=sw_batch_size, overlap=overlap, mode=mode, skip_background=skip_background, **kwargs
+        )
+        self.reset()
+
+    def reset(self):
+        self._inputs = None
+        self._windows = None
+        self._window_logits = None
+        self._output = None
+
+    def __call__(self, inputs: torch.Tensor, network: Callable, *args, **kwargs) -> torch.Tensor:
+        roi_size = ensure_tuple_rep(self.roi_size, len(inputs.shape) - 2)
+        update_sw_batch_size(self, inputs.shape[2:])
+        if torch.is_grad_enabled() or self.buffer_steps is not None:
+            return super().__call__(inputs, network, *args, **kwargs)
+
+        temp_meta = None
+        if isinstance(inputs, MetaTensor):
+            temp_meta = MetaTensor([]).copy_meta_from(inputs, copy_attr=False)
+        inputs_t = convert_data_type(inputs, torch.Tensor)[0]
+        sw_device = self.sw_device or inputs_t.device
+        device = self.device or inputs_t.device
+        pad_size, crop = get_roi_padding(inputs_t.shape[2:], roi_size)
+        if any(pad_size):
+            inputs_t = F.pad(inputs_t, pad=pad_size, mode=look_up_option(self.padding_mode, PytorchPadMode), value=self.cval)
+        batch_size, image_size = inputs_t.shape[0], tuple(inputs_t.shape[2:])
+
+        plan = self._get_window_plan(image_size, roi_size, device)
+        if self._inputs is None or self._inputs.shape != inputs_t.shape:
+            # New volume, compute all windows
+            self.reset()
+            self._windows = [(b, s) for b in range(batch_size) for s in plan.slices]
+            self._window_logits = [None] * len(self._windows)
+            dirty = list(range(len(self._windows)))
+        else:
+            changed = torch.any(inputs_t != self._inputs, dim=1).to(device=device)
+            dirty = [i for i, (b, s) in enumerate(self._windows) if torch.any(changed[(b, *s)])]
+        predicted, skipped = self._split_windows(inputs_t, dirty, self._windows)
+        if self._output is None and not len(predicted):
+            # Predict one window anyway to get the number of output channels
+            predicted, skipped = skipped[:1], skipped[1:]
+
+        importance_map = plan.importance_map
+
+        def update_window(idx, logits):
+            b, s = self._windows[idx]
+            region = (slice(b, b + 1), slice(None), *s)
+            if self._window_logits[idx] is not None:
+                # Remove the contribution of the outdated window
+                self._output[region] -= self._window_logits[idx] * importance_map
+            self._output[region] += logits * importance_map
+            self._window_logits[idx] = logits
+
+        predicted_windows = [self._windows[i] for i in predicted]
+        for pos, logits in predict_windows(
+            inputs_t, network, predicted_windows, self.sw_batch_size, sw_device, *args, **kwargs
+        ):
+            logits = logits.to(device=device, dtype=torch.float32)
+            if self._output is None:
+                self._output = torch.zeros((batch_size, logits.shape[1], *image_size), device=device)
+            update_window(predicted[pos], logits)
+        if len(skipped):
+            background_logits = self._get_background_logits(self._output.shape[1], roi_size, device)
+            for idx in skipped:
+                update_window(idx, background_logits)
+
+        self._inputs = inputs_t.detach().clone()
+        self.skipped_windows = len(skipped)
+        logger.info(
+            f"Incremental sliding window: recomputed {len(predicted)}/{len(self._windows)} windows"
+            + (f", skipped {len(skipped)} background windows" if self.skip_background else "")
+        )
+
+        output = self._output / plan.count_map
+        if temp_meta is not None:
+            return convert_to_dst_type(output, temp_meta, device=device)[0]
+        return output
+
+
+class CascadeSlidingWindowInferer(ForegroundSlidingWindowInferer):
+    """
+    Coarse-to-fine SlidingWindowInferer for the click loop of `Interaction`. A sliding window pass on the volume
+    downsampled by `downsample_factor` finds the candidate regions (any label but the background). The full
+    resolution windows are then only predicted where they cover a candidate, a click or the foreground of the
+    previous prediction, all other windows are filled with the upsampled coarse logits.
+
+    The intermediate predictions only have to be good enough to place the next click, so this is an approximation.
+    With `full_final_pass=True` the prediction after `final_pass` has been set (done by `Interaction` before the final
+    prediction) is a full sliding window pass again. With `skip_background=True` that full pass skips the windows
+    without foreground and clicks, see ForegroundSlidingWindowInferer.
+    With gradients enabled (training step) this falls back to the normal SlidingWindowInferer.
+    Call `reset()` to release the previous prediction, e.g. when the next volume starts.
+
+    Args:
+        downsample_factor: factor by which every spatial dimension is downsampled for the coarse pass.
+        full_final_pass: whether the final prediction is a full resolution pass over all windows.
+    """
+
+    def __init__(
+        self,
+        roi_size,
+        sw_batch_size: int = 1,
+        overlap: float = 0.25,
+        mode="gaussian",
+        *,
+        skip_background: bool = False,
+        downsample_factor: int = 2,
+        full_final_pass: bool = True,
+        **kwargs,
+    ):
+        super().__init__(
+            roi_size, sw_batch_size=sw_batch_size, overlap=overlap, mode=mode, skip_background=skip_background, **kwargs
+        )
+        assert downsample_factor >= 1
+        self.downsample_factor = downsample_factor
+        self.full_final_pass = full_final_pass
+        self.reset()
+
+    def reset(self):
+        self._previous_mask = None
+        self.final_pass = False
+
+    def _get_coarse_logits(self, inputs: torch.Tensor, network: Callable, *args, **kwargs) -> torch.Tensor:
+        """Sliding window pass on the downsampled inputs, upsampled back to the input size."""
+        spatial_dims = len(inputs.shape) - 2
+        f = self.downsample_factor
+        intensity = getattr(F, f"avg_pool{spatial_dims}d")(
+            inputs[:, : self.number_intensity_ch], kernel_size=f, ceil_mode=True, count_include_pad=False
+        )
+        # Max pooling keeps every click in the downsampled guidance signal
+        guidance = getattr(F, f"max_pool{spatial_dims}d")(
+            inputs[:, self.number_intensity_ch :], kernel_size=f, ceil_mode=True
+        )
+        coarse_inputs = torch.cat([intensity, guidance], dim=1)
+        coarse_logits = SlidingWindowInferer.__call__(self, coarse_inputs, network, *args, **kwargs)
+        coarse_logits = convert_data_type(coarse_logits, torch.Tensor)[0].to(dtype=torch.float32)
+        interpolation = {1: "linear", 2: "bilinear", 3: "trilinear"}[spatial_dims]
+        return F.interpolate(coarse_logits, size=inputs.shape[2:], mode=interpolation, align_corners=False)
+
+    def __call__(self, inputs: torch.Tensor, network: Callable, *args, **kwargs) -> torch.Tensor:
+        roi_size = ensure_tuple_rep(self.roi_size, len(inputs.shape) - 2)
+        update_sw_batch_size(self, inputs.shape[2:])
+        if torch.is_grad_enabled() or any(inputs.shape[2 + i] < roi_size[i] for i in range(len(roi_size))):
+            return SlidingWindowInferer.__call__(self, inputs, network, *args, **kwargs)
+        if self.final_pass and self.full_final_pass:
+            logger.info("Cascade sliding window: full resolution pass for the final prediction")
+            return super().__call__(inputs, network, *args, **kwargs)
+
+        temp_meta = None
+        if isinstance(inputs, MetaTensor):
+            temp_meta = MetaTensor([]).copy_meta_from(inputs, copy_attr=False)
+        inputs_t = convert_data_type(inputs, torch.Tensor)[0]
+        sw_device = self.sw_device or inputs_t.device
+        device = self.device or inputs_t.device
+        batch_size, image_size = inputs_t.shape[0], tuple(inputs_t.shape[2:])
+        if self._previous_mask is not None and self._previous_mask.shape[1:] != image_size:
+            # New volume
+            self.reset()
+
+        output = self._get_coarse_logits(inputs_t, network, *args, **kwargs).to(device=device)
+        candidates = torch.argmax(output, dim=1) != 0
+        if inputs_t.shape[1] > self.number_intensity_ch:
+            candidates |= torch.any(inputs_t[:, self.number_intensity_ch :] != 0, dim=1).to(device=device)
+        if self._previous_mask is not None:
+            candidates |= self._previous_mask
+        plan = self._get_window_plan(image_size, roi_size, device)
+        windows = [(b, s) for b in range(batch_size) for s in plan.slices]
+        predicted = [i for i, (b, s) in enumerate(windows) if torch.any(candidates[(b, *s)])]
+        del candidates
+
+        # The blending of the full resolution windows, the coarse logits stay where no window is predicted
+        importance_map = plan.importance_map
+        count_map = torch.zeros((batch_size, 1, *image_size), device=device)
+        fine = torch.zeros_like(output)
+        for pos, logits in predict_windows(
+            inputs_t, network, [windows[i] for i in predicted], self.sw_batch_size, sw_device, *args, **kwargs
+        ):
+            b, s = windows[predicted[pos]]
+            region = (slice(b, b + 1), slice(None), *s)
+            fine[region] += logits.to(device=device, dtype=torch.float32) * importance_map
+            count_map[region] += importance_map
+        covered = count_map > 0
+        output = torch.where(covered, fine / count_map.clamp(min=torch.finfo(torch.float32).tiny), output)
+        del fine, count_map, covered
+
+        self._previous_mask = torch.argmax(output, dim=1) != 0
+        logger.info(f"Cascade sliding window: predicted {len(predicted)}/{len(windows)} windows at full resolution")
+
+        if temp_meta is not None:
+            return convert_to_dst_type(output, temp_meta, device=device)[0]
+        return output
+
+
+def get_dynunet_receptive_field(network: torch.nn.Module) -> Tuple[int]:
+    """
+    Receptive field (in voxels, per spatial dimension) of an output voxel of a DynUNet, from its kernel_size, strides
+    and upsample_kernel_size, as 2 * radius + 1 with the radius the largest distance of an input voxel which influences
+    the output voxel. Every level has two convolutions (UnetResBlock / UnetBasicBlock) in the encoder and two in the
+    decoder (with the kernel_size[1:] of the up path), the 1x1 convolutions of the residual paths and the output block
+    do not widen it. The transposed convolutions only look to one side, so they add their full width to the radius.
+    Checked against the gradients of real DynUNets in scripts/receptive_field_test.py.
+    """
+    dims = network.spatial_dims
+    kernels = [ensure_tuple_rep(k, dims) for k in network.kernel_size]
+    strides = [ensure_tuple_rep(s, dims) for s in network.strides]
+    upsample_kernels = [ensure_tuple_rep(u, dims) for u in network.upsample_kernel_size]
+    radius, jump = [0] * dims, [1] * dims
+    for k, s in zip(kernels, strides):
+        for d in range(dims):
+            radius[d] += (k[d] - 1) // 2 * jump[d]
+            jump[d] *= s[d]
+            radius[d] += (k[d] - 1) // 2 * jump[d]
+    for k, s, u in zip(reversed(kernels[1:]), reversed(strides[1:]), reversed(upsample_kernels)):
+        for d in range(dims):
+            jump[d] //= s[d]
+            radius[d] += (u[d] - 1) * jump[d] + 2 * ((k[d] - 1) // 2) * jump[d]
+    return tuple(2 * r + 1 for r in radius)
+
+
+def get_dynunet_total_stride(network: torch.nn.Module) -> Tuple[int]:
+    """Product of all strides per spatial dimension, the tile grid has to be aligned to it."""
+    total_stride = [1] * network.spatial_dims
+    for s in network.strides:
+        for d, s_d in enumerate(ensure_tuple_rep(s, network.spatial_dims)):
+            total_stride[d] *= s_d
+    return tuple(total_stride)
+
+
+def get_max_halo(roi_size: int, total_stride: int) -> int:
+    """Largest halo on the stride grid for which the core keeps at least half of roi_size (and at least one stride)."""
+    core_size = max((roi_size // 2) // total_stride * total_stride, total_stride)
+    return (roi_size - core_size) // 2 // total_stride * total_stride
+
+
+class HaloTiledInferer(SlidingWindowInferer):
+    """
+    Tiled inference without overlap blending: the image is split into non-overlapping cores and every core is predicted
+    from a tile of roi_size, which extends the core by a halo on each side. Only the core of each tile is kept, so
+    every output voxel is computed once (plus the halo) instead of about twice for an overlap of 0.25. The tiles at the
+    image border have their halo only on the inner side.
+
+    The halo defaults to the receptive field radius of the DynUNet (see get_dynunet_receptive_field), rounded up to
+    the total stride so the tiles stay on the downsampling grid of a full volume pass. The core has to keep at least
+    half of the roi_size, otherwise the tiles cost more than the overlap blending. If the roi_size is too small for the
+    full halo, or a call would compute more voxels than the sliding window with `overlap`, this inferer falls back to
+    the normal SlidingWindowInferer and logs it. With `strict` a too small roi_size raises a UserWarning instead,
+    after a fallback `core_size` is None and `halo` stays the derived one.
+
+    `exact` tells if the result matches a single full-volume pass, which needs the full halo and a network whose output
+    only depends on the receptive field (e.g. batch norm in eval mode). With instance norm every tile is normalized with
+    its own statistics, so the result differs from the sliding window (and the full-volume pass).
+    The redundant compute (predicted voxels / image voxels) of every call is logged next to the one of the sliding
+    window, and kept in `redundant_compute`.
+
+    With gradients enabled (training step) this falls back to the normal SlidingWindowInferer.
+
+    Args:
+        halo: halo per spatial dimension, defaults to the one derived from `network`.
+        network: the DynUNet to derive the halo and the total stride from.
+        sw_batch_size_fn: sets the sw_batch_size per volume shape, see update_sw_batch_size().
+        strict: raise a UserWarning instead of falling back if the roi_size is too small for the halo.
+    """
+
+    def __init__(
+        self,
+        roi_size,
+        sw_batch_size: int = 1,
+        overlap: float = 0.25,
+        mode="gaussian",
+        *,
+        halo: Sequence[int] | int | None = None,
+        network: torch.nn.Module | None = None,
+        sw_batch_size_fn: Callable | None = None,
+        strict: bool = False,
+        **kwargs,
+    ):
+        super().__init__(roi_size, sw_batch_size=sw_batch_size, overlap=overlap, mode=mode, **kwargs)
+        self.sw_batch_size_fn = sw_batch_size_fn
+        self.sw_batch_sizes = {}
+        if network is not None:
+            spatial_dims = network.spatial_dims
+            self.total_stride = get_dynunet_total_stride(network)
+            radius = tuple(r // 2 for r in get_dynunet_receptive_field(network))
+            has_instance_norm = any(isinstance(m, torch.nn.modules.instancenorm._InstanceNorm) for m in network.modules())
+        else:
+            assert halo is not None, "The HaloTiledInferer needs either the halo or the network"
+            spatial_dims = len(ensure_tuple(roi_size))
+            self.total_stride = (1,) * spatial_dims
+            radius = ensure_tuple_rep(halo, spatial_dims)
+            has_instance_norm = False
+        roi_size = ensure_tuple_rep(roi_size, spatial_dims)
+        if halo is None:
+            halo = tuple(-(-r // t) * t for r, t in zip(radius, self.total_stride))
+        halo = ensure_tuple_rep(halo, spatial_dims)
+        self.halo = halo
+        max_halo = tuple(get_max_halo(r, t) for r, t in zip(roi_size, self.total_stride))
+        self.fallback = any(h > m for h, m in zip(halo, max_halo))
+        # Without a tiling there is no core size, the halo stays the derived one
+        self.core_size = None
+        if not self.fallback:
+            self.core_size = tuple((r - 2 * h) // t * t for r, h, t in zip(roi_size, halo, self.total_stride))
+        self.exact = not self.fallback and not has_instance_norm and all(h >= r for h, r in zip(halo, radius))
+        if self.fallback:
+            min_roi_size = tuple(
+                max(r, next(m for m in itertools.count(t, t) if get_max_halo(m, t) >= h))
+                for r, h, t in zip(roi_size, halo, self.total_stride)
+            )
+            message = (
+                f"The roi_size {roi_size} is too small for the halo {halo} (receptive field radius {radius}), "
+                f"the HaloTiledInferer needs a roi_size of at least {min_roi_size}"
+            )
+            if strict:
+                raise UserWarning(message)
+            logger.warning(f"{message}, it falls back to the sliding window and does not tile with a halo")
+        elif has_instance_norm:
+            logger.warning("The network uses instance norm, the halo tiles differ from the sliding window result")
+        self.redundant_compute = None
+
+    def get_tiles(self, image_size: Sequence[int], roi_size: Sequence[int]) -> List[Tuple[Tuple[slice], Tuple[slice]]]:
+        """
+        Returns (tile slices, core slices relative to the tile) of all tiles, the cores cover the image once.
+        The first and the last tile per dimension have their halo only on the inner side, the tile starts are unique.
+        """
+        per_dim = []
+        for size, roi, halo, core_size in zip(image_size, roi_size, self.halo, self.core_size):
+            if size <= roi:
+                per_dim.append([(slice(0, size), slice(0, size))])
+                continue
+            core_end = halo + core_size
+            tiles = [(slice(0, roi), slice(0, core_end))]
+            while core_end < size:
+                core_start, start = core_end, core_end - halo
+                if start + roi >= size:
+                    # The last tile ends at the image border, only it may be shifted off the stride grid
+                    start = size - roi
+                    core_end = size
+                else:
+                    core_end = core_start + core_size
+                tiles.append((slice(start, start + roi), slice(core_start - start, core_end - start)))
+            per_dim.append(tiles)
+        tiles = []
+        for combination in np.ndindex(*[len(t) for t in per_dim]):
+            dims = [per_dim[d][i] for d, i in enumerate(combination)]
+            tiles.append((tuple(t for t, _ in dims), tuple(c for _, c in dims)))
+        return tiles
+
+    def __call__(self, inputs: torch.Tensor, network: Callable, *args, **kwargs) -> torch.Tensor:
+        roi_size = ensure_tuple_rep(self.roi_size, len(inputs.shape) - 2)
+        update_sw_batch_size(self, inputs.shape[2:])
+        if (
+            self.fallback
+            or torch.is_grad_enabled()
+            or any(inputs.shape[2 + i] < roi_size[i] for i in range(len(roi_size)))
+        ):
+            return super().__call__(inputs, network, *args, **kwargs)
+
+        image_size = tuple(inputs.shape[2:])
+        tiles = self.get_tiles(image_size, roi_size)
+        image_voxels = float(np.prod(image_size))
+        roi_voxels = float(np.prod(roi_size))
+        redundant_compute = len(tiles) * roi_voxels / image_voxels
+        sw_redundant_compute = len(get_window_slices(image_size, roi_size, self.overlap)) * roi_voxels / image_voxels
+        if redundant_compute > sw_redundant_compute:
+            logger.info(
+                f"Halo tiles would compute {redundant_compute:.2f}x the image, more than the sliding window "
+                f"({sw_redundant_compute:.2f}x), falling back to the sliding window"
+            )
+            self.redundant_compute = sw_redundant_compute
+            return super().__call__(inputs, network, *args, **kwargs)
+        self.redundant_compute = redundant_compute
+
+        temp_meta = None
+        if isinstance(inputs, MetaTensor):
+            temp_meta = MetaTensor([]).copy_meta_from(inputs, copy_attr=False)
+        inputs_t = convert_data_type(inputs, torch.Tensor)[0]
+        sw_device = self.sw_device or inputs_t.device
+        device = self.device or inputs_t.device
+        batch_size = inputs_t.shape[0]
+
+        windows = [(b, tile) for b in range(batch_size) for tile, _ in tiles]
+        output = None
+        for pos, logits in predict_windows(inputs_t, network, windows, self.sw_batch_size, sw_device, *args, **kwargs):
+            b, tile = windows[pos]
+            core = tiles[pos % len(tiles)][1]
+            if output is None:
+                output = torch.zeros((batch_size, logits.shape[1], *image_size), device=device)
+            core_in_image = tuple(slice(t.start + c.start, t.start + c.stop) for t, c in zip(tile, core))
+            output[(slice(b, b + 1), slice(None), *core_in_image)] = logits[(slice(None), slice(None), *core)].to(
+                device=device, dtype=torch.float32
+            )
+
+        logger.info(
+            f"Halo tiled inference: {len(tiles)} tiles with halo {self.halo}, redundant compute "
+            f"{self.redundant_compute:.2f}x (sliding window with overlap {self.overlap}: {sw_redundant_compute:.2f}x)"
+        )
+
+        if temp_meta is not None:
+            return convert_to_dst_type(output, temp_meta, device=device)[0]
+        return output
@@ -22,16 +22,16 @@ from monai.data import decollate_batch, list_data_collate
 from monai.engines import SupervisedEvaluator, SupervisedTrainer
 from monai.engines.utils import IterationEvents
 from monai.losses import DiceLoss
+from monai.networks.utils import one_hot
 from monai.transforms import Compose
 from monai.utils.enums import CommonKeys
 
 from sw_fastedit.click_definitions import ClickGenerationStrategy, StoppingCriterion
+from sw_fastedit.transforms import get_label_names
 from sw_fastedit.utils.helper import get_gpu_usage, timeit
 
 logger = logging.getLogger("sw_fastedit")
 
-# WARNING Code is not tested on batch_size > 1!!!!!!!!!!!!
-
 
 class Interaction:
     """
@@ -47,7 +47,7 @@ class Interaction:
 
     Args:
         transforms: execute additional transformation during every iteration (before train).
-            Typically, several Tensor based transforms composed by `Compose`.
+            Typically, several Tensor based transforms composed by `Compose`. They get the whole batch (BCHWD).
         train: True for training mode or False for evaluation mode
         label_names: Dict of label names
         max_interactions: maximum number of interactions per iteration
@@ -66,6 +66,8 @@ class Interaction:
         loss_function: loss_function to the ran after every interaction to determine if the clicks actually help the model
         non_interactive: set it for non-interactive runs, where no clicks shall be added. The Interaction class only prints the
             shape of image and label, then resumes normal training.
+        inference_network: inference-optimized variant of the engine's network (see get_inference_network), used for the
+            no-grad click passes instead of engine.network. It has to share the parameters with engine.network.
     """
 
     def __init__(
@@ -87,6 +89,7 @@ class Interaction:
         nifti_post_transform=None,
         loss_function=None,
         non_interactive=False,
+        inference_network=None,
     ) -> None:
         self.deepgrow_probability = deepgrow_probability
         self.transforms = Compose(transforms) if not isinstance(transforms, Compose) else transforms  # click transforms
@@ -105,7 +108,9 @@ class Interaction:
         self.loss_stopping_threshold = loss_stopping_threshold
         self.click_generation_strategy_key = click_generation_strategy_key
         self.dice_loss_function = DiceLoss(include_background=False, to_onehot_y=True, softmax=True)
+        self.discrete_dice_loss_function = DiceLoss(include_background=False, to_onehot_y=True)
         self.non_interactive = non_interactive
+        self.inference_network = inference_network
 
     @timeit
     def __call__(
@@ -144,6 +149,9 @@ class Interaction:
             batchdata[CommonKeys.LABEL] = labels
 
             if iteration == 0:
+                if hasattr(engine.inferer, "reset"):
+                    # Drop the cached windows of the previous volume (IncrementalSlidingWindowInferer)
+                    engine.inferer.reset()
                 logger.info("inputs.shape is {}".format(inputs.shape))
                 logger.info("labels.shape is {}".format(labels.shape))
                 # Make sure the signal is empty in the first iteration assertion holds
@@ -151,7 +159,7 @@ class Interaction:
                 logger.info(f"image file name: {batchdata['image_meta_dict']['filename_or_obj']}")
                 logger.info(f"label file name: {batchdata['label_meta_dict']['filename_or_obj']}")
 
-                for i in range(len(batchdata["label"][0])):
+                for i in range(len(batchdata["label"])):
                     if torch.sum(batchdata["label"][i, 0]) < 0.1:
                         logger.warning("No valid labels for this sample (probably due to crop)")
 
@@ -200,18 +208,24 @@ class Interaction:
 
             engine.fire_event(IterationEvents.INNER_ITERATION_STARTED)
             engine.network.eval()
+            network = self.inference_network if self.inference_network is not None else engine.network
 
             # Forward Pass
             with torch.no_grad():
                 if engine.amp:
                     with torch.cuda.amp.autocast():
-                        predictions = engine.inferer(inputs, engine.network)
+                        predictions = engine.inferer(inputs, network)
                 else:
-                    predictions = engine.inferer(inputs, engine.network)
+                    predictions = engine.inferer(inputs, network)
 
             batchdata[CommonKeys.PRED] = predictions
 
-            last_dice_loss = self.dice_loss_function(batchdata[CommonKeys.PRED], batchdata[CommonKeys.LABEL]).item()
+            if predictions.shape[1] == 1:
+                # The inferer already returned the label map (e.g. MemmapSlidingWindowInferer)
+                one_hot_predictions = one_hot(predictions.long(), num_classes=len(get_label_names(batchdata)))
+                last_dice_loss = self.discrete_dice_loss_function(one_hot_predictions, batchdata[CommonKeys.LABEL]).item()
+            else:
+                last_dice_loss = self.dice_loss_function(batchdata[CommonKeys.PRED], batchdata[CommonKeys.LABEL]).item()
             logger.info(
                 f"It: {iteration} {self.dice_loss_function.__class__.__name__}: {last_dice_loss:.4f} Epoch: {engine.state.epoch}"
             )
@@ -229,16 +243,12 @@ class Interaction:
 
                 self.debug_viz(inputs, labels, tmp_batchdata[CommonKeys.PRED], iteration)
 
-            # decollate/collate batchdata to execute click transforms
-            batchdata_list = decollate_batch(batchdata)
-            for i in range(len(batchdata_list)):
-                batchdata_list[i][self.click_probability_key] = self.deepgrow_probability
-                batchdata_list[i][self.click_generation_strategy_key] = self.click_generation_strategy.value
-                start = time.time()
-                batchdata_list[i] = self.transforms(batchdata_list[i])  # Apply click transform
-                logger.debug(f"Click transform took: {time.time() - start:.2} seconds")
-
-            batchdata = list_data_collate(batchdata_list)
+            # The click transforms work on the whole batch, no need to decollate
+            batchdata[self.click_probability_key] = self.deepgrow_probability
+            batchdata[self.click_generation_strategy_key] = self.click_generation_strategy.value
+            start = time.time()
+            batchdata = self.transforms(batchdata)  # Apply click transform
+            logger.debug(f"Click transform took: {time.time() - start:.2} seconds")
 
             engine.fire_event(IterationEvents.INNER_ITERATION_COMPLETED)
 
@@ -246,7 +256,13 @@ class Interaction:
 
         logger.debug(f"Interaction took {time.time()- before_it:.2f} seconds..")
         engine.state.batch = batchdata
-        return engine._iteration(engine, batchdata)  # train network with the final iteration cycle
+        if hasattr(engine.inferer, "final_pass"):
+            # Allow the CascadeSlidingWindowInferer to run the full resolution pass for the final prediction
+            engine.inferer.final_pass = True
+        output = engine._iteration(engine, batchdata)  # train network with the final iteration cycle
+        if hasattr(engine.inferer, "reset"):
+            engine.inferer.reset()
+        return output
 
     def debug_viz(self, inputs, labels, preds, j):
         self.save_nifti_file(f"{self.nifti_dir}/im", inputs[0, 0].cpu().detach().numpy())
@@ -11,28 +11,28 @@
 
 from __future__ import annotations
 
-import gc
 import logging
+import math
 from typing import Dict, Hashable, List, Mapping, Tuple
 
 import torch
 from monai.config import KeysCollection
-from monai.data import MetaTensor, PatchIterd
-from monai.losses import DiceLoss
+from monai.data import MetaTensor
 from monai.networks.layers import GaussianFilter
 from monai.transforms import (
-    Activationsd,
-    AsDiscreted,
-    Compose,
     MapTransform,
     Randomizable,
 )
 from monai.utils.enums import CommonKeys
 
-from sw_fastedit.click_definitions import LABELS_KEY, ClickGenerationStrategy
-from sw_fastedit.utils.distance_transform import get_random_choice_from_tensor
-from monai.transforms.utils import distance_transform_edt
-from sw_fastedit.utils.helper import get_global_coordinates_from_patch_coordinates, get_tensor_at_coordinates, timeit
+from sw_fastedit.click_definitions import LABELS_KEY, NUM_STAMPED_CLICKS_KEY, ClickGenerationStrategy
+from sw_fastedit.utils.distance_transform import distance_transform_edt, get_random_choice_from_tensor
+from sw_fastedit.utils.helper import (
+    get_bounding_box_coordinates,
+    get_global_coordinates_from_patch_coordinates,
+    get_tensor_at_coordinates,
+    timeit,
+)
 
 # from monai.transforms import DistanceTransformEDT
 
@@ -49,6 +49,44 @@ def get_guidance_tensor_for_key_label(data, key_label, device) -> torch.Tensor:
     return tmp_gui
 
 
+def get_batched_guidance_for_key_label(data, key_label, batch_size, device) -> List[torch.Tensor]:
+    """Returns the guidance tensor of every sample in the batch, without the -1 padding of `pad_batched_guidance`."""
+    batched_gui = data.get(key_label)
+    if batched_gui is None or len(batched_gui) == 0:
+        return [torch.tensor([], dtype=torch.int32, device=device) for _ in range(batch_size)]
+    assert len(batched_gui) == batch_size, f"Expected guidance for {batch_size} samples, got {len(batched_gui)}"
+    guidance = []
+    for tmp_gui in batched_gui:
+        tmp_gui = torch.as_tensor(tmp_gui, dtype=torch.int32, device=device)
+        if tmp_gui.numel():
+            tmp_gui = tmp_gui[torch.all(tmp_gui >= 0, dim=-1)]
+        guidance.append(tmp_gui)
+    return guidance
+
+
+def pad_batched_guidance(guidance: List[torch.Tensor], point_size: int, device) -> torch.Tensor:
+    """
+    Stacks the guidance of all samples into one tensor of shape (B, N, point_size). Samples with less clicks
+    are padded with -1, so the guidance can be collated / decollated like every other tensor in the batch.
+    """
+    max_clicks = max(len(tmp_gui) for tmp_gui in guidance)
+    padded = torch.full((len(guidance), max_clicks, point_size), -1, dtype=torch.int32, device=device)
+    for b, tmp_gui in enumerate(guidance):
+        if len(tmp_gui):
+            padded[b, : len(tmp_gui)] = tmp_gui
+    return padded
+
+
+def get_label_names(data) -> Dict[str, int]:
+    """The label names of a batch get collated into tensors, however all samples share the same label names."""
+    label_names = {}
+    for key_label, val_label in data[LABELS_KEY].items():
+        if isinstance(val_label, torch.Tensor) and val_label.dim():
+            val_label = val_label[0]
+        label_names[key_label] = int(val_label)
+    return label_names
+
+
 class AddEmptySignalChannels(MapTransform):
     def __init__(self, device, keys: KeysCollection = None):
         """
@@ -140,11 +178,52 @@ class NormalizeLabelsInDatasetd(MapTransform):
         return data
 
 
+# Gaussian of a single click per (sigma, dimensions, device), see get_guidance_signal_kernel
+_guidance_signal_kernels = {}
+
+
+def get_guidance_signal_kernel(sigma: int, dimensions: int, device) -> torch.Tensor:
+    """
+    Returns the GaussianFilter response of a single click (not normalized) cropped to its support. The filter is linear
+    and pads with zeros, so the sum of these kernels stamped at the clicks is the same as filtering the click volume.
+    The kernel is only computed once per sigma.
+    """
+    key = (sigma, dimensions, str(device))
+    if key not in _guidance_signal_kernels:
+        # GaussianFilter truncates the kernel at 4 sigma
+        radius = int(math.ceil(4 * sigma)) + 1
+        kernel = torch.zeros((2 * radius + 1,) * dimensions, device=device)
+        kernel[(radius,) * dimensions] = 1.0
+        if sigma != 0:
+            pt_gaussian = GaussianFilter(dimensions, sigma=sigma).to(device=device)
+            kernel = pt_gaussian(kernel.unsqueeze(0).unsqueeze(0)).squeeze(0).squeeze(0)
+        # Crop the kernel to its support
+        support = torch.max(torch.abs(torch.nonzero(kernel) - radius)).item()
+        kernel = kernel[(slice(radius - support, radius + support + 1),) * dimensions]
+        _guidance_signal_kernels[key] = kernel
+    return _guidance_signal_kernels[key]
+
+
+def stamp_guidance_signal(signal: torch.Tensor, point: List[int], kernel: torch.Tensor) -> None:
+    """Adds the kernel centered at point to signal (in place), cropped at the borders of signal."""
+    radius = kernel.shape[0] // 2
+    signal_slices = []
+    kernel_slices = []
+    for p, size in zip(point, signal.shape):
+        start, stop = max(p - radius, 0), min(p + radius + 1, size)
+        signal_slices.append(slice(start, stop))
+        kernel_slices.append(slice(start - (p - radius), stop - (p - radius)))
+    signal[tuple(signal_slices)] += kernel[tuple(kernel_slices)]
+
+
 class AddGuidanceSignal(MapTransform):
     """
     Add Guidance signal for input image.
 
-    Based on the "guidance" points, apply Gaussian to them and add them as new channel for input image.
+    Based on the "guidance" points, stamp a Gaussian (or disk) around each of them into the signal channel of the label.
+    The result is the same as applying the GaussianFilter to the click volume, but the Gaussians are only added on
+    their support. A signal channel is kept between the click iterations and only rendered again when its label got new
+    clicks, the number of stamped clicks per label is stored in data[NUM_STAMPED_CLICKS_KEY].
 
     Args:
         sigma: standard deviation for Gaussian kernel.
@@ -168,116 +247,79 @@ class AddGuidanceSignal(MapTransform):
         self.disks = disks
         self.device = device
 
-    def _get_corrective_signal(self, image, guidance, key_label):
-        dimensions = 3 if len(image.shape) > 3 else 2
+    def _stamp_corrective_signal(self, signal, guidance, num_stamped: int) -> int:
+        """
+        Renders the signal of all clicks of guidance into signal if there are clicks which have not been stamped yet.
+        Same result as filtering the click volume with the GaussianFilter: the Gaussians of the (unique) clicks are
+        summed, then min-max normalized over the volume and (for disks) thresholded. Returns the number of stamped clicks.
+        """
+        dimensions = len(signal.shape)
         assert (
             type(guidance) is torch.Tensor or type(guidance) is MetaTensor
         ), f"guidance is {type(guidance)}, value {guidance}"
 
-        if guidance.size()[0]:
-            first_point_size = guidance[0].numel()
-            if dimensions == 3:
-                # Assume channel is first and depth is last CHWD
-                # Assuming the guidance has either shape (1, x, y , z) or (x, y, z)
-                assert (
-                    first_point_size == 4 or first_point_size == 3
-                ), f"first_point_size is {first_point_size}, first_point is {guidance[0]}"
-                signal = torch.zeros(
-                    (1, image.shape[-3], image.shape[-2], image.shape[-1]),
-                    device=self.device,
-                )
-            else:
-                assert first_point_size == 3, f"first_point_size is {first_point_size}, first_point is {guidance[0]}"
-                signal = torch.zeros((1, image.shape[-2], image.shape[-1]), device=self.device)
-
-            sshape = signal.shape
-
-            for point in guidance:
-                if torch.any(point < 0):
-                    continue
-                if dimensions == 3:
-                    # Making sure points fall inside the image dimension
-                    p1 = max(0, min(int(point[-3]), sshape[-3] - 1))
-                    p2 = max(0, min(int(point[-2]), sshape[-2] - 1))
-                    p3 = max(0, min(int(point[-1]), sshape[-1] - 1))
-                    signal[:, p1, p2, p3] = 1.0
-                else:
-                    p1 = max(0, min(int(point[-2]), sshape[-2] - 1))
-                    p2 = max(0, min(int(point[-1]), sshape[-1] - 1))
-                    signal[:, p1, p2] = 1.0
-
-            # Apply a Gaussian filter to the signal
-            if torch.max(signal[0]) > 0:
-                signal_tensor = signal[0]
-                if self.sigma != 0:
-                    pt_gaussian = GaussianFilter(len(signal_tensor.shape), sigma=self.sigma)
-                    signal_tensor = pt_gaussian(signal_tensor.unsqueeze(0).unsqueeze(0))
-                    signal_tensor = signal_tensor.squeeze(0).squeeze(0)
-
-                signal[0] = signal_tensor
-                signal[0] = (signal[0] - torch.min(signal[0])) / (torch.max(signal[0]) - torch.min(signal[0]))
-                if self.disks:
-                    signal[0] = (signal[0] > 0.1) * 1.0  # 0.1 with sigma=1 --> radius = 3, otherwise it is a cube
-
-            if not (torch.min(signal[0]).item() >= 0 and torch.max(signal[0]).item() <= 1.0):
-                raise UserWarning(
-                    "[WARNING] Bad signal values",
-                    torch.min(signal[0]),
-                    torch.max(signal[0]),
-                )
-            if signal is None:
-                raise UserWarning("[ERROR] Signal is None")
-            return signal
-        else:
-            if dimensions == 3:
-                signal = torch.zeros(
-                    (1, image.shape[-3], image.shape[-2], image.shape[-1]),
-                    device=self.device,
-                )
-            else:
-                signal = torch.zeros((1, image.shape[-2], image.shape[-1]), device=self.device)
-            if signal is None:
-                print("[ERROR] Signal is None")
-            return signal
+        if len(guidance) == num_stamped:
+            return num_stamped
+        # The normalization depends on all clicks, so the signal is always rendered again, only on the click supports
+        signal.zero_()
+        if not len(guidance):
+            return 0
+
+        # Assume channel is first and depth is last CHWD
+        # Assuming the guidance has either shape (1, x, y , z) or (x, y, z)
+        first_point_size = guidance[0].numel()
+        assert first_point_size in [dimensions, dimensions + 1], f"first_point_size is {first_point_size}, first_point is {guidance[0]}"
+        kernel = get_guidance_signal_kernel(self.sigma, dimensions, signal.device)
+
+        points = set()
+        for point in guidance.tolist():
+            if any(p < 0 for p in point):
+                continue
+            # Making sure points fall inside the image dimension
+            points.add(tuple(max(0, min(int(p), size - 1)) for p, size in zip(point[-dimensions:], signal.shape)))
+        for point in points:
+            stamp_guidance_signal(signal, point, kernel)
+        if points:
+            min_value, max_value = torch.min(signal), torch.max(signal)
+            signal.sub_(min_value).div_(max_value - min_value)
+            if self.disks:
+                signal.copy_((signal > 0.1) * 1.0)  # 0.1 with sigma=1 --> radius = 3, otherwise it is a cube
+        return len(guidance)
 
     @timeit
     def __call__(self, data: Mapping[Hashable, torch.Tensor]) -> Mapping[Hashable, torch.Tensor]:
         for key in self.key_iterator(data):
             if key == "image":
                 image = data[key]
-                assert image.is_cuda
-                tmp_image = image[0 : 0 + self.number_intensity_ch, ...]
+                # Either a single image CHWD or a whole batch BCHWD (only supported for 3D)
+                batched = len(image.shape) == 5
+                images = image if batched else image[None]
+                label_names = get_label_names(data)
+                assert images.shape[1] == self.number_intensity_ch + len(label_names)
+                all_num_stamped = data.get(NUM_STAMPED_CLICKS_KEY, {})
 
                 # e.g. {'spleen': '[[1, 202, 190, 192], [2, 224, 212, 192], [1, 242, 202, 192], [1, 256, 184, 192], [2.0, 258, 198, 118]]',
                 # 'background': '[[257, 0, 98, 118], [1.0, 223, 303, 86]]'}
 
-                for _, (label_key, _) in enumerate(data[LABELS_KEY].items()):
-                    # label_guidance = data[label_key]
-                    label_guidance = get_guidance_tensor_for_key_label(data, label_key, self.device)
-                    logger.debug(f"Converting guidance for label {label_key}:{label_guidance} into a guidance signal..")
-
-                    if label_guidance is not None and label_guidance.numel():
-                        signal = self._get_corrective_signal(
-                            image,
-                            label_guidance.to(device=self.device),
-                            key_label=label_key,
-                        )
-                        assert torch.sum(signal) > 0
+                for idx, label_key in enumerate(label_names.keys()):
+                    if batched:
+                        batched_guidance = get_batched_guidance_for_key_label(data, label_key, len(images), self.device)
                     else:
-                        # TODO can speed this up here
-                        signal = self._get_corrective_signal(
-                            image,
-                            torch.Tensor([]).to(device=self.device),
-                            key_label=label_key,
+                        batched_guidance = [get_guidance_tensor_for_key_label(data, label_key, self.device)]
+                    num_stamped = torch.as_tensor(all_num_stamped.get(label_key, 0)).expand(len(images)).tolist()
+
+                    for b, label_guidance in enumerate(batched_guidance):
+                        logger.debug(f"Stamping guidance for label {label_key}:{label_guidance} into the guidance signal..")
+                        # Signal channel of the label, updated in place
+                        signal = images[b, self.number_intensity_ch + idx]
+                        num_stamped[b] = self._stamp_corrective_signal(
+                            signal, label_guidance.to(device=signal.device), num_stamped[b]
                         )
+                        if num_stamped[b]:
+                            assert torch.max(signal) > 0
 
-                    assert signal.is_cuda
-                    assert tmp_image.is_cuda
-                    tmp_image = torch.cat([tmp_image, signal], dim=0)
-                    if isinstance(data[key], MetaTensor):
-                        data[key].array = tmp_image
-                    else:
-                        data[key] = tmp_image
+                    all_num_stamped[label_key] = torch.tensor(num_stamped) if batched else num_stamped[0]
+                data[NUM_STAMPED_CLICKS_KEY] = all_num_stamped
                 return data
             else:
                 raise UserWarning("This transform only applies to image key")
@@ -288,10 +330,15 @@ class FindDiscrepancyRegions(MapTransform):
     """
     Find discrepancy between prediction and actual during click interactions during training.
 
+    The discrepancies of all labels are computed in one vectorized pass on the discrete label and prediction
+    and stored as bool masks: data[discrepancy_key][label_key] = [FN, FP], each with the shape of the label.
+
     Args:
         pred_key: key to prediction source.
         discrepancy_key: key to store discrepancies found between label and prediction.
         device: device this transform shall run on.
+        bounding_box_key: if set, the bounding box (plus a margin of one voxel) of every discrepancy mask is stored
+            there as data[bounding_box_key][label_key] = [FN boxes, FP boxes], see get_bounding_boxes.
     """
 
     def __init__(
@@ -301,22 +348,38 @@ class FindDiscrepancyRegions(MapTransform):
         discrepancy_key: str = "discrepancy",
         allow_missing_keys: bool = False,
         device=None,
+        bounding_box_key: str | None = None,
     ):
         super().__init__(keys, allow_missing_keys)
         self.pred_key = pred_key
         self.discrepancy_key = discrepancy_key
         self.device = device
+        self.bounding_box_key = bounding_box_key
 
-    def disparity(self, label, pred):
-        disparity = label - pred
-        # +1 means predicted label is not part of the ground truth
-        # -1 means predicted label missed that region of the ground truth
-        pos_disparity = (disparity > 0).to(dtype=torch.float32, device=self.device)  # FN
-        neg_disparity = (disparity < 0).to(dtype=torch.float32, device=self.device)  # FP
-        return [pos_disparity, neg_disparity]
-
-    def _apply(self, label, pred):
-        return self.disparity(label, pred)
+    def disparity(self, label: torch.Tensor, pred: torch.Tensor, label_values: List[int]) -> torch.Tensor:
+        """
+        Returns the FN and FP masks of all label values as a bool tensor of shape (2, len(label_values), *label.shape).
+        """
+        label_values = torch.as_tensor(label_values, device=label.device).view(-1, *([1] * len(label.shape)))
+        # Only voxels where prediction and label differ can be part of a discrepancy
+        mismatch = (label != pred).unsqueeze(0)
+        # FN: the voxel has the label value, but the prediction missed it
+        pos_disparity = (label.unsqueeze(0) == label_values) & mismatch
+        # FP: the voxel was predicted as the label value, but belongs to another label
+        neg_disparity = (pred.unsqueeze(0) == label_values) & mismatch
+        return torch.stack((pos_disparity, neg_disparity))
+
+    def get_bounding_boxes(self, masks: torch.Tensor) -> torch.Tensor:
+        """Returns the bounding boxes of the masks (BCHWD) as a tensor (B, 4, 2), empty masks are filled with -1."""
+        bounding_boxes = torch.full((len(masks), len(masks.shape) - 1, 2), -1, dtype=torch.int64)
+        for b, mask in enumerate(masks):
+            bounding_box = get_bounding_box_coordinates(mask, margin=1)
+            if bounding_box is not None:
+                bounding_boxes[b] = bounding_box
+        return bounding_boxes
+
+    def _apply(self, label, pred, label_values):
+        return self.disparity(label, pred, label_values)
 
     @timeit
     def __call__(self, data: Mapping[Hashable, torch.Tensor]) -> Mapping[Hashable, torch.Tensor]:
@@ -327,36 +390,27 @@ class FindDiscrepancyRegions(MapTransform):
                     or (type(data[key]) is MetaTensor)
                     and (type(data[self.pred_key]) is torch.Tensor or type(data[self.pred_key]) is MetaTensor)
                 )
+                label_names = get_label_names(data)
+                label = data[key].detach().as_tensor() if isinstance(data[key], MetaTensor) else data[key].detach()
+                pred = data[self.pred_key].detach()
+                pred = pred.as_tensor() if isinstance(pred, MetaTensor) else pred
+                # Label and prediction are discrete, so rounding only guards against float noise
+                discrepancies = self._apply(
+                    torch.round(label).to(dtype=torch.int32),
+                    torch.round(pred).to(dtype=torch.int32, device=label.device),
+                    list(label_names.values()),
+                ).to(device=self.device)
+
                 all_discrepancies = {}
-                assert data[key].is_cuda and data["pred"].is_cuda
-
-                for _, (label_key, label_value) in enumerate(data[LABELS_KEY].items()):
-                    if label_key != "background":
-                        label = torch.clone(data[key].detach())
-                        # Label should be represented in 1
-                        label[label != label_value] = 0
-                        label = (label > 0.5).to(dtype=torch.float32)
-
-                        # Taking single prediction
-                        pred = torch.clone(data[self.pred_key].detach())
-                        pred[pred != label_value] = 0
-                        # Prediction should be represented in one
-                        pred = (pred > 0.5).to(dtype=torch.float32)
-                    else:
-                        # Taking single label
-                        label = torch.clone(data[key].detach())
-                        label[label != label_value] = 1
-                        label = 1 - label
-                        # Label should be represented in 1
-                        label = (label > 0.5).to(dtype=torch.float32)
-                        # Taking single prediction
-                        pred = torch.clone(data[self.pred_key].detach())
-                        pred[pred != label_value] = 1
-                        pred = 1 - pred
-                        # Prediction should be represented in one
-                        pred = (pred > 0.5).to(dtype=torch.float32)
-                    all_discrepancies[label_key] = self._apply(label, pred)
+                all_bounding_boxes = {}
+                for idx, label_key in enumerate(label_names.keys()):
+                    all_discrepancies[label_key] = [discrepancies[0, idx], discrepancies[1, idx]]
+                    if self.bounding_box_key is not None:
+                        # One box per sample for the FN and the FP mask
+                        all_bounding_boxes[label_key] = [self.get_bounding_boxes(discrepancies[i, idx]) for i in range(2)]
                 data[self.discrepancy_key] = all_discrepancies
+                if self.bounding_box_key is not None:
+                    data[self.bounding_box_key] = all_bounding_boxes
                 return data
             else:
                 logger.error("This transform only applies to 'label' key")
@@ -368,12 +422,16 @@ class AddGuidance(Randomizable, MapTransform):
     Add guidance based on different click generation strategies.
 
     Args:
-        discrepancy_key: key to discrepancy map between label and prediction shape (2, C, H, W, D) or (2, C, H, W)
+        discrepancy_key: key to discrepancy map between label and prediction, [pos, neg] with shape (B, C, H, W, D) each
         probability_key: key to click/interaction probability, shape (1)
         device: device this transform shall run on.
         click_generation_strategy_key: sets the used ClickGenerationStrategy.
         patch_size: Only relevant for the patch-based click generation strategy. Sets the size of the cropped patches
         on which then further analysis is run.
+        patch_overlap: Only relevant for the patch-based click generation strategy. Overlap of neighbouring patches,
+            0 means a grid of disjoint patches.
+        bounding_box_key: key to the bounding boxes of the discrepancies stored by FindDiscrepancyRegions.
+            If set, the corrective strategies use them instead of searching the discrepancy again.
     """
 
     def __init__(
@@ -385,9 +443,12 @@ class AddGuidance(Randomizable, MapTransform):
         device=None,
         click_generation_strategy_key: str = "click_generation_strategy",
         patch_size: Tuple[int] = (128, 128, 128),
+        patch_overlap: float = 0.0,
+        bounding_box_key: str | None = None,
     ):
         super().__init__(keys, allow_missing_keys)
         self.discrepancy_key = discrepancy_key
+        self.bounding_box_key = bounding_box_key
         self.probability_key = probability_key
         self._will_interact = None
         self.is_other = None
@@ -395,43 +456,57 @@ class AddGuidance(Randomizable, MapTransform):
         self.device = device
         self.click_generation_strategy_key = click_generation_strategy_key
         self.patch_size = patch_size
+        assert 0 <= patch_overlap < 1, f"patch_overlap has to be in [0, 1), got {patch_overlap}"
+        self.patch_overlap = patch_overlap
 
     def randomize(self, data: Mapping[Hashable, torch.Tensor]):
         probability = data[self.probability_key]
-        self._will_interact = self.R.choice([True, False], p=[probability, 1.0 - probability])
+        # One decision per sample of the batch
+        self._will_interact = [
+            self.R.choice([True, False], p=[probability, 1.0 - probability]) for _ in range(len(data[CommonKeys.IMAGE]))
+        ]
 
-    def find_guidance(self, discrepancy) -> List[int | List[int]] | None:
-        assert discrepancy.is_cuda
-        distance = distance_transform_edt(discrepancy)
+    def find_guidance(self, discrepancy, bounding_box: torch.Tensor | None = None) -> List[int | List[int]] | None:
+        """
+        Samples a click from the distance transform of the discrepancy (CHWD).
+        The distance transform and the sampling only run on the bounding box of the discrepancy plus a margin of one
+        voxel. All voxels outside of it are zero, so the distances inside are the same as for the full volume.
+        The bounding box is computed here unless it is passed in.
+        """
+        coordinates = bounding_box if bounding_box is not None else get_bounding_box_coordinates(discrepancy, margin=1)
+        if coordinates is None:
+            return None
+        distance = distance_transform_edt(get_tensor_at_coordinates(discrepancy, coordinates=coordinates))
         t_index, t_value = get_random_choice_from_tensor(distance)
-        return t_index
+        if t_index is None:
+            return None
+        return [int(c) for c in get_global_coordinates_from_patch_coordinates(t_index, coordinates)]
+
+    def append_guidance(self, data: Dict, guidance: torch.Tensor, new_guidance: List[int]) -> torch.Tensor:
+        self.check_guidance_length(data, new_guidance)
+        return torch.cat(
+            (
+                guidance,
+                torch.tensor([new_guidance], dtype=torch.int32, device=guidance.device),
+            ),
+            0,
+        )
 
     def add_guidance_based_on_discrepancy(
         self,
         data: Dict,
         guidance: torch.Tensor,
-        key_label: str,
+        pos_discr: torch.Tensor,
         coordinates: torch.Tensor | None = None,
+        bounding_box: torch.Tensor | None = None,
     ) -> torch.Tensor:
         assert guidance.dtype == torch.int32
-        # Positive clicks of the segment in the iteration
-        discrepancy = data[self.discrepancy_key][key_label]
-        # idx 0 is positive discrepancy and idx 1 is negative discrepancy
-        pos_discr = discrepancy[0]
-
         if coordinates is None:
             # Add guidance to the current key label
-            if torch.sum(pos_discr) > 0:
-                tmp_gui = self.find_guidance(pos_discr)
-                self.check_guidance_length(data, tmp_gui)
+            if bounding_box is not None or torch.sum(pos_discr) > 0:
+                tmp_gui = self.find_guidance(pos_discr, bounding_box)
                 if tmp_gui is not None:
-                    guidance = torch.cat(
-                        (
-                            guidance,
-                            torch.tensor([tmp_gui], dtype=torch.int32, device=guidance.device),
-                        ),
-                        0,
-                    )
+                    guidance = self.append_guidance(data, guidance, tmp_gui)
         else:
             pos_discr = get_tensor_at_coordinates(pos_discr, coordinates=coordinates)
             if torch.sum(pos_discr) > 0:
@@ -439,32 +514,17 @@ class AddGuidance(Randomizable, MapTransform):
                 tmp_gui = self.find_guidance(pos_discr)
                 if tmp_gui is not None:
                     tmp_gui = get_global_coordinates_from_patch_coordinates(tmp_gui, coordinates)
-                    self.check_guidance_length(data, tmp_gui)
-                    guidance = torch.cat(
-                        (
-                            guidance,
-                            torch.tensor([tmp_gui], dtype=torch.int32, device=guidance.device),
-                        ),
-                        0,
-                    )
+                    guidance = self.append_guidance(data, guidance, tmp_gui)
         return guidance
 
     def add_guidance_based_on_label(self, data, guidance, label):
         assert guidance.dtype == torch.int32
         # Add guidance to the current key label
         if torch.sum(label) > 0:
-            assert label.is_cuda
             # generate a random sample
             tmp_gui_index, tmp_gui_value = get_random_choice_from_tensor(label)
             if tmp_gui_index is not None:
-                self.check_guidance_length(data, tmp_gui_index)
-                guidance = torch.cat(
-                    (
-                        guidance,
-                        torch.tensor([tmp_gui_index], dtype=torch.int32, device=guidance.device),
-                    ),
-                    0,
-                )
+                guidance = self.append_guidance(data, guidance, tmp_gui_index)
         return guidance
 
     def check_guidance_length(self, data, new_guidance):
@@ -476,84 +536,117 @@ class AddGuidance(Randomizable, MapTransform):
 
     @timeit
     def __call__(self, data: Mapping[Hashable, torch.Tensor]) -> Mapping[Hashable, torch.Tensor]:
+        """
+        Works on the whole batch, so image, label, pred and the discrepancies have the shape BCHWD.
+        The guidance of each label is stored as a tensor (B, N, 4) padded with -1, see `pad_batched_guidance`.
+        """
         click_generation_strategy = data[self.click_generation_strategy_key]
-
-        if click_generation_strategy == ClickGenerationStrategy.GLOBAL_NON_CORRECTIVE:
-            # uniform random sampling on label
-            for idx, (key_label, _) in enumerate(data[LABELS_KEY].items()):
-                tmp_gui = get_guidance_tensor_for_key_label(data, key_label, self.device)
-                data[key_label] = self.add_guidance_based_on_label(
-                    data, tmp_gui, data["label"].eq(idx).to(dtype=torch.int32)
-                )
-        elif (
-            click_generation_strategy == ClickGenerationStrategy.GLOBAL_CORRECTIVE
-            or click_generation_strategy == ClickGenerationStrategy.DEEPGROW_GLOBAL_CORRECTIVE
-        ):
-            if click_generation_strategy == ClickGenerationStrategy.DEEPGROW_GLOBAL_CORRECTIVE:
-                # sets self._will_interact
-                self.randomize(data)
+        label_names = get_label_names(data)
+        batch_size = len(data[CommonKeys.IMAGE])
+        # Clicks are stored as (channel, x, y, z)
+        point_size = len(data[CommonKeys.IMAGE].shape) - 1
+
+        for idx, key_label in enumerate(label_names.keys()):
+            batched_gui = get_batched_guidance_for_key_label(data, key_label, batch_size, self.device)
+
+            if click_generation_strategy == ClickGenerationStrategy.GLOBAL_NON_CORRECTIVE:
+                # uniform random sampling on label
+                for b in range(batch_size):
+                    batched_gui[b] = self.add_guidance_based_on_label(
+                        data, batched_gui[b], data["label"][b].eq(idx).to(dtype=torch.int32)
+                    )
+            elif (
+                click_generation_strategy == ClickGenerationStrategy.GLOBAL_CORRECTIVE
+                or click_generation_strategy == ClickGenerationStrategy.DEEPGROW_GLOBAL_CORRECTIVE
+            ):
+                if idx == 0:
+                    if click_generation_strategy == ClickGenerationStrategy.DEEPGROW_GLOBAL_CORRECTIVE:
+                        # sets self._will_interact
+                        self.randomize(data)
+                    else:
+                        self._will_interact = [True] * batch_size
+
+                # idx 0 is positive discrepancy and idx 1 is negative discrepancy
+                pos_discr = data[self.discrepancy_key][key_label][0]
+                bounding_boxes = None
+                if self.bounding_box_key is not None and self.bounding_box_key in data:
+                    bounding_boxes = data[self.bounding_box_key][key_label][0]
+                for b in range(batch_size):
+                    if not self._will_interact[b] or (bounding_boxes is not None and bounding_boxes[b][0, 0] < 0):
+                        # No interaction or empty discrepancy
+                        continue
+                    # Add guidance based on discrepancy
+                    batched_gui[b] = self.add_guidance_based_on_discrepancy(
+                        data,
+                        batched_gui[b],
+                        pos_discr[b],
+                        bounding_box=bounding_boxes[b] if bounding_boxes is not None else None,
+                    )
+            elif click_generation_strategy == ClickGenerationStrategy.PATCH_BASED_CORRECTIVE:
+                if idx == 0:
+                    worst_patch_coordinates = [self.find_worst_patch(data, b) for b in range(batch_size)]
+                for b in range(batch_size):
+                    pos_discr = data[self.discrepancy_key][key_label][0][b]
+                    # Add guidance based on discrepancy
+                    batched_gui[b] = self.add_guidance_based_on_discrepancy(
+                        data, batched_gui[b], pos_discr, worst_patch_coordinates[b][idx]
+                    )
             else:
-                self._will_interact = True
-
-            if self._will_interact:
-                for key_label in data[LABELS_KEY].keys():
-                    tmp_gui = get_guidance_tensor_for_key_label(data, key_label, self.device)
+                raise UserWarning("Unknown click strategy")
 
-                    # Add guidance based on discrepancy
-                    data[key_label] = self.add_guidance_based_on_discrepancy(data, tmp_gui, key_label)
-        elif click_generation_strategy == ClickGenerationStrategy.PATCH_BASED_CORRECTIVE:
-            assert data[CommonKeys.LABEL].shape == data[CommonKeys.PRED].shape
-
-            t = [
-                Activationsd(keys="pred", softmax=True),
-                AsDiscreted(
-                    keys=("pred", "label"),
-                    argmax=(True, False),
-                    to_onehot=(len(data[LABELS_KEY]), len(data[LABELS_KEY])),
-                ),
-            ]
-            post_transform = Compose(t)
-            t_data = post_transform(data)
-
-            # Split the data into patches of size self.patch_size
-            # TODO not working for 2d data yet!
-            new_data = PatchIterd(keys=[CommonKeys.PRED, CommonKeys.LABEL], patch_size=self.patch_size)(t_data)
-            pred_list = []
-            label_list = []
-            coordinate_list = []
-
-            for patch in new_data:
-                actual_patch = patch[0]
-                pred_list.append(actual_patch[CommonKeys.PRED])
-                label_list.append(actual_patch[CommonKeys.LABEL])
-                coordinate_list.append(actual_patch["patch_coords"])
-
-            label_stack = torch.stack(label_list, 0)
-            pred_stack = torch.stack(pred_list, 0)
-
-            dice_loss = DiceLoss(include_background=True, reduction="none")
-            with torch.no_grad():
-                loss_per_label = dice_loss.forward(input=pred_stack, target=label_stack).squeeze()
-                assert len(loss_per_label.shape) == 2
-                # 1. dim: patch number, 2. dim: number of labels, e.g. [27,2]
-                max_loss_position_per_label = torch.argmax(loss_per_label, dim=0)
-                assert len(max_loss_position_per_label) == len(data[LABELS_KEY])
-
-            # We now have the worst patches for each label, now sample clicks on them
-            for idx, (key_label, _) in enumerate(data[LABELS_KEY].items()):
-                patch_number = max_loss_position_per_label[idx]
-                coordinates = coordinate_list[patch_number]
-
-                tmp_gui = get_guidance_tensor_for_key_label(data, key_label, self.device)
-                # Add guidance based on discrepancy
-                data[key_label] = self.add_guidance_based_on_discrepancy(data, tmp_gui, key_label, coordinates)
-
-            gc.collect()
-        else:
-            raise UserWarning("Unknown click strategy")
+            data[key_label] = pad_batched_guidance(batched_gui, point_size, self.device)
 
         return data
 
+    def find_worst_patch(self, data: Dict, b: int) -> List[torch.Tensor]:
+        """
+        Returns the coordinates of the patch with the highest dice loss for every label of sample b,
+        in the order of the label names.
+
+        The patches form a grid of size self.patch_size with a stride of patch_size * (1 - self.patch_overlap),
+        the last patch of every dimension is cut at the border. The TP / prediction / label voxel counts of all patches
+        are computed with a strided sum pooling over the masks, so no patch gets copied.
+        Where patch_size does not divide the image size, the former PatchIterd implementation wrap-padded the border
+        patches with the voxels of the opposite border instead of cutting them, so the chosen patch can differ there.
+        Checked in scripts/worst_patch_test.py.
+        """
+        label = data[CommonKeys.LABEL][b]
+        pred = data[CommonKeys.PRED][b].to(device=label.device)
+        assert label.shape == pred.shape
+        spatial_size = label.shape[1:]
+        dimensions = len(spatial_size)
+        # Patches larger than the image are cut to the image size
+        patch_size = [min(p, s) for p, s in zip(self.patch_size, spatial_size)]
+        stride = [max(int(p * (1 - self.patch_overlap)), 1) for p in patch_size]
+        sum_pool = getattr(torch.nn.functional, f"avg_pool{dimensions}d")
+
+        def count_per_patch(mask):
+            # mask has the shape 1HWD, returns the number of voxels of each patch
+            return sum_pool(
+                mask.to(dtype=torch.float32)[None], kernel_size=patch_size, stride=stride, ceil_mode=True, divisor_override=1
+            )[0, 0]
+
+        dice_loss = []
+        with torch.no_grad():
+            for label_value in get_label_names(data).values():
+                label_mask = label == label_value
+                pred_mask = pred == label_value
+                tp = count_per_patch(label_mask & pred_mask)
+                # Same as DiceLoss(include_background=True, reduction="none") with the default smoothing
+                dice_loss.append(1.0 - (2.0 * tp + 1e-5) / (count_per_patch(pred_mask) + count_per_patch(label_mask) + 1e-5))
+        grid_shape = dice_loss[0].shape
+
+        worst_patch_coordinates = []
+        for loss in dice_loss:
+            grid_position = torch.unravel_index(torch.argmax(loss), grid_shape)
+            coordinates = [[0, 1]]
+            for position, p, st, size in zip(grid_position, patch_size, stride, spatial_size):
+                start = int(position) * st
+                coordinates.append([start, min(start + p, size)])
+            worst_patch_coordinates.append(torch.tensor(coordinates))
+        # We now have the worst patches for each label
+        return worst_patch_coordinates
+
 
 class SplitPredsLabeld(MapTransform):
     """
@@ -22,7 +22,6 @@ import os
 import pathlib
 import sys
 import tempfile
-import time
 import uuid
 
 import torch
@@ -57,6 +56,26 @@ def parse_args():
         action="store_true",
         help="Use a temporary folder which will be cleaned up after the program run.",
     )
+    parser.add_argument(
+        "--volume_store",
+        default=False,
+        action="store_true",
+        help="Store the preprocessed train / val volumes in cache_dir as memory-mapped .npy files with a JSON sidecar "
+        "instead of the pickles of PersistentDataset, so loading a sample only reads the pages of the crop",
+    )
+    parser.add_argument(
+        "--volume_store_workers",
+        type=int,
+        default=0,
+        help="Threads which fill the volume store before the training, 0 fills it on the first access of a sample",
+    )
+    parser.add_argument(
+        "--ram_cache_gb",
+        type=float,
+        default=0,
+        help="Keep up to this many GB of preprocessed samples per loader (train / val) in an in-RAM LRU cache in front "
+        "of the disk cache, 0 disables it",
+    )
     parser.add_argument(
         "--save_pred",
         default=False,
@@ -99,6 +118,26 @@ def parse_args():
     parser.add_argument(
         "--positive_crop_rate", type=float, default=0.6, help="The rate of positive samples for RandCropByPosNegLabeld"
     )
+    parser.add_argument(
+        "--crops_per_volume",
+        type=int,
+        default=1,
+        help="Number of random crops drawn from every loaded training volume, yielded as separate samples through a "
+        "shuffle buffer. An epoch then has crops_per_volume samples per volume",
+    )
+    parser.add_argument(
+        "--crop_shuffle_buffer",
+        type=int,
+        default=None,
+        help="Crops held in the shuffle buffer for --crops_per_volume > 1, default: 2 * crops_per_volume",
+    )
+    parser.add_argument(
+        "--max_crop_center_indices",
+        type=int,
+        default=1000000,
+        help="The foreground / background voxel indices for the crop centers of RandCropByPosNegLabeld are computed "
+        "once and cached, thinned out to at most this many per volume (0: all)",
+    )
 
     # Configuration
     parser.add_argument("-s", "--seed", type=int, default=36)
@@ -113,29 +152,136 @@ def parse_args():
         "-n",
         "--network",
         default="dynunet",
-        choices=["dynunet", "smalldynunet", "bigdynunet", "bigdynunet2", "matteodynunet"],
+        choices=["dynunet", "smalldynunet", "bigdynunet", "bigdynunet2", "matteodynunet", "hugedynunet"],
+    )
+    parser.add_argument(
+        "--checkpoint_activations",
+        default="none",
+        choices=["none", "encoder", "decoder", "all"],
+        help="Recompute the activations of these DynUNet blocks in the backward pass instead of storing them, "
+        "so larger train_crop_size / train_sw_batch_size fit (mainly for bigdynunet / hugedynunet)",
     )
     parser.add_argument(
         "-in",
         "--inferer",
         default="SlidingWindowInferer",
-        choices=["SimpleInferer", "SlidingWindowInferer"],
+        choices=[
+            "SimpleInferer",
+            "SlidingWindowInferer",
+            "IncrementalSlidingWindowInferer",
+            "CascadeSlidingWindowInferer",
+            "HaloTiledInferer",
+        ],
+        help="IncrementalSlidingWindowInferer only reruns the windows whose guidance changed during the click simulation, "
+        "CascadeSlidingWindowInferer only predicts the full resolution windows around the candidates of a downsampled pass, "
+        "the clicks and the previous prediction (only with the click loop, not in test.py / test_ensemble.py), "
+        "HaloTiledInferer predicts non-overlapping tiles with the receptive field of the network as halo instead of "
+        "blending overlapping windows (and falls back to the sliding window if the roi is too small for the halo or the "
+        "tiles cost more)",
+    )
+    parser.add_argument(
+        "--cascade_downsample_factor",
+        type=int,
+        default=2,
+        help="Downsampling of the coarse pass of the CascadeSlidingWindowInferer",
+    )
+    parser.add_argument(
+        "--no_cascade_full_final_pass",
+        default=False,
+        action="store_true",
+        help="Use the cascade also for the final prediction of every interaction loop instead of a full pass",
+    )
+    parser.add_argument(
+        "--inference_backend",
+        default="torch",
+        choices=["torch", "onnxruntime", "int8"],
+        help="onnxruntime runs the windows of the inferer through the --onnx_path model on the CPU, int8 through the "
+        "--quantized_path model of quantize.py (test.py)",
+    )
+    parser.add_argument(
+        "--inference_network",
+        default="none",
+        choices=["none", "compile", "torchscript"],
+        help="Inference-optimized variant of the network (torch.compile / TorchScript, channels_last_3d, eval folding) "
+        "for the no-grad click passes and test.py / test_ensemble.py",
+    )
+    parser.add_argument(
+        "--compile_cache_dir", type=str, default=None, help="Persistent torch.compile cache, reused by the next run"
+    )
+    parser.add_argument("--onnx_path", type=str, default="None", help="Written by export_onnx.py")
+    parser.add_argument("--onnx_threads", type=int, default=None, help="Default: all cores")
+    parser.add_argument("--quantized_path", type=str, default="None", help="Written by quantize.py")
+    parser.add_argument("--calibration_windows", type=int, default=16, help="Number of windows for the INT8 calibration")
+    parser.add_argument(
+        "--quantization_val_samples", type=int, default=None, help="Number of validation samples for the Dice delta"
     )
     parser.add_argument("--sw_roi_size", default="(128,128,128)", action="store")
+    parser.add_argument(
+        "--plan_manifest",
+        type=str,
+        default="None",
+        help="JSON file with the HWD shapes (at the target spacing) of the volumes, for plan.py",
+    )
+    parser.add_argument(
+        "--plan_networks", nargs="+", default=None, help="Networks compared by plan.py, default: --network"
+    )
+    parser.add_argument(
+        "--plan_roi_sizes", nargs="+", default=None, help="Roi sizes compared by plan.py, default: --sw_roi_size"
+    )
+    parser.add_argument(
+        "--plan_sw_batch_sizes",
+        nargs="+",
+        type=int,
+        default=None,
+        help="sw_batch_sizes compared by plan.py, default: --val_sw_batch_size",
+    )
     # crop_size multiples of sliding window size (128,128,128) with overlap 0.25 (default): 128, 224, 320, 416, 512
     parser.add_argument("--train_crop_size", default="(224,224,224)", action="store")
     parser.add_argument("--val_crop_size", default="None", action="store")
     # 1 on 24 Gb, 8 on 50 Gb,
     parser.add_argument("--train_sw_batch_size", type=int, default=8)
     parser.add_argument("--val_sw_batch_size", type=int, default=1)
+    parser.add_argument(
+        "--auto_sw_batch_size",
+        default=False,
+        action="store_true",
+        help="Ignore the sw_batch_size settings and pick the largest one which fits into memory by probing the network",
+    )
     parser.add_argument("--train_sw_overlap", type=float, default=0.25)
     # Reduce this if you run into OOMs
     parser.add_argument("--val_sw_overlap", type=float, default=0.25)
     parser.add_argument("--sw_cpu_output", default=False, action="store_true")
+    parser.add_argument(
+        "--sw_stitching",
+        default="memory",
+        choices=["memory", "memmap", "fp16", "bf16", "margin"],
+        help="memmap stitches the sliding windows into a disk-backed numpy.memmap and only returns the label map, "
+        "so the logits of the whole volume never have to fit into memory. fp16 / bf16 stitch the weighted logits "
+        "in half precision without a count map, margin only the logit margin of the two label case. "
+        "All but memory only return the label map during evaluation",
+    )
+    parser.add_argument("--sw_stitching_dir", default=None, help="Directory for the memmap files, default is the temp dir")
+    parser.add_argument(
+        "--sw_skip_background",
+        default=False,
+        action="store_true",
+        help="Skip sliding windows without foreground (threshold_foreground) and without clicks when no gradients are needed",
+    )
+    parser.add_argument(
+        "--sw_plan_cache_size",
+        type=int,
+        default=4,
+        help="Number of sliding window plans (window slices, importance and count map per image size) kept in memory",
+    )
 
     # Training
     parser.add_argument("-a", "--amp", default=False, action="store_true")
     parser.add_argument("--num_workers", type=int, default=1)
+    # The click simulation runs on the whole batch
+    parser.add_argument("--train_batch_size", type=int, default=1)
+    parser.add_argument(
+        "--val_batch_size", type=int, default=1, help="Values > 1 need a fixed --val_crop_size so that the volumes can be batched"
+    )
     parser.add_argument("-e", "--epochs", type=int, default=100)
     # LOSS
     # If learning rate is set to 0.001, the DiceCELoss will produce Nans very quickly
@@ -179,6 +325,14 @@ def parse_args():
     # Guidance Signal Hyperparameters
     parser.add_argument("--sigma", type=int, default=1)
     parser.add_argument("--no_disks", default=False, action="store_true")
+    parser.add_argument(
+        "--distance_transform_backend",
+        default="auto",
+        choices=["auto", "scipy", "separable", "monai", "cucim"],
+        help="Distance transform used for the click generation. auto uses cucim for CUDA tensors if available, "
+        "otherwise scipy, which is the fastest CPU backend. separable is a pure numpy reference implementation and "
+        "about 2-3x slower than scipy. Run scripts/benchmark_distance_transform.py to compare them on a host.",
+    )
 
     # Guidance Signal Click Generation - for details see the mappings below
     parser.add_argument("-tcg", "--train_click_generation", type=int, default=2, choices=[1, 2])
@@ -198,6 +352,11 @@ def parse_args():
         default=1,
         choices=[1, 2, 3, 4, 5],
     )
+    # only needed for the patch-based corrective click generation
+    parser.add_argument("--click_patch_size", default="(128,128,128)", action="store")
+    parser.add_argument(
+        "--click_patch_overlap", type=float, default=0.0, help="Overlap of the patches, 0 means disjoint patches"
+    )
     # only needed for training
     parser.add_argument("--train_loss_stopping_threshold", type=float, default=0.1)
     parser.add_argument("--train_iteration_probability", type=float, default=0.5)
@@ -247,11 +406,8 @@ def setup_environment_and_adapt_args(args):
         if args.throw_away_cache:
             args.cache_dir = f"{args.cache_dir}/{uuid.uuid4()}"
         else:
-            logger.warning("Reusing the cache_dir between different network runs may lead to cache inconsistencies.")
-            logger.warning("Most importantly the crops may not be updated if you set them differently")
-            logger.warning("PersistentDataset does not detect this automatically but only checks if the hash matches")
-            logger.warning("Waiting shortly...")
-            time.sleep(10)
+            # The cache keys contain a fingerprint of the preprocessing and of the input files, see get_cache_dataset
+            logger.info(f"Reusing the cache_dir {args.cache_dir}, samples with identical preprocessing are shared")
             args.cache_dir = f"{args.cache_dir}"
 
     if not os.path.exists(args.cache_dir):
@@ -315,6 +471,10 @@ def setup_environment_and_adapt_args(args):
     # Init the Inferer
     args.sw_roi_size = eval(args.sw_roi_size)
     assert len(args.sw_roi_size) == 3
+    args.plan_roi_sizes = [eval(size) for size in args.plan_roi_sizes] if args.plan_roi_sizes else [args.sw_roi_size]
+    assert all(len(size) == 3 for size in args.plan_roi_sizes)
+    args.click_patch_size = eval(args.click_patch_size)
+    assert len(args.click_patch_size) == 3
 
     if args.val_crop_size == "None":
         args.val_crop_size = None
@@ -328,6 +488,13 @@ def setup_environment_and_adapt_args(args):
         args.train_crop_size = eval(args.train_crop_size)
         assert len(args.train_crop_size) == 3
 
+    if args.crop_shuffle_buffer is None:
+        args.crop_shuffle_buffer = 2 * args.crops_per_volume
+    assert args.crops_per_volume >= 1 and args.crop_shuffle_buffer >= 1
+
+    if args.val_batch_size > 1 and args.val_crop_size is None:
+        raise UserWarning("--val_batch_size > 1 needs --val_crop_size, otherwise the volumes have different shapes")
+
     # verify both have a valid size (for Unet with seven layers)
     if args.inferer == "SimpleInferer":
         for size in args.train_crop_size:
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import inspect
+import logging
+import os
+from enum import Enum
+from typing import Sequence
+
+import numpy as np
+import torch
+from monai.data.utils import json_hashing, pickle_hashing
+
+from sw_fastedit.helper_transforms import InitLoggerd, PrintDatad
+
+logger = logging.getLogger("sw_fastedit")
+
+"""
+Cache keys for PersistentDataset / VolumeStoreDataset which make a cache_dir safe to share between runs: the key of a
+sample is the hash of its file paths plus the modification time and the size of the files, followed by the hash of the
+deterministic transforms (their classes and arguments) up to the first random one. Runs with identical preprocessing
+share the cached samples, any change of the preprocessing or of the input files leads to new keys.
+"""
+
+# Transforms which do not change the data, their arguments (e.g. the log_dir of the run) are left out of the key
+NON_DATA_TRANSFORMS = (InitLoggerd, PrintDatad)
+
+_MAX_DEPTH = 8
+
+
+def _describe(obj, depth: int = 0):
+    """Stable JSON description of a transform: its class and recursively all its attributes."""
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu().tolist()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (torch.device, torch.dtype, np.dtype, type)):
+        return str(obj)
+    if isinstance(obj, (list, tuple)):
+        return [_describe(v, depth + 1) for v in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted(str(v) for v in obj)
+    if isinstance(obj, dict):
+        return {str(k): _describe(v, depth + 1) for k, v in obj.items()}
+    if inspect.isroutine(obj):
+        return f"{getattr(obj, '__module__', '')}.{getattr(obj, '__qualname__', type(obj).__qualname__)}"
+    name = f"{type(obj).__module__}.{type(obj).__qualname__}"
+    if isinstance(obj, NON_DATA_TRANSFORMS) or isinstance(obj, logging.Logger) or depth >= _MAX_DEPTH:
+        return name
+    if hasattr(obj, "__dict__"):
+        return {"class": name, **{k: _describe(v, depth + 1) for k, v in sorted(vars(obj).items())}}
+    return name
+
+
+def transform_fingerprint_hashing(transforms: Sequence) -> bytes:
+    """hash_transform of PersistentDataset, hashes the classes and arguments of the deterministic transforms."""
+    return json_hashing([_describe(t) for t in transforms])
+
+
+def file_fingerprint_hashing(item) -> bytes:
+    """hash_func of PersistentDataset, hashes the data item together with the mtime and the size of its files."""
+    if isinstance(item, dict):
+        fingerprint = {}
+        for key, value in item.items():
+            if isinstance(value, str) and os.path.isfile(value):
+                stat = os.stat(value)
+                value = [value, stat.st_mtime_ns, stat.st_size]
+            fingerprint[key] = value
+        item = fingerprint
+    return pickle_hashing(item)
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import functools
+import logging
+from typing import Callable, List
+
+import torch
+from monai.networks.nets.dynunet import DynUNet, DynUNetSkipLayer
+from torch.utils.checkpoint import checkpoint
+
+logger = logging.getLogger("sw_fastedit")
+
+"""
+Activation (gradient) checkpointing for the DynUNet: the activations inside the checkpointed blocks are not stored
+for the backward pass but recomputed, which trades compute for memory so larger crops / batches fit for training.
+"""
+
+CHECKPOINT_GRANULARITIES = ["none", "encoder", "decoder", "all"]
+
+
+def _checkpointed_forward(forward: Callable, module: torch.nn.Module, *args):
+    if module.training and torch.is_grad_enabled():
+        return checkpoint(forward, module, *args, use_reentrant=False)
+    return forward(module, *args)
+
+
+def _get_blocks(network: DynUNet, granularity: str) -> List[torch.nn.Module]:
+    """The encoder blocks (incl. the input block), the bottleneck and / or the decoder blocks of the network."""
+    encoder, decoder = [], []
+    layer = network.skip_layers
+    while isinstance(layer, DynUNetSkipLayer):
+        encoder.append(layer.downsample)
+        decoder.append(layer.upsample)
+        layer = layer.next_layer
+    bottleneck = layer
+    if granularity == "encoder":
+        return encoder
+    if granularity == "decoder":
+        return decoder
+    return encoder + [bottleneck] + decoder
+
+
+def enable_activation_checkpointing(network: DynUNet, granularity: str = "all") -> DynUNet:
+    """
+    Checkpoints every block of the given granularity ("encoder", "decoder" or "all"). Only active in training mode
+    with gradients enabled, the inference is unchanged.
+    The forward of the blocks is replaced in place, so the state_dict and the checkpoints stay compatible.
+    """
+    assert granularity in CHECKPOINT_GRANULARITIES, f"Unknown granularity {granularity}"
+    if granularity == "none":
+        return network
+    blocks = _get_blocks(network, granularity)
+    for block in blocks:
+        # The unbound forward of the class, so deepcopies of the network checkpoint their own blocks
+        block.forward = functools.partial(_checkpointed_forward, type(block).forward, block)
+    logger.info(f"Activation checkpointing of {len(blocks)} blocks ({granularity})")
+    return network
@@ -1,91 +1,275 @@
 from __future__ import annotations
 
 import logging
-from typing import List, Tuple
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Sequence, Tuple
 
-import cupy as cp
 import numpy as np
 import torch
+from monai.transforms.utils import distance_transform_edt as distance_transform_edt_monai
+from monai.utils import optional_import
+from scipy.ndimage import distance_transform_edt as distance_transform_edt_scipy
 
+# Only needed for the GPU backends, so the click pipeline also runs on machines without CUDA
+cp, has_cupy = optional_import("cupy")
 # Details here: https://docs.rapids.ai/api/cucim/nightly/api/#cucim.core.operations.morphology.distance_transform_edt
-from cucim.core.operations.morphology import distance_transform_edt as distance_transform_edt_cupy
-# from numpy.typing import ArrayLike
-# from scipy.ndimage import distance_transform_edt
+distance_transform_edt_cupy, has_cucim = optional_import(
+    "cucim.core.operations.morphology", name="distance_transform_edt"
+)
 
 np.seterr(all="raise")
 
 logger = logging.getLogger("sw_fastedit")
 
 """
-CUDA enabled distance transforms using cupy
+Distance transforms with exchangeable CPU / GPU backends.
+
+All backends take a channel first tensor (CHW[D]) and return the euclidean distance of every nonzero voxel
+to the closest zero voxel, channel by channel, as a float32 tensor on the device of the input.
+scipy is the CPU default of "auto" and the fastest CPU backend, cucim the one for CUDA tensors.
 """
 
+# Set by set_click_sampler_seed(), usually from args.seed
+_click_sampler_seed = None
+_click_generators: Dict[str, torch.Generator] = {}
+
+DISTANCE_TRANSFORM_BACKENDS: Dict[str, Callable[[torch.Tensor], torch.Tensor]] = {}
+# Set by set_distance_transform_backend(), usually from args.distance_transform_backend
+_default_backend = "auto"
+
+
+def register_distance_transform_backend(name: str, available: bool = True):
+    """Decorator to add a distance transform backend to DISTANCE_TRANSFORM_BACKENDS, if its dependencies are available."""
+
+    def decorator(func: Callable[[torch.Tensor], torch.Tensor]):
+        if available:
+            DISTANCE_TRANSFORM_BACKENDS[name] = func
+        return func
+
+    return decorator
+
+
+@register_distance_transform_backend("scipy")
+def distance_transform_scipy(t: torch.Tensor) -> torch.Tensor:
+    t_np = t.detach().cpu().numpy()
+    distance = np.stack([distance_transform_edt_scipy(channel) for channel in t_np])
+    return torch.as_tensor(distance, dtype=torch.float32, device=t.device)
+
+
+def _squared_distance_1d(f: np.ndarray) -> np.ndarray:
+    """
+    Lower envelope of parabolas (Felzenszwalb & Huttenlocher, Distance Transforms of Sampled Functions),
+    run on all rows of f (lines x n) at the same time. Returns min_y f[:, y] + (x - y)^2 for every x.
+    """
+    lines, n = f.shape
+    rows = np.arange(lines)
+    v = np.zeros((lines, n), dtype=np.int64)
+    z = np.empty((lines, n + 1), dtype=np.float64)
+    z[:, 0] = -np.inf
+    z[:, 1] = np.inf
+    k = np.zeros(lines, dtype=np.int64)
+
+    def intersection(q, lines_subset):
+        vk = v[lines_subset, k[lines_subset]]
+        return ((f[lines_subset, q] + q * q) - (f[lines_subset, vk] + vk * vk)) / (2 * q - 2 * vk)
+
+    for q in range(1, n):
+        s = intersection(q, rows)
+        pop = s <= z[rows, k]
+        while np.any(pop):
+            k[pop] -= 1
+            s[pop] = intersection(q, rows[pop])
+            pop = s <= z[rows, k]
+        k += 1
+        v[rows, k] = q
+        z[rows, k] = s
+        z[rows, k + 1] = np.inf
+
+    d = np.empty_like(f)
+    k[:] = 0
+    for q in range(n):
+        advance = z[rows, k + 1] < q
+        while np.any(advance):
+            k[advance] += 1
+            advance = z[rows, k + 1] < q
+        vk = v[rows, k]
+        d[:, q] = (q - vk) ** 2 + f[rows, vk]
+    return d
+
+
+def separable_distance_transform(t: np.ndarray, num_threads: int = 1) -> np.ndarray:
+    """
+    Exact euclidean distance transform of a single channel, computed as one 1D pass per axis.
+    The lines of every pass are split into chunks which run in num_threads threads (numpy releases the GIL).
+    Pure numpy reference without compiled code: the 1D passes loop over the voxels of a line in Python, so on the
+    CPU it is about 2-3x slower than scipy (e.g. 1.1e-6 vs 4.3e-7 seconds per voxel on 128^3 with one thread), also
+    with several threads. Use scipy on the CPU, see benchmark_distance_transform_backends().
+    """
+    # Larger than any squared distance inside the volume, used instead of inf to keep the arithmetic finite
+    max_distance = float(sum(s * s for s in t.shape) + 1)
+    squared = np.where(t != 0, max_distance, 0.0)
+    with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        for axis in range(squared.ndim):
+            moved = np.moveaxis(squared, axis, -1)
+            lines = moved.reshape(-1, moved.shape[-1])
+            chunks = np.array_split(np.arange(len(lines)), max(num_threads, 1))
+            results = executor.map(lambda chunk: _squared_distance_1d(lines[chunk]), [c for c in chunks if len(c)])
+            lines = np.concatenate(list(results))
+            squared = np.moveaxis(lines.reshape(moved.shape), -1, axis)
+    return np.sqrt(squared)
+
+
+@register_distance_transform_backend("separable")
+def distance_transform_separable(t: torch.Tensor) -> torch.Tensor:
+    t_np = t.detach().cpu().numpy()
+    distance = np.stack([separable_distance_transform(channel, torch.get_num_threads()) for channel in t_np])
+    return torch.as_tensor(distance, dtype=torch.float32, device=t.device)
+
+
+@register_distance_transform_backend("monai")
+def distance_transform_monai(t: torch.Tensor) -> torch.Tensor:
+    # Uses cuCIM for CUDA tensors if available, scipy otherwise
+    distance = distance_transform_edt_monai(t)
+    return torch.as_tensor(distance, dtype=torch.float32, device=t.device)
+
 
-# TODO replace with distance_transform_edt when MONAI 1.3.0 gets released
-# def get_distance_transform(tensor: torch.Tensor, device: torch.device = None) -> torch.Tensor:
-#     # The distance transform provides a metric or measure of the separation of points in the image.
-#     # This function calculates the distance between each pixel that is set to off (0) and
-#     # the nearest nonzero pixel for binary images
-#     # http://matlab.izmiran.ru/help/toolbox/images/morph14.html
-#     dimension = tensor.dim()
+@register_distance_transform_backend("cucim", available=has_cupy and has_cucim)
+def distance_transform_cucim(t: torch.Tensor) -> torch.Tensor:
+    assert t.is_cuda, "The cucim backend only works on CUDA tensors"
+    with cp.cuda.Device(t.device.index):
+        t_cp = cp.asarray(t)
+        distance = cp.stack([distance_transform_edt_cupy(channel) for channel in t_cp])
+        distance = torch.as_tensor(distance, dtype=torch.float32, device=t.device)
+    return distance
 
-#     if dimension == 4:
-#         tensor = tensor.squeeze(0)
-#     assert len(tensor.shape) == 3 and tensor.is_cuda, "tensor.shape: {}, tensor.is_cuda: {}".format(
-#         tensor.shape, tensor.is_cuda
-#     )
-#     with cp.cuda.Device(device.index):
-#         tensor_cp = cp.asarray(tensor)
-#         distance = torch.as_tensor(distance_transform_edt_cupy(tensor_cp), device=device)
 
-#     if dimension == 4:
-#         distance = distance.unsqueeze(0)
-#     assert distance.dim() == dimension
-#     return distance
+def set_distance_transform_backend(name: str):
+    global _default_backend
+    if name != "auto" and name not in DISTANCE_TRANSFORM_BACKENDS:
+        raise UserWarning(
+            f"Distance transform backend {name} is not available, choose from {['auto'] + list(DISTANCE_TRANSFORM_BACKENDS)}"
+        )
+    _default_backend = name
+    logger.info(f"Using the distance transform backend {name}")
+
+
+def get_distance_transform_backend(name: str | None = None, device: torch.device | None = None) -> Callable:
+    """Returns the backend `name` (default: the one set by set_distance_transform_backend). "auto" picks by device."""
+    name = name or _default_backend
+    if name == "auto":
+        if device is not None and torch.device(device).type == "cuda" and "cucim" in DISTANCE_TRANSFORM_BACKENDS:
+            name = "cucim"
+        else:
+            name = "scipy"
+    return DISTANCE_TRANSFORM_BACKENDS[name]
+
+
+def distance_transform_edt(t: torch.Tensor, backend: str | None = None) -> torch.Tensor:
+    assert t.dim() in [3, 4], f"Expected a channel first tensor (CHW[D]), got shape {t.shape}"
+    return get_distance_transform_backend(backend, t.device)(t)
+
+
+def get_synthetic_discrepancy(shape: Sequence[int], num_regions: int = 10, device=None) -> torch.Tensor:
+    """Random boxes as a stand-in for the discrepancy between label and prediction (1HWD)."""
+    discrepancy = torch.zeros((1, *shape), device=device)
+    for _ in range(num_regions):
+        size = [np.random.randint(1, max(s // 4, 2)) for s in shape]
+        start = [np.random.randint(0, s - size_s + 1) for s, size_s in zip(shape, size)]
+        discrepancy[(0, *[slice(b, b + size_s) for b, size_s in zip(start, size)])] = 1
+    return discrepancy
+
+
+def benchmark_distance_transform_backends(
+    shapes: Sequence[Sequence[int]] = ((64, 64, 64), (128, 128, 128), (256, 256, 192)),
+    device=None,
+    iterations: int = 3,
+) -> Dict[str, Dict[Tuple[int], float]]:
+    """Runs every available backend on synthetic discrepancy maps and returns / logs the seconds per voxel."""
+    device = torch.device(device or "cpu")
+    results = {}
+    for name, backend in DISTANCE_TRANSFORM_BACKENDS.items():
+        if name == "cucim" and device.type != "cuda":
+            continue
+        results[name] = {}
+        for shape in shapes:
+            discrepancy = get_synthetic_discrepancy(shape, device=device)
+            backend(discrepancy)  # warm-up
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.time()
+            for _ in range(iterations):
+                backend(discrepancy)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            seconds_per_voxel = (time.time() - start) / iterations / discrepancy.numel()
+            results[name][tuple(shape)] = seconds_per_voxel
+            logger.info(f"Distance transform backend {name:>9} on {tuple(shape)}: {seconds_per_voxel:.3e} seconds per voxel")
+    return results
+
+
+def set_click_sampler_seed(seed: int):
+    """Seeds the generators of get_random_choice_from_tensor, so the simulated clicks are reproducible."""
+    global _click_sampler_seed
+    _click_sampler_seed = seed
+    _click_generators.clear()
+
+
+def get_click_generator(device: torch.device) -> torch.Generator:
+    """One torch.Generator per device, created with the seed of set_click_sampler_seed()."""
+    key = str(device)
+    if key not in _click_generators:
+        generator = torch.Generator(device=device)
+        if _click_sampler_seed is not None:
+            generator.manual_seed(_click_sampler_seed)
+        else:
+            generator.seed()
+        _click_generators[key] = generator
+    return _click_generators[key]
 
 
 def get_random_choice_from_tensor(
-    t: torch.Tensor | cp.ndarray,
+    t: torch.Tensor,
     *,
-    # device: torch.device,
-    max_threshold: int = None,
-    size=1,
-) -> Tuple[List[int], int] | None:
-    device = t.device
-    
-    with cp.cuda.Device(device.index):
-        if not isinstance(t, cp.ndarray):
-            t_cp = cp.asarray(t)
-        else:
-            t_cp = t
-
-        if cp.sum(t_cp) <= 0:
-            # No valid distance has been found. Dont raise, just empty return
-            return None, None
-
-        # Probability transform
-        if max_threshold is None:
-            # divide by the maximum number of elements in a volume, otherwise we will get overflows..
-            max_threshold = int(cp.floor(cp.log(cp.finfo(cp.float32).max))) / (800 * 800 * 800)
-
-        # Clip the distance transform to avoid overflows and negative probabilities
-        clipped_distance = t_cp.clip(min=0, max=max_threshold)
-
-        flattened_t_cp = clipped_distance.flatten()
-
-        probability = cp.exp(flattened_t_cp) - 1.0
-        idx = cp.where(flattened_t_cp > 0)[0]
-        probabilities = probability[idx] / cp.sum(probability[idx])
-        assert idx.shape == probabilities.shape
-        assert cp.all(cp.greater_equal(probabilities, 0))
-
-        # Choosing an element based on the probabilities
-        seed = cp.random.choice(a=idx, size=size, p=probabilities)
-        dst = flattened_t_cp[seed.item()]
-
-        # Get the elements index
-        g = cp.asarray(cp.unravel_index(seed, t_cp.shape)).transpose().tolist()[0]
-        index = g
-        # g[0] = dst.item()
-    assert len(g) == len(t_cp.shape), f"g has wrong dimensions! {len(g)} != {len(t_cp.shape)}"
-    return index, dst.item()
+    max_threshold: float = None,
+    size: int = 1,
+    generator: torch.Generator | None = None,
+) -> Tuple[List[int], float] | Tuple[List[List[int]], List[float]] | Tuple[None, None]:
+    """
+    Draws `size` elements of t (with replacement) with a probability of exp(min(t, max_threshold)) - 1,
+    so only positive elements can be chosen. Runs in torch on the device of t.
+
+    The positive elements are compacted first, then the sample is drawn by inverse-CDF
+    (cumulative sum + searchsorted) on them.
+
+    Returns: (index, value) of the element for size == 1, lists of them for size > 1 and (None, None)
+        if there is no positive element.
+    """
+    flattened_t = t.detach().flatten()
+    idx = torch.nonzero(flattened_t > 0).squeeze(1)
+    if not len(idx):
+        # No valid distance has been found. Dont raise, just empty return
+        return None, None
+
+    # Probability transform
+    if max_threshold is None:
+        # divide by the maximum number of elements in a volume, otherwise we will get overflows..
+        max_threshold = math.floor(math.log(torch.finfo(torch.float32).max)) / (800 * 800 * 800)
+    # Clip the distance transform to avoid overflows
+    values = flattened_t[idx].to(dtype=torch.float64).clamp(max=max_threshold)
+    cdf = torch.cumsum(torch.expm1(values), dim=0)
+
+    # Choosing elements based on the probabilities
+    generator = generator or get_click_generator(t.device)
+    u = torch.rand(size, generator=generator, device=t.device, dtype=torch.float64) * cdf[-1]
+    positions = torch.searchsorted(cdf, u, right=True).clamp(max=len(idx) - 1)
+    seeds = idx[positions]
+
+    # Get the elements index
+    indices = torch.stack(torch.unravel_index(seeds, t.shape), dim=1).tolist()
+    dst = flattened_t[seeds].tolist()
+    assert len(indices[0]) == len(t.shape), f"g has wrong dimensions! {len(indices[0])} != {len(t.shape)}"
+    if size == 1:
+        return indices[0], dst[0]
+    return indices, dst
@@ -12,12 +12,12 @@ from datetime import datetime
 from functools import wraps
 from typing import List
 
-import cupy as cp
 import pandas as pd
 import psutil
 import SimpleITK
 import torch
 from monai.data.meta_tensor import MetaTensor
+from monai.utils import optional_import
 from pynvml import (
     NVMLError,
     nvmlDeviceGetComputeRunningProcesses,
@@ -28,6 +28,8 @@ from pynvml import (
     nvmlShutdown,
 )
 
+cp, has_cupy = optional_import("cupy")
+
 logger = logging.getLogger("sw_fastedit")
 
 gb_divisor = 1024**3
@@ -65,10 +67,12 @@ def gpu_usage(device: torch.device, used_memory_only=False, nvml_handle=None):
 
         torch_reserved = torch.cuda.memory_reserved(device) / gb_divisor
 
-        with cp.cuda.Device(device.index):
-            mempool = cp.get_default_memory_pool()
-            cupy_total = mempool.total_bytes() / gb_divisor
-            cupy_used = mempool.used_bytes() / gb_divisor
+        cupy_total, cupy_used = 0, 0
+        if has_cupy:
+            with cp.cuda.Device(device.index):
+                mempool = cp.get_default_memory_pool()
+                cupy_total = mempool.total_bytes() / gb_divisor
+                cupy_used = mempool.used_bytes() / gb_divisor
     except NVMLError:
         return []
     finally:
@@ -413,6 +417,26 @@ def get_tensor_at_coordinates(t: torch.Tensor, coordinates: torch.Tensor) -> tor
         raise UserWarning("Not implemented for this lenghts of coordinates")
 
 
+def get_bounding_box_coordinates(t: torch.Tensor, margin: int = 1) -> torch.Tensor | None:
+    """
+    Returns the bounding box of the nonzero elements of t (CHWD) enlarged by margin, in the same (len(t.shape), 2)
+    format as the patch coordinates, so it can be used with get_tensor_at_coordinates and
+    get_global_coordinates_from_patch_coordinates. The channel dimension is always fully included.
+    Returns None if t is all zero.
+    """
+    nonzero = t != 0
+    coordinates = [[0, t.shape[0]]]
+    for dim in range(1, len(t.shape)):
+        other_dims = [d for d in range(len(t.shape)) if d != dim]
+        indices = torch.nonzero(torch.amax(nonzero, dim=other_dims))
+        if not len(indices):
+            return None
+        start = max(indices[0].item() - margin, 0)
+        end = min(indices[-1].item() + margin + 1, t.shape[dim])
+        coordinates.append([start, end])
+    return torch.tensor(coordinates)
+
+
 def get_global_coordinates_from_patch_coordinates(
     current_coordinates: List, patch_coordinates: torch.Tensor
 ) -> torch.Tensor:
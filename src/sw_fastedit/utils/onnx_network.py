@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import inspect
+import logging
+import os
+from typing import Sequence
+
+import torch
+from monai.utils import optional_import
+
+# Only needed for the onnxruntime inference backend, see --inference_backend
+ort, has_onnxruntime = optional_import("onnxruntime")
+
+logger = logging.getLogger("sw_fastedit")
+
+"""
+ONNX export of the networks of get_network() and an onnxruntime CPU backend, which can be used as the network of
+any sliding window inferer, so annotation nodes without a GPU get a usable latency.
+"""
+
+ONNX_NETWORKS = ["dynunet", "smalldynunet", "bigdynunet"]
+
+
+def export_onnx(network: torch.nn.Module, onnx_path: str, in_channels: int, roi_size: Sequence[int], opset: int = 17):
+    """Exports the network (BCHWD -> BCHWD) to onnx_path with a dynamic batch size and dynamic spatial dimensions."""
+    network = network.eval().cpu()
+    dummy_input = torch.zeros((1, in_channels, *roi_size))
+    dynamic_axes = {0: "batch", **{2 + i: f"spatial_{i}" for i in range(len(roi_size))}}
+    # Newer torch versions default to the dynamo exporter, the TorchScript based one handles the dynamic axes directly
+    exporter_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            network,
+            dummy_input,
+            onnx_path,
+            input_names=["input"],
+            output_names=["output"],
+            dynamic_axes={"input": dynamic_axes, "output": dynamic_axes},
+            opset_version=opset,
+            **exporter_kwargs,
+        )
+    logger.info(f"Exported the network to {onnx_path}")
+
+
+class OnnxNetwork(torch.nn.Module):
+    """
+    Runs an exported network in onnxruntime on the CPU. Takes and returns torch tensors like the eager network,
+    the output is moved back to the device of the input.
+
+    Args:
+        onnx_path: the file written by export_onnx().
+        num_threads: intra op threads of onnxruntime, defaults to all cores (init() limits torch to a third of them).
+    """
+
+    def __init__(self, onnx_path: str, num_threads: int | None = None):
+        super().__init__()
+        if not has_onnxruntime:
+            raise UserWarning("The onnxruntime backend needs onnxruntime, install it with: pip install onnxruntime")
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads or os.cpu_count()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        logger.info(f"Loaded {onnx_path} into onnxruntime with {options.intra_op_num_threads} threads")
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        inputs = x.detach().to(device="cpu", dtype=torch.float32).contiguous().numpy()
+        output = self.session.run(None, {self.input_name: inputs})[0]
+        return torch.from_numpy(output).to(device=x.device)
+
+
+def check_onnx_parity(
+    network: torch.nn.Module, onnx_network: OnnxNetwork, in_channels: int, roi_size: Sequence[int], atol: float = 1e-3
+) -> float:
+    """Compares the eager and the onnxruntime output on a random input, returns the max abs difference."""
+    network = network.eval().cpu()
+    inputs = torch.rand((1, in_channels, *roi_size))
+    with torch.no_grad():
+        max_diff = torch.max(torch.abs(network(inputs) - onnx_network(inputs))).item()
+    logger.info(f"Max abs difference between the eager and the onnxruntime output: {max_diff:.2e}")
+    if max_diff > atol:
+        logger.warning(f"The onnxruntime output differs by more than {atol} from the eager output")
+    return max_diff
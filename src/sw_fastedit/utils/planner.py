@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import copy
+import json
+import logging
+import time
+from typing import Dict, List, Sequence
+
+import numpy as np
+import torch
+from monai.networks.nets.dynunet import DynUNetSkipLayer
+
+from sw_fastedit.inferers import get_window_slices
+
+logger = logging.getLogger("sw_fastedit")
+
+"""
+Cost model of the sliding window inference for choosing the sw_roi_size, the network and the sw_batch_size of a
+deployment without trial runs. The FLOPs and activations are counted on the meta device, so even the biggest networks
+and roi sizes are planned instantly; only the seconds per FLOP come from a short micro-benchmark on the CPU.
+"""
+
+
+def _get_conv_flops(module: torch.nn.Module, inputs: torch.Tensor, output: torch.Tensor) -> int:
+    kernel_volume = int(np.prod(module.kernel_size))
+    if isinstance(module, torch.nn.modules.conv._ConvTransposeNd):
+        return 2 * inputs.numel() * module.out_channels // module.groups * kernel_volume
+    return 2 * output.numel() * module.in_channels // module.groups * kernel_volume
+
+
+def get_network_cost(
+    network: torch.nn.Module, in_channels: int, roi_size: Sequence[int], bytes_per_element: int = 4
+) -> Dict[str, int]:
+    """
+    Counts the convolution FLOPs and estimates the peak activation memory in bytes of one forward pass of a single
+    window (no grad). The peak is the largest sum of the network input, the skip connections which are still alive and
+    the input and output of a layer, over all layers. `train_activations` is the memory of all layer outputs, which
+    autograd keeps for the backward pass.
+    """
+    network = copy.deepcopy(network).to("meta").eval()
+    cost = {"flops": 0, "peak_activations": 0, "train_activations": 0}
+    input_bytes = int(np.prod(roi_size)) * in_channels * bytes_per_element
+    skips = {}
+
+    def leaf_hook(module, inputs, output):
+        inputs = inputs[0]
+        if isinstance(module, torch.nn.modules.conv._ConvNd):
+            cost["flops"] += _get_conv_flops(module, inputs, output)
+        live = input_bytes + sum(skips.values()) + (inputs.numel() + output.numel()) * bytes_per_element
+        cost["peak_activations"] = max(cost["peak_activations"], live)
+        cost["train_activations"] += output.numel() * bytes_per_element
+
+    def skip_hook(key, alive):
+        def hook(module, inputs, output):
+            if alive:
+                skips[key] = output.numel() * bytes_per_element
+            else:
+                skips.pop(key, None)
+
+        return hook
+
+    handles = [m.register_forward_hook(leaf_hook) for m in network.modules() if not list(m.children())]
+    layer = getattr(network, "skip_layers", None)
+    while isinstance(layer, DynUNetSkipLayer):
+        # The output of the downsample block is kept as skip connection until the upsample block is done
+        handles.append(layer.downsample.register_forward_hook(skip_hook(id(layer), True)))
+        handles.append(layer.upsample.register_forward_hook(skip_hook(id(layer), False)))
+        layer = layer.next_layer
+    with torch.no_grad():
+        network(torch.zeros((1, in_channels, *roi_size), device="meta"))
+    for handle in handles:
+        handle.remove()
+    return cost
+
+
+def get_cpu_seconds_per_flop(
+    network: torch.nn.Module, in_channels: int, roi_size: Sequence[int] = (64, 64, 64), repeats: int = 3
+) -> float:
+    """Micro-benchmark: the median time of a forward pass of one roi_size window on the CPU divided by its FLOPs."""
+    network = copy.deepcopy(network).cpu().eval()
+    inputs = torch.rand((1, in_channels, *roi_size))
+    times = []
+    with torch.no_grad():
+        network(inputs)  # warm-up
+        for _ in range(repeats):
+            start = time.perf_counter()
+            network(inputs)
+            times.append(time.perf_counter() - start)
+    flops = get_network_cost(network, in_channels, roi_size)["flops"]
+    seconds_per_flop = float(np.median(times)) / flops
+    logger.info(
+        f"CPU calibration on {tuple(roi_size)}: {np.median(times):.3f} s per window, "
+        f"{1 / seconds_per_flop / 1e9:.1f} GFLOP/s with {torch.get_num_threads()} threads"
+    )
+    return seconds_per_flop
+
+
+def load_shape_manifest(path: str) -> List[tuple]:
+    """
+    Reads the spatial shapes (HWD, after the resampling to the target spacing) of the volumes from a JSON file,
+    either a list of shapes or a dict of case name -> shape.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    shapes = list(manifest.values()) if isinstance(manifest, dict) else manifest
+    assert len(shapes), f"{path} contains no volume shapes"
+    for shape in shapes:
+        assert len(shape) == 3, f"Expected HWD shapes in {path}, got {shape}"
+    return [tuple(int(s) for s in shape) for shape in shapes]
+
+
+def get_windows_per_case(
+    shapes: Sequence[Sequence[int]], roi_size: Sequence[int], overlap: float, crop_size: Sequence[int] | None = None
+) -> List[int]:
+    """Number of sliding windows per volume, after the (center) crop to crop_size and the padding to the roi_size."""
+    windows = []
+    for shape in shapes:
+        if crop_size is not None:
+            shape = [min(s, c) for s, c in zip(shape, crop_size)]
+        image_size = [max(s, r) for s, r in zip(shape, roi_size)]
+        windows.append(len(get_window_slices(image_size, roi_size, overlap)))
+    return windows
+
+
+def plan_configuration(
+    network: torch.nn.Module,
+    in_channels: int,
+    roi_size: Sequence[int],
+    sw_batch_size: int,
+    shapes: Sequence[Sequence[int]],
+    overlap: float,
+    seconds_per_flop: float,
+    clicks_per_case: int,
+    crop_size: Sequence[int] | None = None,
+    bytes_per_element: int = 4,
+) -> Dict[str, float]:
+    """
+    Cost of one configuration. A click reruns the full sliding window pass, a case is clicks_per_case clicks plus the
+    final prediction. The peak memory covers the weights and the activations of a batch of sw_batch_size windows.
+    """
+    cost = get_network_cost(network, in_channels, roi_size, bytes_per_element)
+    windows = get_windows_per_case(shapes, roi_size, overlap, crop_size)
+    weight_bytes = sum(p.numel() * p.element_size() for p in network.parameters())
+    seconds_per_click = float(np.mean(windows)) * cost["flops"] * seconds_per_flop
+    return {
+        "gflops_per_window": cost["flops"] / 1e9,
+        "peak_memory_gb": (weight_bytes + sw_batch_size * cost["peak_activations"]) / 1024**3,
+        "train_activations_gb": cost["train_activations"] / 1024**3,
+        "windows_per_case": float(np.mean(windows)),
+        "max_windows_per_case": max(windows),
+        "seconds_per_click": seconds_per_click,
+        "seconds_per_case": (clicks_per_case + 1) * seconds_per_click,
+    }
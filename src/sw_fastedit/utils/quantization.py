@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import copy
+import logging
+from typing import Iterable, List, Sequence
+
+import torch
+from monai.metrics import DiceMetric
+from monai.networks.utils import one_hot
+from monai.utils import convert_data_type
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from sw_fastedit.helper_transforms import threshold_foreground
+from sw_fastedit.inferers import get_window_occupancy, get_window_slices
+
+logger = logging.getLogger("sw_fastedit")
+
+"""
+INT8 post training quantization of the networks of get_network() for the CPU inference (x86 / fbgemm).
+
+PyTorch's dynamic quantization only covers Linear and recurrent layers, so the 3D convolutions of the DynUNet are
+quantized statically: the activation ranges are calibrated on a few windows of the (cached) validation data.
+"""
+
+QUANTIZATION_BACKEND = "x86"
+
+
+def get_calibration_windows(
+    data_loader: Iterable, roi_size: Sequence[int], num_windows: int = 16, number_intensity_ch: int = 1
+) -> List[torch.Tensor]:
+    """Collects up to num_windows windows (1CHWD, on the CPU) with foreground from the images of data_loader."""
+    windows = []
+    for batchdata in data_loader:
+        image = convert_data_type(batchdata["image"], torch.Tensor)[0].cpu()
+        if any(image.shape[2 + i] < roi_size[i] for i in range(len(roi_size))):
+            continue
+        slices = [(b, s) for b in range(image.shape[0]) for s in get_window_slices(image.shape[2:], roi_size, 0.0)]
+        occupancy = get_window_occupancy(image, slices, threshold_foreground, number_intensity_ch)
+        for (b, s), occupied in zip(slices, occupancy):
+            if occupied:
+                windows.append(image[(slice(b, b + 1), slice(None), *s)].clone())
+            if len(windows) >= num_windows:
+                return windows
+    logger.warning(f"Only found {len(windows)}/{num_windows} calibration windows")
+    return windows
+
+
+def prepare_quantization(network: torch.nn.Module, example_input: torch.Tensor) -> torch.nn.Module:
+    """Inserts the observers into a copy of the network (eval mode, CPU)."""
+    network = copy.deepcopy(network).eval().cpu()
+    return prepare_fx(network, get_default_qconfig_mapping(QUANTIZATION_BACKEND), (example_input,))
+
+
+def quantize_network(network: torch.nn.Module, calibration_windows: List[torch.Tensor]) -> "QuantizedNetwork":
+    """Returns the INT8 version of the network, calibrated on calibration_windows."""
+    assert len(calibration_windows), "The quantization needs at least one calibration window"
+    torch.backends.quantized.engine = QUANTIZATION_BACKEND
+    prepared = prepare_quantization(network, calibration_windows[0])
+    with torch.no_grad():
+        for window in calibration_windows:
+            prepared(window.to(dtype=torch.float32))
+    return QuantizedNetwork(convert_fx(prepared))
+
+
+def save_quantized_network(quantized_network: "QuantizedNetwork", path: str):
+    torch.save({"net": quantized_network.quantized_network.state_dict()}, path)
+    logger.info(f"Saved the quantized network to {path}")
+
+
+def load_quantized_network(
+    network: torch.nn.Module, path: str, in_channels: int, roi_size: Sequence[int]
+) -> "QuantizedNetwork":
+    """Rebuilds the quantized graph from the (fp32) architecture of network and loads the INT8 weights of path."""
+    torch.backends.quantized.engine = QUANTIZATION_BACKEND
+    quantized_network = convert_fx(prepare_quantization(network, torch.zeros((1, in_channels, *roi_size))))
+    quantized_network.load_state_dict(torch.load(path, map_location="cpu")["net"])
+    logger.info(f"Loaded the quantized network from {path}")
+    return QuantizedNetwork(quantized_network)
+
+
+class QuantizedNetwork(torch.nn.Module):
+    """
+    Runs the INT8 network of quantize_network() on the CPU. Takes and returns torch tensors like the eager network,
+    the output is moved back to the device of the input.
+    """
+
+    def __init__(self, quantized_network: torch.nn.Module):
+        super().__init__()
+        self.quantized_network = quantized_network
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        output = self.quantized_network(x.detach().to(device="cpu", dtype=torch.float32))
+        return output.to(device=x.device)
+
+
+def get_dice_delta(
+    network: torch.nn.Module,
+    quantized_network: torch.nn.Module,
+    inferer,
+    data_loader: Iterable,
+    num_classes: int,
+    max_samples: int | None = None,
+) -> tuple[float, float]:
+    """Mean Dice (without background) of the fp32 and the INT8 network on the labelled samples of data_loader (CPU)."""
+    network = network.eval().cpu()
+    metrics = {"fp32": DiceMetric(include_background=False), "int8": DiceMetric(include_background=False)}
+    with torch.no_grad():
+        for i, batchdata in enumerate(data_loader):
+            if max_samples is not None and i >= max_samples:
+                break
+            inputs, label = batchdata["image"].cpu(), batchdata["label"].cpu()
+            label = one_hot(label.long(), num_classes=num_classes)
+            for name, net in [("fp32", network), ("int8", quantized_network)]:
+                pred = inferer(inputs, net)
+                if pred.shape[1] > 1:
+                    pred = torch.argmax(pred, dim=1, keepdim=True)
+                metrics[name](one_hot(pred.long(), num_classes=num_classes), label)
+    dice_fp32, dice_int8 = (metrics[name].aggregate().item() for name in ["fp32", "int8"])
+    logger.info(f"Dice fp32: {dice_fp32:.4f}, int8: {dice_int8:.4f}, delta: {dice_int8 - dice_fp32:+.4f}")
+    return dice_fp32, dice_int8
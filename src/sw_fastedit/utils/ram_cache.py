@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import logging
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+
+import numpy as np
+import torch
+from monai.data.dataset import PersistentDataset
+
+from sw_fastedit.utils.volume_store import VolumeStoreDataset
+
+logger = logging.getLogger("sw_fastedit")
+
+"""
+In-process RAM tier in front of the disk cache of PersistentDataset / VolumeStoreDataset: the preprocessed samples
+(the output of the deterministic transforms) are kept in a least recently used cache with a byte budget, so repeated
+epochs are mostly served from memory without holding the whole dataset.
+"""
+
+
+def get_nbytes(item) -> int:
+    """Memory of all tensors / arrays of a (nested) sample."""
+    if isinstance(item, torch.Tensor):
+        return item.numel() * item.element_size()
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    if isinstance(item, dict):
+        return sum(get_nbytes(v) for v in item.values())
+    if isinstance(item, (list, tuple)):
+        return sum(get_nbytes(v) for v in item)
+    return 0
+
+
+class RamCache:
+    """
+    Least recently used cache with a budget of max_bytes (counted with get_nbytes). Counts the hits, misses and
+    evictions and logs them every log_interval lookups.
+    """
+
+    def __init__(self, max_bytes: int, log_interval: int = 100):
+        self.max_bytes = max_bytes
+        self.log_interval = log_interval
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Copied into the DataLoader worker processes, every worker has its own cache
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items.move_to_end(key)
+            if (self.hits + self.misses) % self.log_interval == 0:
+                self.log_stats()
+            return item[0] if item is not None else None
+
+    def put(self, key, item):
+        nbytes = get_nbytes(item)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            while self.nbytes + nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+            self._items[key] = (item, nbytes)
+            self.nbytes += nbytes
+
+    def log_stats(self):
+        lookups = max(self.hits + self.misses, 1)
+        logger.info(
+            f"RAM cache: {self.hits} hits ({self.hits / lookups:.1%}), {self.misses} misses, {self.evictions} evictions, "
+            f"{len(self._items)} samples with {self.nbytes / 1024**3:.2f}/{self.max_bytes / 1024**3:.2f} GB"
+        )
+
+
+class RamCachedPersistentDataset(PersistentDataset):
+    """
+    PersistentDataset which serves the deterministic part of the samples from ram_cache if possible, only a miss goes
+    to its disk cache. The random transforms are applied to a copy of the cached sample, like CacheDataset does.
+    Without a ram_cache (set by add_ram_cache()) it is a plain PersistentDataset.
+    """
+
+    def __init__(self, *args, ram_cache: RamCache | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ram_cache = ram_cache
+
+    def _cachecheck(self, item_transformed):
+        if self.ram_cache is None:
+            return super()._cachecheck(item_transformed)
+        key = self.hash_func(item_transformed).decode("utf-8") + self.transform_hash
+        pre_random_item = self.ram_cache.get(key)
+        if pre_random_item is None:
+            pre_random_item = super()._cachecheck(item_transformed)
+            # The copy also loads the memory maps of VolumeStoreDataset into RAM
+            self.ram_cache.put(key, deepcopy(pre_random_item))
+            return pre_random_item
+        return deepcopy(pre_random_item)
+
+
+class RamCachedVolumeStoreDataset(RamCachedPersistentDataset, VolumeStoreDataset):
+    """VolumeStoreDataset with the RAM tier of RamCachedPersistentDataset, misses go to the volume store."""
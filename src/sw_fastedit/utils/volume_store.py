@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import base64
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from enum import Enum
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+import torch
+from monai.data import MetaTensor
+from monai.data.dataset import PersistentDataset
+
+logger = logging.getLogger("sw_fastedit")
+
+"""
+Preprocessed volume store as replacement of the pickles of PersistentDataset: every array of a sample (image, label)
+is written as uncompressed .npy file and opened as memory map, the meta data (affine, meta dict, applied operations)
+and all other values (e.g. label_names) go into a JSON sidecar. Loading a sample then only maps the files, the
+random crop afterwards only pages in the crop region instead of deserializing the full scan.
+"""
+
+SIDECAR_NAME = "sample.json"
+
+
+def _to_json(obj):
+    if isinstance(obj, torch.Tensor):
+        return {"__tensor__": obj.detach().cpu().tolist(), "dtype": str(obj.dtype).replace("torch.", "")}
+    if isinstance(obj, np.ndarray):
+        return {"__ndarray__": obj.tolist(), "dtype": str(obj.dtype)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, dict):
+        return {str(k): _to_json(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_json(v) for v in obj]
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    # Anything else (e.g. a Path or a dtype in the meta dict) is pickled, so it is read back unchanged
+    return {"__pickle__": base64.b64encode(pickle.dumps(obj)).decode("ascii")}
+
+
+def _from_json(obj):
+    if isinstance(obj, dict):
+        if "__tensor__" in obj:
+            return torch.tensor(obj["__tensor__"], dtype=getattr(torch, obj["dtype"]))
+        if "__ndarray__" in obj:
+            return np.array(obj["__ndarray__"], dtype=obj["dtype"])
+        if "__pickle__" in obj:
+            return pickle.loads(base64.b64decode(obj["__pickle__"]))
+        return {k: _from_json(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_from_json(v) for v in obj]
+    return obj
+
+
+def write_sample(path: str | Path, data: Dict):
+    """
+    Writes a (dict) sample to the directory path. The directory is written next to path and renamed at the end, so an
+    interrupted write never leaves an incomplete sample behind.
+    """
+    path = Path(path)
+    tmp_path = Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}."))
+    sidecar = {"arrays": {}, "items": {}}
+    for key, value in data.items():
+        if isinstance(value, (torch.Tensor, np.ndarray)):
+            array = value.detach().cpu().numpy() if isinstance(value, torch.Tensor) else value
+            np.save(tmp_path / f"{key}.npy", np.ascontiguousarray(array), allow_pickle=False)
+            entry = {"type": "ndarray" if isinstance(value, np.ndarray) else "tensor"}
+            if isinstance(value, MetaTensor):
+                entry = {"type": "meta_tensor", "meta": _to_json(value.meta)}
+                entry["applied_operations"] = _to_json(value.applied_operations)
+            sidecar["arrays"][str(key)] = entry
+        else:
+            sidecar["items"][str(key)] = _to_json(value)
+    with open(tmp_path / SIDECAR_NAME, "w") as f:
+        json.dump(sidecar, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Written concurrently by another worker
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def read_sample(path: str | Path) -> Dict:
+    """
+    Reads a sample of write_sample() zero-copy: the arrays are copy-on-write memory maps of the .npy files, so only the
+    accessed pages are read from the disk and in-place changes never reach the files.
+    """
+    path = Path(path)
+    with open(path / SIDECAR_NAME) as f:
+        sidecar = json.load(f)
+    data = {key: _from_json(value) for key, value in sidecar["items"].items()}
+    for key, entry in sidecar["arrays"].items():
+        array = np.load(path / f"{key}.npy", mmap_mode="c")
+        if entry["type"] == "ndarray":
+            data[key] = array
+        elif entry["type"] == "tensor":
+            data[key] = torch.from_numpy(array)
+        else:
+            data[key] = MetaTensor(
+                torch.from_numpy(array),
+                meta=_from_json(entry["meta"]),
+                applied_operations=_from_json(entry["applied_operations"]),
+            )
+    return data
+
+
+class VolumeStoreDataset(PersistentDataset):
+    """
+    PersistentDataset which stores the output of the deterministic transforms (up to the first random one) with
+    write_sample() / read_sample() in cache_dir instead of pickling it. Same arguments and cache keys as
+    PersistentDataset, the samples are computed on the first access or upfront with build().
+    """
+
+    def _get_store_path(self, item) -> Path | None:
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / f"{self.hash_func(item).decode('utf-8')}{self.transform_hash}.store"
+
+    def _cachecheck(self, item_transformed):
+        path = self._get_store_path(item_transformed)
+        if path is not None and path.is_dir():
+            return read_sample(path)
+        _item_transformed = self._pre_transform(deepcopy(item_transformed))  # keep the original hashed
+        if path is None:
+            return _item_transformed
+        write_sample(path, _item_transformed)
+        # Continue with the memory maps, like every later access
+        return read_sample(path)
+
+    def _build_item(self, index: int):
+        path = self._get_store_path(self.data[index])
+        if not path.is_dir():
+            write_sample(path, self._pre_transform(deepcopy(self.data[index])))
+
+    def build(self, num_workers: int = 1):
+        """
+        Fills the store for all samples which are missing, with num_workers threads. Threads instead of processes,
+        so the dataset and its transforms are not pickled for every worker; the loading and resampling mostly run
+        in numpy / torch / ITK code which releases the GIL.
+        """
+        assert self.cache_dir is not None, "The volume store needs a cache_dir"
+        missing = [i for i in range(len(self.data)) if not self._get_store_path(self.data[i]).is_dir()]
+        logger.info(f"Building the volume store in {self.cache_dir}: {len(missing)}/{len(self.data)} samples missing")
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                list(executor.map(self._build_item, missing))
+        else:
+            for index in missing:
+                self._build_item(index)
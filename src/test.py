@@ -38,6 +38,8 @@ from sw_fastedit.data import (
 )
 from sw_fastedit.utils.argparser import parse_args, setup_environment_and_adapt_args
 from sw_fastedit.utils.helper import handle_exception
+from sw_fastedit.utils.onnx_network import OnnxNetwork
+from sw_fastedit.utils.quantization import load_quantized_network
 
 
 logger = logging.getLogger("sw_fastedit")
@@ -53,17 +55,37 @@ def run(args):
     for arg in vars(args):
         logger.info("USING:: {} = {}".format(arg, getattr(args, arg)))
     print("")
-    device = torch.device(f"cuda:{args.gpu}")
+    if args.inference_backend in ["onnxruntime", "int8"]:
+        # Annotation nodes without a GPU
+        device = torch.device("cpu")
+    else:
+        device = torch.device(f"cuda:{args.gpu}")
 
     _, pre_transforms_test = get_pre_transforms(args.labels, device, args, input_keys=("image",))
     test_loader = get_test_loader(args, pre_transforms_test)
 
     pred_dir = os.path.join(args.output_dir, "predictions")
     post_transform = get_post_transforms_unsupervised(
-        args.labels, device, pred_dir=pred_dir, pretransform=pre_transforms_test
+        args.labels,
+        device,
+        pred_dir=pred_dir,
+        pretransform=pre_transforms_test,
+        discrete_pred=(args.sw_stitching != "memory"),
     )
 
-    network = get_network(args.network, args.labels, args.non_interactive).to(device)
+    # The HaloTiledInferer derives the halo from the DynUNet, which the onnxruntime / int8 backends do not expose
+    architecture = get_network(args.network, args.labels, args.non_interactive)
+    if args.inference_backend == "onnxruntime":
+        network = OnnxNetwork(args.onnx_path, num_threads=args.onnx_threads)
+    elif args.inference_backend == "int8":
+        network = load_quantized_network(
+            architecture,
+            args.quantized_path,
+            in_channels=1 if args.non_interactive else 1 + len(args.labels),
+            roi_size=args.sw_roi_size,
+        )
+    else:
+        network = architecture.to(device)
     _, test_inferer = get_inferers(
         args.inferer,
         sw_roi_size=args.sw_roi_size,
@@ -74,6 +96,9 @@ def run(args):
         train_sw_overlap=args.train_sw_overlap,
         val_sw_overlap=args.val_sw_overlap,
         cache_roi_weight_map=True,
+        network=architecture,
+        sw_stitching=args.sw_stitching,
+        sw_stitching_dir=args.sw_stitching_dir,
     )
 
     evaluator = get_test_evaluator(
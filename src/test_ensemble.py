@@ -79,6 +79,8 @@ def run_ensemble(args):
         train_sw_overlap=args.train_sw_overlap,
         val_sw_overlap=args.val_sw_overlap,
         cache_roi_weight_map=True,
+        # All folds share the architecture, e.g. for the halo of the HaloTiledInferer
+        network=networks[0],
     )
 
     evaluator = get_ensemble_evaluator(